@@ -9,20 +9,30 @@ from material import Material
 from mesh import Mesh
 
 from shaders import *
-from texture import Texture
+from texture import Texture, texture_manager
+from renderQueue import gl_state
+from vertexLayout import default_layout, vertex_memory
+from culling import local_bounds, transform_bounds, unbounded
 
+import ctypes
 import sys
 
 
+# the parent matrix of models drawn on their own, shared by all drawing methods so that the combined model matrix
+# is kept from one pass to the next (see BaseModel.world_matrix())
+no_parent = poseMatrix()
+
+
 class BaseModel:
     '''
     Base class for all models, implementing the basic draw function for triangular meshes.
     Inherit from this to create new models.
     '''
 
-    def __init__(self, scene, M=poseMatrix(), mesh=Mesh(), color=[1., 1., 1.], primitive=GL_TRIANGLES, visible=True):
+    def __init__(self, scene, M=poseMatrix(), mesh=Mesh(), color=[1., 1., 1.], primitive=GL_TRIANGLES, visible=True, layout=None):
         '''
         Initialises the model data
+        :param layout: The format of the vertex attributes in the vertex buffer, see vertexLayout.py
         '''
 
         print('+ Initializing {}'.format(self.__class__.__name__))
@@ -30,6 +40,9 @@ class BaseModel:
         # if this flag is set to False, the model is not rendered
         self.visible = visible
 
+        # the render queue draws the models of lower passes first (see RenderQueue)
+        self.render_pass = 0
+
         # store the scene reference
         self.scene = scene
 
@@ -59,47 +72,29 @@ class BaseModel:
         # dict of VBOs
         self.vbos = {}
 
-        # dict of attributes
+        # dict of attributes, and the layout of the vertex buffer holding them
         self.attributes = {}
+        self.layout = layout if layout is not None else default_layout
 
         # store the position of the model in the scene, ...
         self.M = M
 
+        # the model matrix combined with the parent's, and the matrices derived from it for the current view. They
+        # are kept until M is replaced, so the model should be moved by assigning a new M rather than modifying it.
+        self.world = (None, None, None)
+        self.view_cache = [None, None, None, None, None]
+
+        # the bounding sphere and box of the mesh, set when the vertices are bound, and the bounds in world
+        # coordinates for the last model matrix (see culling.py)
+        self.bounds = unbounded
+        self.world_bounds_cache = (None, None)
+
         # We use a Vertex Array Object to pack all buffers for rendering in the GPU (see lecture on OpenGL)
         self.vao = glGenVertexArrays(1)
 
         # this buffer will be used to store indices, if using shared vertex representation
         self.index_buffer = None
 
-    def initialise_vbo(self, name, data):
-        print('Initialising VBO for attribute {}'.format(name))
-
-        if data is None:
-            print('(W) Warning in {}.bind_attribute(): Data array for attribute {} is None!'.format(
-                self.__class__.__name__, name))
-            return
-
-        # bind the location of the attribute in the GLSL program to the next index
-        # the name of the location must correspond to a 'in' variable in the GLSL vertex shader code
-        self.attributes[name] = len(self.vbos)
-
-        # create a buffer object...
-        self.vbos[name] = glGenBuffers(1)
-        # and bind it
-        glBindBuffer(GL_ARRAY_BUFFER, self.vbos[name])
-
-        # enable the attribute
-        glEnableVertexAttribArray(self.attributes[name])
-
-        # Associate the bound buffer to the corresponding input location in the shader
-        # Each instance of the vertex shader will get one row of the array
-        # so this can be processed in parallel!
-        glVertexAttribPointer(index=self.attributes[name], size=data.shape[1], type=GL_FLOAT, normalized=False,
-                              stride=0, pointer=None)
-
-        # ... and we set the data in the buffer as the vertex array
-        glBufferData(GL_ARRAY_BUFFER, data, GL_STATIC_DRAW)
-
     def bind_shader(self, shader):
         '''
         If a new shader is bound, we need to re-link it to ensure attributes are correctly linked.  
@@ -120,30 +115,47 @@ class BaseModel:
         '''
 
         # bind the VAO to retrieve all buffers and rendering context
-        glBindVertexArray(self.vao)
+        gl_state.bind_vertex_array(self.vao)
 
         if self.mesh.vertices is None:
             print('(W) Warning in {}.bind(): No vertex array!'.format(self.__class__.__name__))
+            return
 
-        # initialise vertex position VBO and link to shader program attribute
-        self.initialise_vbo('position', self.mesh.vertices)
-        self.initialise_vbo('normal', self.mesh.normals)
-        self.initialise_vbo('color', self.mesh.colors)
-        self.initialise_vbo('texCoord', self.mesh.textureCoords)
-        self.initialise_vbo('tangent', self.mesh.tangents)
-        self.initialise_vbo('binormal', self.mesh.binormals)
+        # all attributes are interleaved in a single VBO, in the formats selected by the layout. The position is
+        # always the first attribute (see ShadowMapping.DepthShader).
+        attributes = [('position', self.mesh.vertices), ('normal', self.mesh.normals), ('color', self.mesh.colors),
+                      ('texCoord', self.mesh.textureCoords), ('tangent', self.mesh.tangents),
+                      ('binormal', self.mesh.binormals)]
+        vertices, fields = self.layout.pack(attributes)
+        self.bounds = local_bounds(self.mesh.vertices)
+
+        self.vbos['vertices'] = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbos['vertices'])
+        glBufferData(GL_ARRAY_BUFFER, vertices, GL_STATIC_DRAW)
+
+        # link each attribute to the next location of the shader program, at its offset in the interleaved vertex
+        for name, size, type, normalized, offset in fields:
+            self.attributes[name] = len(self.attributes)
+            glEnableVertexAttribArray(self.attributes[name])
+            glVertexAttribPointer(index=self.attributes[name], size=size, type=type, normalized=normalized,
+                                  stride=vertices.shape[1], pointer=ctypes.c_void_p(offset))
 
         # if indices are provided, put them in a buffer too
+        index_bytes = 0
         if self.mesh.faces is not None:
             self.index_buffer = glGenBuffers(1)
             glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
             glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.mesh.faces, GL_STATIC_DRAW)
+            index_bytes = self.mesh.faces.nbytes
+
+        float_bytes = sum(4 * data.size for name, data in attributes if data is not None)
+        vertex_memory.add(vertices.shape[0], vertices.nbytes, float_bytes, index_bytes)
 
         # finally we unbind the VAO and VBO when we're done to avoid side effects
-        glBindVertexArray(0)
+        gl_state.bind_vertex_array(0)
         glBindBuffer(GL_ARRAY_BUFFER, 0)
 
-    def draw(self, Mp=poseMatrix()):
+    def draw(self, Mp=no_parent):
         '''
         Draws the model using OpenGL functions.
         :param Mp: The model matrix of the parent object, for composite objects.
@@ -156,41 +168,143 @@ class BaseModel:
                 print('(W) Warning in {}.draw(): No vertex array!'.format(self.__class__.__name__))
 
             # bind the Vertex Array Object so that all buffers are bound correctly and following operations affect them
-            glBindVertexArray(self.vao)
+            gl_state.bind_vertex_array(self.vao)
+
+            # use the layered variant of the shader when rendering to all layers of a framebuffer at once
+            instances = self.shader.select_layers(self.scene.layer_PV)
 
             # setup the shader program and provide it the Model, View and Projection matrices to use
             # for rendering this model
             self.shader.bind(
                 model=self,
-                M=np.matmul(Mp, self.M)
+                M=self.world_matrix(Mp)
             )
 
             #print('---> object {} rendered using shader {}'.format(self.name, self.shader.name))
 
             # bind all textures. Note that your shader needs to handle each one with a sampler object.
             for unit, tex in enumerate(self.mesh.textures):
-                glActiveTexture(GL_TEXTURE0 + unit)
-                tex.bind()
+                tex.bind(unit)
 
-            # check whether the data is stored as vertex array or index array
-            if self.mesh.faces is not None:
-                # draw the data in the buffer using the index array
-                glDrawElements(self.primitive, self.mesh.faces.flatten().shape[0], GL_UNSIGNED_INT, None )
-            else:
-                # draw the data in the buffer using the vertex array ordering only.
-                glDrawArrays(self.primitive, 0, self.mesh.vertices.shape[0])
+            # the VAO and textures are left bound, so that they are not bound again if the next model uses them too
+            self.draw_primitives(instances)
 
-            # unbind the shader to avoid side effects
-            glBindVertexArray(0)
+    def draw_depth(self, shader, Mp=no_parent):
+        '''
+        Draws the model using a depth only shader, eg for rendering shadow maps: the shader only uses the vertex
+        positions, and no texture is bound.
+        :param shader: The depth shader, see ShadowMapping.DepthShader
+        :param Mp: The model matrix of the parent object, for composite objects.
+        '''
+        if self.visible:
+            gl_state.bind_vertex_array(self.vao)
+            shader.bind(model=self, M=self.world_matrix(Mp))
+            self.draw_primitives()
+
+    def world_matrix(self, Mp):
+        '''
+        Returns the model matrix combined with the matrix of the parent object, computed again only when one of them
+        is replaced.
+        :param Mp: The model matrix of the parent object
+        '''
+        if self.world[0] is not Mp or self.world[1] is not self.M:
+            self.world = (Mp, self.M, np.matmul(Mp, self.M))
+        return self.world[2]
+
+    def world_bounds(self, Mp=no_parent):
+        '''
+        Returns the bounds of the model in world coordinates, computed again only when the model matrix is replaced.
+        :param Mp: The model matrix of the parent object
+        :return: An array of 10 values, see culling.py
+        '''
+        M = self.world_matrix(Mp)
+        if self.world_bounds_cache[0] is not M:
+            self.world_bounds_cache = (M, transform_bounds(self.bounds, M))
+        return self.world_bounds_cache[1]
+
+    def view_transforms(self, context, M, normals=True):
+        '''
+        Returns the matrices transforming the model to view and clip coordinates, computed again only when the model
+        matrix or the frame context (the projection, view or light) changed.
+        :param context: The FrameContext of the scene
+        :param M: The model matrix, as returned by world_matrix()
+        :param normals: Whether to return the inverse transpose of VM for transforming the normals, or None
+        :return: A tuple (PVM, VM, VMiT)
+        '''
+        cache = self.view_cache
+        if cache[0] is not context or cache[1] is not M:
+            VM = np.matmul(context.V, M)
+            cache = self.view_cache = [context, M, np.matmul(context.P, VM), VM, None]
+        if normals and cache[4] is None:
+            cache[4] = np.linalg.inv(cache[3])[:3, :3].transpose()
+        return cache[2], cache[3], cache[4]
+
+    def draw_primitives(self, instances=1):
+        '''
+        Issues the draw call for the buffers of the model, once the VAO and shader are bound.
+        :param instances: The number of instances to draw, eg for layered rendering
+        '''
+        # check whether the data is stored as vertex array or index array
+        if self.mesh.faces is not None and instances > 1:
+            # draw one instance per layer
+            glDrawElementsInstanced(self.primitive, self.mesh.faces.size, self.index_type(), None, instances)
+        elif self.mesh.faces is not None:
+            # draw the data in the buffer using the index array
+            glDrawElements(self.primitive, self.mesh.faces.size, self.index_type(), None )
+        elif instances > 1:
+            glDrawArraysInstanced(self.primitive, 0, self.mesh.vertices.shape[0], instances)
+        else:
+            # draw the data in the buffer using the vertex array ordering only.
+            glDrawArrays(self.primitive, 0, self.mesh.vertices.shape[0])
+
+    def triangles(self):
+        '''
+        Returns the vertex indices of the triangles of the model, eg for picking, quads being split in two triangles.
+        :return: An (T, 3) array of indices in the vertex array, empty for models drawn with other primitives
+        '''
+        faces = self.mesh.faces
+        if faces is None and self.primitive == GL_TRIANGLES:
+            faces = np.arange(self.mesh.vertices.shape[0] // 3 * 3).reshape(-1, 3)
+        if faces is None or faces.shape[1] not in (3, 4):
+            return np.zeros((0, 3), dtype=int)
+        if faces.shape[1] == 4:
+            faces = np.concatenate([faces[:, [0, 1, 2]], faces[:, [0, 2, 3]]])
+        return faces
+
+    def triangle_vertices(self):
+        '''
+        Returns the positions of the vertices of the triangles returned by triangles(), in model coordinates.
+        :return: An (T, 3, 3) array
+        '''
+        return self.mesh.vertices[self.triangles()]
+
+    def part_name(self, triangle):
+        '''
+        Returns the name of the part of the model holding a triangle, for models drawing several meshes (see
+        StaticBatch), or None.
+        :param triangle: The index of the triangle, in the array returned by triangles()
+        '''
+        return None
+
+    def index_type(self):
+        '''
+        Returns the OpenGL type of the index array, which can be stored on 16 or 32 bits.
+        '''
+        if self.mesh.faces.dtype == np.uint16:
+            return GL_UNSIGNED_SHORT
+        return GL_UNSIGNED_INT
 
     def vbo__del__(self):
         '''
-        Release all VBO objects when finished.
+        Release all VBO objects and textures when finished.
         '''
-        for vbo in self.vbos.items():
-            glDeleteBuffers(1, vbo)
+        for vbo in self.vbos.values():
+            glDeleteBuffers(1, [vbo])
+
+        for texture in self.mesh.textures:
+            texture_manager.release(texture)
 
-        glDeleteVertexArrays(1,self.vao.tolist())
+        gl_state.delete_vertex_array(self.vao)
 
 
 class DrawModelFromMesh(BaseModel):
@@ -198,12 +312,12 @@ class DrawModelFromMesh(BaseModel):
     Base class for all models, inherit from this to create new models
     '''
 
-    def __init__(self, scene, M, mesh, name=None, shader=None, visible=True):
+    def __init__(self, scene, M, mesh, name=None, shader=None, visible=True, layout=None):
         '''
         Initialises the model data
         '''
 
-        BaseModel.__init__(self, scene=scene, M=M, mesh=mesh, visible=visible)
+        BaseModel.__init__(self, scene=scene, M=M, mesh=mesh, visible=visible, layout=layout)
 
         if name is not None:
             self.name = name
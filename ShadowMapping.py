@@ -3,9 +3,12 @@ from matutils import *
 
 from mesh import Mesh
 from BaseModel import DrawModelFromMesh
-from shaders import BaseShaderProgram,PhongShader
+from shaders import BaseShaderProgram,PhongShader,instance_attributes
 from texture import Texture
-from framebuffer import Framebuffer
+from framebuffer import Framebuffer, Renderbuffer
+from renderQueue import gl_state
+from culling import cull
+from bvh import ModelTree
 
 
 def normalize(v):
@@ -16,6 +19,10 @@ def lookAt(eye, center, up=np.array([0, 1, 0])):
     f = normalize(center - eye)
     u = normalize(up)
 
+    # the up vector cannot be parallel to the view direction, eg for a light right above its target
+    if np.linalg.norm(np.cross(f, u)) < 1e-6:
+        u = np.array([0, 0, 1])
+
     # Note: the normalization is missing in the official glu manpage: /: /: /
     s = normalize(np.cross(f, u))
     u = np.cross(s, f)
@@ -42,36 +49,84 @@ class ShowTextureShader(BaseShaderProgram):
         self.add_uniform('sampler')
 
 
+class DepthShader(BaseShaderProgram):
+    '''
+    Minimal shader for rendering depth only, eg for shadow maps: it transforms the vertex positions and does not
+    shade the fragments.
+    '''
+    def __init__(self):
+        BaseShaderProgram.__init__(self, name='depth')
+
+        # the projection-view matrix of the depth map, set before rendering
+        self.PV = np.identity(4)
+
+        # the positions are always the first attribute of the models (see BaseModel.bind())
+        self.compile({'position': 0})
+
+        # the variant for instanced models, reading the model matrix of each instance (see InstancedModel)
+        with open('shaders/depth_instanced/vertex_shader.glsl', 'r') as file:
+            self.instanced_program = self.link_program(file.read(), dict(self.attributes, **instance_attributes))
+        self.use_program(self.default_program)
+
+    def bind(self, model, M, instanced=False):
+        '''
+        :param instanced: Whether the model is drawn with instancing, using the instanced variant of the program
+        '''
+        program = self.instanced_program if instanced else self.default_program
+        if program != self.program:
+            self.use_program(program)
+        gl_state.use_program(self.program)
+        self.uniforms['PVM'].bind(np.matmul(self.PV, M))
+
+
 class ShadowMappingShader(PhongShader):
-    def __init__(self, shadow_map=None):
-        PhongShader.__init__(self, name='shadow_mapping')
+    def __init__(self, shadow_map=None, name='shadow_mapping'):
+        PhongShader.__init__(self, name=name)
         self.add_uniform('shadow_map')
         #self.add_uniform('old_map')
         self.add_uniform('shadow_map_matrix')
+        self.add_uniform('cascades')
+        self.add_uniform('shadow_cascades')
+        self.add_uniform('cascade_matrices')
+        self.add_uniform('cascade_ends')
         self.shadow_map = shadow_map
 
     def bind(self, model, M):
         PhongShader.bind(self, model, M)
         self.uniforms['shadow_map'].bind(1)
+        self.uniforms['shadow_cascades'].bind(2)
         #self.uniforms['old_map'].bind(2)
 
-        glActiveTexture(GL_TEXTURE1)
-        self.shadow_map.bind()
+        matrices, ends = self.shadow_map.shadow_matrices(model.scene.frame_context())
+        if self.shadow_map.cascades > 0:
+            self.shadow_map.bind(2)
+
+            self.uniforms['cascades'].bind(self.shadow_map.cascades)
+            self.uniforms['cascade_matrices'].bind_matrix(matrices, number=max_cascades)
+            self.uniforms['cascade_ends'].bind_vector(ends)
+            return
+
+        self.uniforms['cascades'].bind(0)
+
+        self.shadow_map.bind(1)
 
         #glActiveTexture(GL_TEXTURE2)
         #self.shadow_map.bind()
 
-        glActiveTexture(GL_TEXTURE0)
-
         # setup the shadow map matrix
-        VsT = np.linalg.inv(model.scene.camera.V)
-        self.SM = np.matmul(self.shadow_map.V, VsT)
-        self.SM = np.matmul(self.shadow_map.P, self.SM)
-        self.SM = np.matmul(translationMatrix([1, 1, 1]), self.SM)
-        self.SM = np.matmul(scaleMatrix(0.5), self.SM)
+        self.SM = matrices
         self.uniforms['shadow_map_matrix'].bind(self.SM)
 
 
+class InstancedShadowMappingShader(ShadowMappingShader):
+    '''
+    Variant of the shadow mapping shader for instanced models (see InstancedModel), which reads the model matrix and
+    the colour of each instance from the instance attributes.
+    '''
+    def __init__(self, shadow_map=None):
+        ShadowMappingShader.__init__(self, shadow_map=shadow_map, name='shadow_mapping_instanced')
+
+
 class ShowTexture(DrawModelFromMesh):
     '''
     Class for drawing the cube faces flattened on the screen (for debugging purposes)
@@ -116,8 +171,28 @@ class ShowTexture(DrawModelFromMesh):
         DrawModelFromMesh.__init__(self, scene=scene, M=poseMatrix(position=[0, 0, 1]), mesh=mesh, shader=ShowTextureShader(), visible=False)
 
 
+# the largest number of cascades supported by the shadow_mapping shader
+max_cascades = 4
+
+
 class ShadowMap(Texture):
-    def __init__(self, light=None, width=1000, height=1000):
+    def __init__(self, light=None, width=1000, height=1000, cache_static=True, cascades=0, shadow_distance=30.0, split_weight=0.75):
+        '''
+        :param light: The light source casting the shadows
+        :param width: The width of the shadow map (of each cascade)
+        :param height: The height of the shadow map (of each cascade)
+        :param cache_static: Whether to keep the depth of the static casters in a separate buffer, which is only
+        rendered again when the light moves. Each frame, the buffer is copied to the shadow map and only the dynamic
+        casters are drawn.
+        :param cascades: The number of cascades, up to max_cascades, or 0 for a single shadow map covering the whole
+        frustum of the light. With cascades, the view frustum of the camera is split in slices by distance, and each
+        slice is rendered to a layer of a texture array, with the projection of the light cropped to fit the slice.
+        :param shadow_distance: With cascades, the distance to the camera up to which shadows are rendered
+        :param split_weight: With cascades, how the frustum is split, from 0 for slices of the same depth to 1 for
+        slices growing with the distance (logarithmic split)
+        '''
+        if cascades > max_cascades:
+            raise ValueError('At most {} shadow map cascades are supported, {} requested'.format(max_cascades, cascades))
 
         # In order to call parent constructor I would need to change it to allow for an empty texture object (poor design)
         # Texture.__init__(self, "shadow", img=None, wrap=GL_CLAMP_TO_EDGE, sample=GL_NEAREST, format=GL_DEPTH_COMPONENT, type=GL_FLOAT, target=GL_TEXTURE_2D)
@@ -128,13 +203,20 @@ class ShadowMap(Texture):
         # we'll just copy and modify the code here
         self.name = 'shadow'
         self.format = GL_DEPTH_COMPONENT
+        # the size of the depth values must match the static cache, to copy between them
+        self.internal_format = GL_DEPTH_COMPONENT24
         self.type = GL_FLOAT
         self.wrap = GL_CLAMP_TO_EDGE
         self.sample = GL_LINEAR
-        self.target = GL_TEXTURE_2D
+        self.target = GL_TEXTURE_2D_ARRAY if cascades > 0 else GL_TEXTURE_2D
         self.width = width
         self.height = height
 
+        self.cascades = cascades
+        self.shadow_distance = shadow_distance
+        self.split_weight = split_weight
+        layers = max(cascades, 1)
+
         # create the texture
         self.textureid = glGenTextures(1)
 
@@ -142,35 +224,190 @@ class ShadowMap(Texture):
 
         # initialise the texture memory
         self.bind()
-        glTexImage2D(self.target, 0, self.format, self.width, self.height, 0, self.format, self.type, None)
+        if cascades > 0:
+            glTexImage3D(self.target, 0, self.internal_format, self.width, self.height, layers, 0, self.format, self.type, None)
+        else:
+            glTexImage2D(self.target, 0, self.internal_format, self.width, self.height, 0, self.format, self.type, None)
         self.unbind()
 
         self.set_wrap_parameter(self.wrap)
         self.set_sampling_parameter(self.sample)
         self.set_shadow_comparison()
 
-        self.fbo = Framebuffer(attachment=GL_DEPTH_ATTACHMENT, texture=self)
+        # one framebuffer per layer of the texture
+        self.fbos = []
+        for layer in range(layers):
+            fbo = Framebuffer(attachment=GL_DEPTH_ATTACHMENT)
+            fbo.prepare(self, layer=layer if cascades > 0 else None)
+            self.fbos.append(fbo)
 
         self.V = None
 
+        # with cascades, the projection-view matrix of each cascade and the distance to the camera where it ends
+        self.cascade_PV = None
+        self.cascade_ends = None
+
+        # the shadow map matrices for the current frame context and light view, see shadow_matrices()
+        self.matrices = (None, None, None)
+
+        # the models casting shadows, which are drawn with a depth only shader. Static casters never move, while
+        # dynamic casters (eg, the balloon) may move on any frame.
+        self.static_casters = []
+        self.dynamic_casters = []
+        self.shader = DepthShader()
+
+        # the casters in bounding volume hierarchies for culling, built when rendering after casters were added
+        self.static_tree = None
+        self.dynamic_tree = None
+
+        # the depth of the static casters in each layer, and the view it was rendered for
+        self.static_fbos = None
+        if cache_static:
+            self.static_depths = [Renderbuffer(width, height, format=self.internal_format) for layer in range(layers)]
+            self.static_fbos = []
+            for depth in self.static_depths:
+                fbo = Framebuffer(attachment=GL_DEPTH_ATTACHMENT)
+                fbo.attach_renderbuffer(depth)
+                self.static_fbos.append(fbo)
+        self.static_view = None
+
+        print('* Shadow map of {} layer(s) of {}x{}, using {:.1f}MB'.format(
+            layers, width, height, (2 if cache_static else 1) * layers * width * height * 4 / 2**20))
+
+    def invalidate(self):
+        '''
+        Marks the depth of the static casters as out of date, eg if one of them moved.
+        '''
+        self.static_view = None
+        self.static_tree = None
+
+    def add_casters(self, models, dynamic=False):
+        '''
+        Adds models to the shadow casters, models that are not added do not cast shadows.
+        :param models: A list of models
+        :param dynamic: Whether the models may move
+        '''
+        if dynamic:
+            self.dynamic_casters += models
+            self.dynamic_tree = None
+        else:
+            self.static_casters += models
+            self.invalidate()
+
+    def shadow_matrices(self, context):
+        '''
+        Returns the shadow map matrices, which map the view coordinates of the fragments to the texture coordinates
+        and depth in the shadow map (scaled from [-1,1] to [0,1]). They are the same for all models, so they are only
+        computed again when the view or the shadow map changed.
+        :param context: The FrameContext of the scene
+        :return: A tuple (matrices, ends): without cascades, the shadow map matrix and None. With cascades, the
+        matrices and ends of max_cascades cascades, the ends of the unused cascades set to the largest float so
+        that they are never selected.
+        '''
+        if self.matrices[0] is not context or self.matrices[1] is not self.V:
+            bias = np.matmul(scaleMatrix(0.5), translationMatrix([1, 1, 1]))
+            if self.cascades > 0:
+                matrices = np.tile(np.identity(4), (max_cascades, 1, 1))
+                matrices[:self.cascades] = np.matmul(bias, np.matmul(self.cascade_PV, context.iV))
+                ends = np.full(max_cascades, np.finfo('f').max, dtype='f')
+                ends[:self.cascades] = self.cascade_ends
+            else:
+                matrices = np.matmul(bias, np.matmul(self.P, np.matmul(self.V, context.iV)))
+                ends = None
+            self.matrices = (context, self.V, (matrices, ends))
+        return self.matrices[2]
+
+    def fit_cascades(self, scene):
+        '''
+        Splits the view frustum of the camera in slices, and crops the projection of the light to each slice.
+        :param scene: The scene, for the projection and the camera
+        :return: A tuple (projection-view matrix of each cascade, distance to the camera where each cascade ends)
+        '''
+        # the corners of the view frustum in view coordinates, first on the near plane and then on the far plane
+        corners = np.array([[x, y, z, 1] for z in (-1, 1) for y in (-1, 1) for x in (-1, 1)], dtype='f')
+        corners = np.matmul(corners, np.linalg.inv(scene.P).T)
+        corners = corners[:, :3] / corners[:, 3:]
+        near = -corners[0, 2]
+        far = min(-corners[4, 2], self.shadow_distance)
+
+        # the ends of the slices, blending splits of the same depth and logarithmic splits
+        i = np.arange(1, self.cascades + 1) / self.cascades
+        ends = self.split_weight * near * (far / near) ** i + (1 - self.split_weight) * (near + (far - near) * i)
+        starts = np.hstack([near, ends[:-1]])
+
+        # the corners of each slice, along the edges of the frustum, in world coordinates
+        edges = corners[:4] / near
+        slices = np.concatenate([edges[None] * starts[:, None, None], edges[None] * ends[:, None, None]], axis=1)
+        slices = np.concatenate([slices, np.ones(slices.shape[:2] + (1,))], axis=2)
+        PV = np.matmul(self.P, self.V)
+        clip = np.matmul(slices, np.matmul(PV, np.linalg.inv(scene.camera.V)).T)
+
+        # the window of each slice in the projection of the light, the whole window if a corner is behind the light
+        ndc = clip[:, :, :2] / clip[:, :, 3:]
+        low = np.clip(ndc.min(axis=1), -1, 1)
+        high = np.clip(ndc.max(axis=1), -1, 1)
+        behind = (clip[:, :, 3] <= 0).any(axis=1)
+        low[behind] = -1
+        high[behind] = 1
+        size = np.maximum(high - low, 1e-6)
+
+        # crop the projection to the window of each slice
+        crop = np.tile(np.identity(4), (self.cascades, 1, 1))
+        crop[:, [0, 1], [0, 1]] = 2 / size
+        crop[:, [0, 1], 3] = -(high + low) / size
+        return np.matmul(crop, PV), ends
+
     def render(self, scene, target=[0, 0, 0]):
-        # backup the view matrix and replace with the new one
-        #self.P = scene.P
         if self.light is not None:
             self.P = frustumMatrix(-1.0, +1.0, -1.0, +1.0, 1.0, 20.0)
             self.V = lookAt(np.array(self.light.position), np.array(target))
-            scene.camera.V = self.V
+
+            # the static casters only need rendering again if the light moved, or the camera for cascades
+            view = tuple(self.light.position) + tuple(target)
+            if self.cascades > 0:
+                view += tuple(scene.camera.V.flatten())
+            if self.static_fbos is not None and view == self.static_view and len(self.dynamic_casters) == 0:
+                return
+
+            if self.cascades > 0:
+                self.cascade_PV, self.cascade_ends = self.fit_cascades(scene)
+                layer_PV = self.cascade_PV
+            else:
+                layer_PV = [np.matmul(self.P, self.V)]
+
+            if self.static_tree is None:
+                self.static_tree = ModelTree(static=self.static_casters)
+            if self.dynamic_tree is None:
+                self.dynamic_tree = ModelTree(dynamic=self.dynamic_casters)
 
             # update the viewport for the image size
             glViewport(0, 0, self.width, self.height)
 
-            self.fbo.bind()
-            scene.draw_shadow_map()
-            self.fbo.unbind()
+            for layer, PV in enumerate(layer_PV):
+                self.shader.PV = PV
+                fbo = self.fbos[layer]
+                if self.static_fbos is None:
+                    fbo.bind()
+                    glClear(GL_DEPTH_BUFFER_BIT)
+                    for model in cull(self.static_tree, PV, 'shadow') + cull(self.dynamic_tree, PV, 'shadow'):
+                        model.draw_depth(self.shader)
+                else:
+                    static_fbo = self.static_fbos[layer]
+                    if view != self.static_view:
+                        static_fbo.bind()
+                        glClear(GL_DEPTH_BUFFER_BIT)
+                        for model in cull(self.static_tree, PV, 'shadow'):
+                            model.draw_depth(self.shader)
+
+                    # start from a copy of the static depth, and add the dynamic casters
+                    glBindFramebuffer(GL_READ_FRAMEBUFFER, static_fbo.fbo)
+                    glBindFramebuffer(GL_DRAW_FRAMEBUFFER, fbo.fbo)
+                    glBlitFramebuffer(0, 0, self.width, self.height, 0, 0, self.width, self.height, GL_DEPTH_BUFFER_BIT, GL_NEAREST)
+                    fbo.bind()
+                    for model in cull(self.dynamic_tree, PV, 'shadow'):
+                        model.draw_depth(self.shader)
+                fbo.unbind()
+            self.static_view = view
 
             # reset the viewport to the windows size
             glViewport(0, 0, scene.window_size[0], scene.window_size[1])
-
-            # restore the view matrix
-            scene.camera.V = None
-            scene.camera.update()
@@ -0,0 +1,264 @@
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from blender import load_obj_data, load_material_library, create_meshes, cache_align
+from mesh import material_texture_parameters
+from texture import ImageWrapper, decode_image, mip_chain
+
+'''
+Parallel loading of the scene assets.
+The CPU heavy part of loading (parsing the Blender files, calculating normals and decoding the images) does not
+need OpenGL, so it is done in a pool of worker processes while the main process creates the window. The arrays are
+passed back through shared memory, and the main process only creates the Mesh objects and uploads them to OpenGL.
+'''
+
+# shared memory blocks created by this worker process. They are kept open until the worker exits, as on some
+# platforms (eg, Windows) a block is freed as soon as no process has it open, possibly before the main process
+# attached to it.
+shared_blocks = []
+
+
+def share_arrays(arrays):
+    '''
+    Copies arrays to a new shared memory block.
+    :param arrays: A dictionary of numpy arrays (None entries are skipped)
+    :return: A tuple (block name, layout), the layout giving the type, shape and offset of each array in the block
+    '''
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        if array is None:
+            continue
+        layout[name] = (array.dtype.str, array.shape, offset)
+        offset = cache_align(offset + array.nbytes)
+
+    # the main process unlinks the block once it copied the arrays, so this process should not track it. Before
+    # Python 3.13 blocks are always tracked on POSIX systems, under their name with a leading slash
+    if sys.version_info >= (3, 13):
+        block = shared_memory.SharedMemory(create=True, size=max(offset, 1), track=False)
+    else:
+        block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        if os.name == 'posix':
+            resource_tracker.unregister('/' + block.name, 'shared_memory')
+
+    for name, (dtype, shape, offset) in layout.items():
+        np.ndarray(shape, dtype, buffer=block.buf, offset=offset)[...] = arrays[name]
+    shared_blocks.append(block)
+
+    return block.name, layout
+
+
+def unshare_arrays(block_name, layout):
+    '''
+    Copies back the arrays shared by share_arrays(), and frees the shared memory block.
+    '''
+    block = shared_memory.SharedMemory(name=block_name)
+    try:
+        return {name: np.ndarray(shape, dtype, buffer=block.buf, offset=offset).copy() for name, (dtype, shape, offset) in layout.items()}
+    finally:
+        block.close()
+        block.unlink()
+
+
+def load_obj_job(file_name, kwargs):
+    '''
+    Worker job: loads the mesh data of a Blender file, and lists the textures used by its materials.
+    '''
+    start = time.perf_counter()
+    mtl_files, meshes = load_obj_data(file_name, **kwargs)
+
+    # create_meshes() uses the last material library of the file
+    textures = set()
+    if len(mtl_files) > 0:
+        library = load_material_library(mtl_files[-1])
+        for mesh in meshes:
+            if mesh['material'] is not None:
+                texture = library.materials[library.names[mesh['material']]].texture
+                if texture is not None:
+                    textures.add(texture)
+
+    meshes = [(mesh['material'], share_arrays({name: array for name, array in mesh.items() if name != 'material'})) for mesh in meshes]
+    return mtl_files, meshes, sorted(textures), time.perf_counter() - start
+
+
+def decode_image_job(name, mipmaps=False):
+    '''
+    Worker job: decodes an image from the textures folder, and computes its mipmap levels if requested.
+    '''
+    start = time.perf_counter()
+    levels = [decode_image(name)]
+    if mipmaps:
+        levels = mip_chain(levels[0])
+    block = share_arrays({'level{}'.format(level): pixels for level, pixels in enumerate(levels)})
+    return block, time.perf_counter() - start
+
+
+class AssetLoader:
+    '''
+    Loads Blender files and their textures in a pool of worker processes. Files are submitted with load_obj_files(),
+    which returns immediately, and the meshes are collected with meshes() once OpenGL is initialised.
+    The loader should be created before the window and the OpenGL context, so that worker processes do not inherit
+    them, and closed after loading.
+    '''
+    def __init__(self, processes=None):
+        '''
+        :param processes: The number of worker processes, by default the number of CPUs. If 0, the assets are
+        loaded sequentially in the main process when requested, as without the loader.
+        '''
+        self.executor = ProcessPoolExecutor(processes) if processes != 0 else None
+        self.lock = threading.Lock()
+        self.obj_jobs = {}
+        self.obj_options = {}
+        self.image_jobs = {}
+        self.closed = False
+
+        # time spent in the workers and in the main process, per task
+        self.start = time.perf_counter()
+        self.timings = {'parse': 0., 'decode': 0., 'wait': 0., 'unshare': 0., 'create': 0.}
+
+    def load_obj_files(self, file_names, **kwargs):
+        '''
+        Submits Blender files for loading, the textures of their materials are decoded as soon as the file is read.
+        :param file_names: A list of .obj files. An entry can also be a pair (file name, dictionary of arguments for
+        this file only), eg ('models/water.obj', {'recompute_normals': True}).
+        :param kwargs: Arguments for load_obj_file() (use_cache, recompute_normals), for all the files
+        '''
+        for file_name in file_names:
+            options = dict(kwargs)
+            if isinstance(file_name, tuple):
+                file_name, file_options = file_name
+                options.update(file_options)
+
+            # the arguments are kept for loading the file directly, if there is no pool of workers
+            self.obj_options[file_name] = options
+            if self.executor is not None and file_name not in self.obj_jobs:
+                job = self.executor.submit(load_obj_job, file_name, options)
+                job.add_done_callback(self.load_textures)
+                self.obj_jobs[file_name] = job
+
+    def load_textures(self, job):
+        '''
+        Called when a Blender file is loaded, to submit the decoding of its textures.
+        '''
+        if job.exception() is None:
+            self.load_material_textures(job.result()[2])
+
+    def load_material_textures(self, names):
+        '''
+        Submits the textures of materials for decoding, with their mipmaps if the meshes compute them on the CPU.
+        '''
+        self.load_images(names, mipmaps=material_texture_parameters.get('mipmap') == 'cpu')
+
+    def load_images(self, names, mipmaps=False):
+        '''
+        Submits images from the textures folder for decoding.
+        :param names: A list of image names, as passed to Texture()
+        :param mipmaps: Whether to compute the mipmap levels of the images too, see mip_chain()
+        '''
+        if self.executor is None:
+            return
+
+        with self.lock:
+            if self.closed:
+                return
+            for name in names:
+                if name not in self.image_jobs:
+                    try:
+                        self.image_jobs[name] = self.executor.submit(decode_image_job, name, mipmaps)
+                    except RuntimeError:
+                        # the pool was shut down, eg when exiting after an error in the main process
+                        return
+
+    def images(self, names):
+        '''
+        Waits for the decoding of the images, and stores them in ImageWrapper.decoded, so that textures using these
+        images are created without reading the files again. Images that could not be decoded are skipped, and
+        will be loaded by ImageWrapper as usual.
+        '''
+        for name in names:
+            with self.lock:
+                job = self.image_jobs.get(name)
+            if job is None or name in ImageWrapper.decoded:
+                continue
+
+            start = time.perf_counter()
+            exception = job.exception()
+            self.timings['wait'] += time.perf_counter() - start
+            if exception is not None:
+                print('(W) Could not decode image {}: {}'.format(name, exception))
+                continue
+
+            block, duration = job.result()
+            self.timings['decode'] += duration
+
+            start = time.perf_counter()
+            levels = unshare_arrays(*block)
+            ImageWrapper.decoded[name] = [levels['level{}'.format(level)] for level in range(len(levels))]
+            self.timings['unshare'] += time.perf_counter() - start
+
+    def meshes(self, file_name, **kwargs):
+        '''
+        Returns the meshes of a Blender file, as load_obj_file() does. This must be called from the main process, as
+        creating the meshes creates their textures in OpenGL.
+        :param file_name: The .obj file, loaded directly if it was not submitted with load_obj_files()
+        :param kwargs: Arguments for load_obj_file(), if the file was not submitted. They override the arguments
+        given to load_obj_files().
+        :return: A list of Mesh objects
+        '''
+        job = self.obj_jobs.pop(file_name, None)
+        if job is None:
+            start = time.perf_counter()
+            data = load_obj_data(file_name, **dict(self.obj_options.get(file_name, {}), **kwargs))
+            self.timings['parse'] += time.perf_counter() - start
+        else:
+            start = time.perf_counter()
+            mtl_files, meshes, textures, duration = job.result()
+            self.timings['wait'] += time.perf_counter() - start
+            self.timings['parse'] += duration
+
+            start = time.perf_counter()
+            data = mtl_files, [dict(material=material, **unshare_arrays(*block)) for material, block in meshes]
+            self.timings['unshare'] += time.perf_counter() - start
+
+            # the textures may not be submitted yet if the callback of the job did not run
+            self.load_material_textures(textures)
+            self.images(textures)
+
+        start = time.perf_counter()
+        mesh_list = create_meshes(*data)
+        self.timings['create'] += time.perf_counter() - start
+        return mesh_list
+
+    def close(self):
+        '''
+        Stops the worker processes, frees the decoded images and prints where the loading time was spent.
+        '''
+        if self.executor is not None:
+            # free the shared memory of the jobs whose results were never collected
+            for job in self.obj_jobs.values():
+                if not job.cancel() and job.exception() is None:
+                    for material, block in job.result()[1]:
+                        unshare_arrays(*block)
+
+            with self.lock:
+                self.closed = True
+
+            for name, job in self.image_jobs.items():
+                if name not in ImageWrapper.decoded and not job.cancel() and job.exception() is None:
+                    unshare_arrays(*job.result()[0])
+
+            self.executor.shutdown()
+
+        for name in self.image_jobs:
+            ImageWrapper.decoded.pop(name, None)
+
+        print('Assets loaded in {:.3f}s: parsing {:.3f}s and decoding {:.3f}s in workers, main process waited {:.3f}s, '
+              'unshared arrays in {:.3f}s and created meshes in {:.3f}s'.format(
+                  time.perf_counter() - self.start, self.timings['parse'], self.timings['decode'],
+                  self.timings['wait'], self.timings['unshare'], self.timings['create']))
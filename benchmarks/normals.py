@@ -0,0 +1,132 @@
+'''
+Benchmark and equivalence check of mesh.calculate_normals() against the original per-face loop.
+
+Run from the root of the repository:
+    python benchmarks/normals.py
+
+The original Mesh.calculate_normals() is copied as it was below (BaselineMesh), and its normals must be close to
+those of calculate_normals() on the meshes of the bundled models. They are not identical, as the sums over the faces
+of each vertex are not done in the same order.
+
+The tangents and binormals differ on purpose: the original computed the second texture edge as
+textureCoords[f2] - textureCoords[f2], which is always null, and calculate_normals() uses textureCoords[f2] -
+textureCoords[f0]. They are not compared, only the number of vertices whose tangents differ is printed. Also, the
+original set the tangents of vertices whose faces all have degenerate texture coordinates to NaN, and
+calculate_normals() leaves them null.
+'''
+import contextlib
+import io
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from blender import load_obj_data
+from mesh import calculate_normals
+
+models = ['models/scene5.obj', 'models/lightvertices.obj', 'models/water.obj', 'models/balloon.obj']
+
+# the number of runs of the vectorized version, the best time is kept (the loop is run once)
+runs = 5
+
+
+class BaselineMesh:
+    '''
+    The arrays of a mesh, with the original Mesh.calculate_normals() copied as it was.
+    '''
+    def __init__(self, vertices, faces, textureCoords=None):
+        self.vertices = vertices
+        self.faces = faces
+        self.textureCoords = textureCoords
+        self.tangents = self.binormals = None
+
+    def calculate_normals(self):
+        self.normals = np.zeros((self.vertices.shape[0], 3), dtype='f')
+        if self.textureCoords is not None:
+            self.tangents = np.zeros((self.vertices.shape[0], 3), dtype='f')
+            self.binormals = np.zeros((self.vertices.shape[0], 3), dtype='f')
+
+        for f in range(self.faces.shape[0]):
+            # first calculate the face normal using the cross product of the triangle's sides
+            a = self.vertices[self.faces[f, 1]] - self.vertices[self.faces[f, 0]]
+            b = self.vertices[self.faces[f, 2]] - self.vertices[self.faces[f, 0]]
+            face_normal = np.cross(a, b)
+
+            # tangent
+            if self.textureCoords is not None:
+                txa = self.textureCoords[self.faces[f, 1], :] - self.textureCoords[self.faces[f, 0], :]
+                txb = self.textureCoords[self.faces[f, 2], :] - self.textureCoords[self.faces[f, 2], :]
+                face_tangent = txb[0]*a - txa[0]*b
+                face_binormal = -txb[1]*a + txa[1]*b
+
+            # blend normal on all 3 vertices
+            for j in range(3):
+                self.normals[self.faces[f, j], :] += face_normal
+                if self.textureCoords is not None:
+                    self.tangents[self.faces[f, j], :] += face_tangent
+                    self.binormals[self.faces[f, j], :] += face_binormal
+
+        # finally we need to normalize the vectors
+        self.normals /= np.linalg.norm(self.normals, axis=1, keepdims=True)
+        if self.textureCoords is not None:
+            self.tangents /= np.linalg.norm(self.tangents, axis=1, keepdims=True)
+            self.binormals /= np.linalg.norm(self.binormals, axis=1, keepdims=True)
+
+
+def loop_normals(vertices, faces, textureCoords=None):
+    '''
+    Runs the original Mesh.calculate_normals(), returning (normals, tangents, binormals) as calculate_normals().
+    '''
+    mesh = BaselineMesh(vertices, faces, textureCoords)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mesh.calculate_normals()
+    return mesh.normals, mesh.tangents, mesh.binormals
+
+
+def vectorized_normals(vertices, faces, textureCoords=None):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return calculate_normals(vertices, faces, textureCoords)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+if __name__ == '__main__':
+    print('Normals of the meshes, original loop -> np.add.at, best of {} runs for np.add.at:'.format(runs))
+    total_loop = total = 0
+    for file_name in models:
+        with contextlib.redirect_stdout(io.StringIO()), np.errstate(divide='ignore', invalid='ignore'):
+            mtl_files, meshes = load_obj_data(file_name, use_cache=False, recompute_normals=True)
+
+        loop_time = vectorized_time = 0
+        vertices = different = 0
+        for mesh in meshes:
+            args = (mesh['vertices'], mesh['faces'].astype(np.int64), mesh['textureCoords'])
+            duration, expected = timed(loop_normals, *args)
+            loop_time += duration
+            durations, results = zip(*[timed(vectorized_normals, *args) for run in range(runs)])
+            vectorized_time += min(durations)
+
+            expected_normals, expected_tangents, expected_binormals = expected
+            normals, tangents, binormals = results[0]
+            if not np.allclose(normals, expected_normals, rtol=1e-4, atol=1e-5, equal_nan=True):
+                error = np.nanmax(np.abs(normals - expected_normals))
+                raise AssertionError('{}: the normals differ by up to {}'.format(file_name, error))
+            if (expected_tangents is None) != (tangents is None):
+                raise AssertionError('{}: tangents missing'.format(file_name))
+            if tangents is not None:
+                vertices += tangents.shape[0]
+                different += np.count_nonzero(~np.isclose(tangents, expected_tangents, rtol=1e-4, atol=1e-5).all(axis=1))
+
+        total_loop += loop_time
+        total += vectorized_time
+        print('  {:26s} {:.3f}s -> {:.4f}s ({:.0f}x), normals of {} meshes match, tangents of {}/{} vertices differ'.format(
+            file_name, loop_time, vectorized_time, loop_time / vectorized_time, len(meshes), different, vertices))
+    print('  {:26s} {:.3f}s -> {:.4f}s ({:.0f}x)'.format('total', total_loop, total, total_loop / total))
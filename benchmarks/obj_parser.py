@@ -0,0 +1,211 @@
+'''
+Benchmark and equivalence check of the OBJ parser (see blender.py) against the original line by line parser.
+
+Run from the root of the repository:
+    python benchmarks/obj_parser.py
+
+Two stages are timed on the two largest models, without the binary cache:
+- parsing: the original line by line parser, extended to read the vn lines (reference_parse()), against
+  blender.parse_obj_file(). Both give the same arrays of positions, texture coordinates, normals and triangles.
+- loading: the original loader reproduced up to the mesh arrays (original_load(), the Mesh constructor is left out),
+  against blender.load_obj_data(). The latter does more work: it also reads the normals and welds the face corners
+  into vertices (see blender.create_mesh_data()).
+
+For every face corner of the bundled models, the position, texture coordinates and normal of the meshes created by
+blender.load_obj_data() must equal those read by the original line parser, extended to read the vn lines, which the
+original loader ignored.
+'''
+import contextlib
+import io
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from blender import load_obj_data, load_material_library, parse_obj_file
+
+# the models compared corner by corner, and the models timed
+models = ['models/scene5.obj', 'models/lightvertices.obj', 'models/water.obj', 'models/balloon.obj']
+timed_models = ['models/scene5.obj', 'models/water.obj']
+
+# the number of runs of each parser, the best time is kept
+runs = 5
+
+
+def process_line(line, normals=False):
+    '''
+    The line parser of the original loader, returning a (label, values) pair or None.
+    :param normals: Whether to read the vn lines, which the original loader ignored
+    '''
+    fields = line.split()
+    if len(fields) == 0:
+        return None
+    if fields[0] == 'v':
+        return ('vertex', [float(token) for token in fields[1:]])
+    if fields[0] == 'vt':
+        return ('vertex texture', [float(token) for token in fields[1:]])
+    if fields[0] == 'vn' and normals:
+        return ('normal', [float(token) for token in fields[1:]])
+    if fields[0] == 'mtllib':
+        return ('material library', fields[1])
+    if fields[0] == 'usemtl':
+        return ('material', fields[1])
+    if fields[0] == 'f':
+        return ('face', [[np.uint32(i) for i in v.split('/')] for v in fields[1:]])
+    return None
+
+
+def original_load(file_name):
+    '''
+    The original load_obj_file(), with the Mesh objects replaced by dictionaries of their arrays as the Mesh
+    constructor is not part of the parsing.
+    '''
+    vlist, tlist, flist, mlist, mesh_list = [], [], [], [], []
+    mesh_id = 0
+    material = None
+    with open(file_name) as objfile:
+        for line in objfile:
+            data = process_line(line)
+            if data is None:
+                continue
+            elif data[0] == 'vertex':
+                vlist.append(data[1])
+            elif data[0] == 'vertex texture':
+                tlist.append(data[1])
+            elif data[0] == 'face':
+                # converts quads into pairs of triangles
+                faces = [data[1]] if len(data[1]) == 3 else [data[1][:3], [data[1][0], data[1][2], data[1][3]]]
+                for face in faces:
+                    flist.append(face)
+                    mesh_list.append(mesh_id)
+                    mlist.append(material)
+            elif data[0] == 'material library':
+                with contextlib.redirect_stdout(io.StringIO()):
+                    library = load_material_library(os.path.join(os.path.dirname(file_name), data[1]))
+            elif data[0] == 'material':
+                material = library.names[data[1]]
+                mesh_id += 1
+
+    varray = np.array(vlist, dtype='f')
+    tarray = np.array(tlist, dtype='f')
+    meshes = []
+    fstart = 0
+    mesh_id = 1
+    for f in range(len(flist) + 1):
+        if f == len(flist) or mesh_id != mesh_list[f]:
+            farray = np.array(flist[fstart:f], dtype=np.uint32)
+            vmax = np.max(farray[:, :, 0].flatten())
+            vmin = np.min(farray[:, :, 0].flatten()) - 1
+
+            # fix blender texture indexing
+            textures = np.zeros((varray.shape[0], 2), dtype='f')
+            for i in range(farray.shape[0]):
+                for j in range(farray.shape[1]):
+                    textures[farray[i, j, 0] - 1, :] = tarray[farray[i, j, 1] - 1, :]
+
+            meshes.append({'vertices': varray[vmin:vmax, :], 'faces': farray[:, :, 0] - vmin - 1,
+                           'material': library.materials[mlist[fstart]], 'textureCoords': textures[vmin:vmax, :]})
+            if f < len(flist):
+                mesh_id = mesh_list[f]
+                fstart = f
+    return meshes
+
+
+def reference_parse(file_name):
+    '''
+    Parses a file line by line as the original loader, reading the normals too and splitting polygons in fans of
+    triangles, so that it gives the same arrays as blender.parse_obj_file().
+    :return: The arrays of positions, texture coordinates and normals, and the triangles of each material
+    '''
+    vlist, tlist, nlist, groups = [], [], [], []
+    with open(file_name) as objfile:
+        for line in objfile:
+            data = process_line(line, normals=True)
+            if data is None:
+                continue
+            elif data[0] == 'vertex':
+                vlist.append(data[1])
+            elif data[0] == 'vertex texture':
+                tlist.append(data[1])
+            elif data[0] == 'normal':
+                nlist.append(data[1])
+            elif data[0] == 'material':
+                groups.append([])
+            elif data[0] == 'face':
+                if not groups:
+                    groups.append([])
+                corners = data[1]
+                for i in range(1, len(corners) - 1):
+                    groups[-1].append([corners[0], corners[i], corners[i + 1]])
+
+    groups = [np.array(group, dtype=np.uint32) for group in groups if group]
+    return np.array(vlist, 'f'), np.array(tlist, 'f'), np.array(nlist, 'f'), groups
+
+
+def bulk_parse(file_name):
+    '''
+    Parses a file with the single pass parser of blender.py.
+    '''
+    return parse_obj_file(file_name)
+
+
+def bulk_load(file_name):
+    '''
+    Loads the mesh data with the bulk parser of blender.py, without the binary cache.
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        return load_obj_data(file_name, use_cache=False)
+
+
+def best_time(function, file_name):
+    times = []
+    for run in range(runs):
+        start = time.perf_counter()
+        function(file_name)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def check_corners(file_name):
+    '''
+    Compares the position, texture coordinates and normal of every face corner with the reference parser.
+    :return: The number of corners compared
+    '''
+    varray, tarray, narray, groups = reference_parse(file_name)
+    mtl_files, meshes = bulk_load(file_name)
+
+    if len(meshes) != len(groups):
+        raise AssertionError('{}: {} meshes, {} expected'.format(file_name, len(meshes), len(groups)))
+
+    count = 0
+    for mesh, group in zip(meshes, groups):
+        faces = group.astype(np.int64)
+        if mesh['faces'].shape[0] != faces.shape[0]:
+            raise AssertionError('{}: {} triangles, {} expected'.format(file_name, mesh['faces'].shape[0], faces.shape[0]))
+        for name, array, column in (('vertices', varray, 0), ('textureCoords', tarray, 1), ('normals', narray, 2)):
+            if not np.array_equal(mesh[name][mesh['faces']], array[faces[:, :, column] - 1]):
+                raise AssertionError('{}: the {} of the face corners differ'.format(file_name, name))
+        count += faces.shape[0] * 3
+    return count
+
+
+if __name__ == '__main__':
+    print('Corner by corner comparison with the reference parser:')
+    for file_name in models:
+        print('  {:26s} {} corners identical'.format(file_name, check_corners(file_name)))
+
+    stages = [('Parsing the v, vt, vn and f lines to arrays, line by line -> single pass', reference_parse, bulk_parse),
+              ('Loading the mesh arrays, original loader -> load_obj_data()', original_load, bulk_load)]
+    for title, reference_function, function in stages:
+        print('{}, best of {} runs:'.format(title, runs))
+        total_reference = total = 0
+        for file_name in timed_models:
+            reference, parsed = best_time(reference_function, file_name), best_time(function, file_name)
+            total_reference += reference
+            total += parsed
+            print('  {:26s} {:.3f}s -> {:.3f}s ({:.1f}x)'.format(file_name, reference, parsed, reference / parsed))
+        print('  {:26s} {:.3f}s -> {:.3f}s ({:.1f}x)'.format('total', total_reference, total, total_reference / total))
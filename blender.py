@@ -1,7 +1,11 @@
+import hashlib
+import json
+import os
+
 import numpy as np
 
 from material import Material,MaterialLibrary
-from mesh import Mesh
+from mesh import Mesh, calculate_normals
 
 '''
 Functions for reading models from blender. 
@@ -9,73 +13,119 @@ Source:
 https://en.wikipedia.org/wiki/Wavefront_.obj_file
 '''
 
-def process_line(line):
+def read_records(data, keywords):
 	'''
-	Function for reading the Blender3D object file, line by line. Clearly
-	minimalistic and slow as it is, but it will do the job nicely for this course.
+	Sorts the lines of an object file by keyword, in a single pass over the file rather than line by line in Python:
+	the start of every line is found with numpy, each line is classified by its first bytes, and the consecutive
+	lines with the same keyword (eg, all the vertices of an object) are copied as a single slice.
+	:param data: The content of the object file, as bytes
+	:param keywords: The keywords to look for (eg, 'v', 'vt', 'f')
+	:return: A dictionary giving for each keyword a tuple (text, lines): the content of its lines as bytes, one
+	record per line with the keyword blanked out, and the index of these lines in the file, in file order
 	'''
-	label = None
-	fields = line.split()
-	if len(fields) == 0:
-		return None
-
-	if fields[0] == '#':
-		label = 'comment'
-		return (label, fields[1:])
-
-	elif fields[0] == 'v':
-		label = 'vertex'
-		if len(fields) != 4:
-			print('(E) Error, 3 entries expected for vertex')
-			return None
-
-	elif fields[0] == 'vt':
-		label = 'vertex texture'
-		if len(fields) != 3:
-			print('(E) Error, 2 entries expected for vertex texture')
-			return None
-
-	elif fields[0] == 'mtllib':
-		label = 'material library'
-		if len(fields) != 2:
-			print('(E) Error, material library file name missing')
-			return None
-		else:
-			return (label, fields[1])
-
-	elif fields[0] == 'usemtl':
-		label = 'material'
-		if len(fields) != 2:
-			print('(E) Error, material file name missing')
-			return None
-		else:
-			return (label, fields[1])
-
-	# check this
-	elif fields[0] == 's':
-		label = 's???'
-		return None
+	# the file is padded so that the first bytes of the last lines can be read without bounds checks
+	buffer = bytearray(data)
+	buffer.extend(b'\n' * (max(len(keyword) for keyword in keywords) + 1))
+	array = np.frombuffer(buffer, dtype=np.uint8)
+	view = memoryview(buffer)
+	newlines = np.flatnonzero(array[:len(data)] == ord('\n'))
+	starts = np.concatenate(([0], newlines + 1))
+	ends = np.concatenate((newlines, [len(data)]))
+	first = array[starts]
+
+	records = {}
+	for keyword in keywords:
+		code = keyword.encode()
+
+		# a keyword is followed by spaces or tabs, so that eg 'v' does not match the 'vt' lines
+		lines = np.flatnonzero(first == code[0])
+		for offset, byte in enumerate(code[1:], 1):
+			lines = lines[array[starts[lines] + offset] == byte]
+		separator = array[starts[lines] + len(code)]
+		lines = lines[(separator == ord(' ')) | (separator == ord('\t'))]
+
+		# blank the keywords out, then copy each run of consecutive lines at once
+		array[starts[lines, np.newaxis] + np.arange(len(code))] = ord(' ')
+		breaks = np.flatnonzero(np.diff(lines) != 1) + 1
+		runs = zip(lines[np.concatenate(([0], breaks))], lines[np.concatenate((breaks - 1, [-1]))]) if len(lines) else []
+		text = b'\n'.join([view[starts[run_start]:ends[run_end]] for run_start, run_end in runs])
+		records[keyword] = (text, lines)
+
+	return records
+
+
+def read_names(text):
+	'''
+	Returns the names given by records such as mtllib or usemtl, see read_records().
+	'''
+	return [name.strip() for name in text.decode().split('\n')] if text else []
 
-	elif fields[0] == 'f':
-		label = 'face'
-		if len(fields) != 4 and len(fields) != 5:
-			print('(E) Error, 3 or 4 entries expected for faces\n{}'.format(line))
-			return None
 
+def parse_float_records(text, count, n, dtype='f'):
+	'''
+	Converts records (eg, vertices or texture coordinates) to an array with n values per record.
+	:param text: The records, one per line, as returned by read_records()
+	:param count: The number of records
+	:param n: The number of values expected per record
+	:param dtype: The type of the returned array (float32 by default, as used by OpenGL)
+	:return: A float array of shape (count, n)
+	'''
+	values = np.fromstring(text, dtype=np.float64, sep=' ')
+	if values.size != n * count:
+		# some records have extra (optional) values, so we keep the first n of each line
+		print('(W) Warning, {} entries expected per line, keeping the first {} only'.format(n, n))
+		values = np.array([record.split()[:n] for record in text.split(b'\n')], dtype=np.float64)
 
-		# multiple formats for faces lines, eg
-		# f 586/1 1860/2 1781/3
-		# f vi/ti/ni
-		# where vi is the vertex index
-		# ti is the texture index
-		# ni is the normal index (optional)
-		return ( label, [ [np.uint32(i) for i in v.split('/')] for v in fields[1:] ] )
+	return values.reshape((count, n)).astype(dtype)
 
-	else:
-		#print('(E) Unknown line: {}'.format(fields))
-		return None
 
-	return (label, [float(token) for token in fields[1:]])
+def parse_face_records(text, count):
+	'''
+	Converts face records to an array of triangles. Polygons with more than 3 vertices are split
+	into a fan of triangles, so that quads (0,1,2,3) give the pair of triangles (0,1,2) and (0,2,3).
+	multiple formats for faces lines, eg
+	f 586/1 1860/2 1781/3
+	f vi/ti/ni
+	where vi is the vertex index
+	ti is the texture index
+	ni is the normal index (optional)
+	:param text: The records, one per line, as returned by read_records()
+	:param count: The number of records
+	:return: A tuple (triangles, faces): an uint32 array of shape (number of triangles, 3, number of indices per
+	vertex), and the index of the record each triangle comes from
+	'''
+	if count == 0:
+		return np.zeros((0, 3, 1), dtype=np.uint32), np.zeros(0, dtype=np.int64)
+
+	# the number of indices per vertex is read from the first vertex; missing texture indices (vi//ni) are set to 0
+	if b'//' in text:
+		text = text.replace(b'//', b'/0/')
+	k = len(text.split(None, 1)[0].split(b'/'))
+
+	# parse all indices in one go. Faces have at least 3 vertices, so if we find exactly 3 vertices per face
+	# they are all triangles and we are done.
+	indices = np.fromstring(text.replace(b'/', b' '), dtype=np.int64, sep=' ')
+	if indices.size == 3 * k * count:
+		return indices.reshape((-1, 3, k)).astype(np.uint32), np.arange(count)
+
+	# otherwise, count the vertices of each face: a vertex starts wherever a blank is followed by another character
+	array = np.frombuffer(text, dtype=np.uint8)
+	blank = (array == ord(' ')) | (array == ord('\t')) | (array == ord('\r')) | (array == ord('\n'))
+	vertices = np.flatnonzero(~blank & np.concatenate(([True], blank[:-1])))
+	nverts = np.bincount(np.searchsorted(np.flatnonzero(array == ord('\n')), vertices), minlength=count)
+	if nverts.sum() * k != indices.size:
+		raise ValueError('(E) Error, faces should all use the same format')
+	if np.any(nverts < 3):
+		print('(E) Error, at least 3 entries expected for faces, ignoring {} face(s)'.format(np.sum(nverts < 3)))
+
+	# split each face in a fan of triangles
+	ntriangles = np.maximum(nverts - 2, 0)
+	first = np.cumsum(nverts) - nverts
+	corner = np.arange(ntriangles.sum()) - np.repeat(np.cumsum(ntriangles) - ntriangles, ntriangles) + 1
+	first = np.repeat(first, ntriangles)
+	triangles = np.stack([first, first + corner, first + corner + 1], axis=1)
+
+	return indices.reshape((-1, k))[triangles].astype(np.uint32), np.repeat(np.arange(count), ntriangles)
 
 
 def load_material_library(file_name):
@@ -118,122 +168,251 @@ def load_material_library(file_name):
 	return library
 
 
-def load_obj_file(file_name):
+def load_obj_file(file_name, use_cache=True, recompute_normals=False):
 	'''
 	Function for loading a Blender3D object file. minimalistic, and partial,
-	but sufficient for this course. You do not really need to worry about it.
+	but sufficient for this course. The file is read in one go, its lines are sorted
+	by keyword and each group is parsed at once using numpy.
+	:param file_name: The path to the .obj file
+	:param use_cache: If True, the meshes are loaded from the binary cache next to the file when it is up to date,
+	and the cache is (re)built otherwise. See load_mesh_cache().
+	:param recompute_normals: If True, the normals stored in the file are ignored and calculated from the faces.
+	:return: A list of Mesh objects, one per material used in the file
+	'''
+	return create_meshes(*load_obj_data(file_name, use_cache, recompute_normals))
+
+
+def load_obj_data(file_name, use_cache=True, recompute_normals=False):
+	'''
+	Loads the mesh data of a Blender3D object file, see load_obj_file() for the parameters.
+	This function only uses numpy (no OpenGL), so it can run in a worker process (see assetLoader.py).
+	:return: A tuple (material library files, list of mesh data). The data of each mesh is a dictionary holding
+	the name of its material and its arrays (see CACHE_ARRAYS), to be turned into Mesh objects by create_meshes().
 	'''
 	print('Loading mesh(es) from Blender file: {}'.format(file_name))
 
-	vlist = []	# list of vertices
-	tlist = []	# list of texture vectors
-	flist = []	# list of polygonal faces
-	mlist = []	# list of material names
+	if use_cache:
+		data = load_mesh_cache(file_name, recompute_normals)
+		if data is not None:
+			return data
+
+	mtl_files, varray, tarray, narray, groups = parse_obj_file(file_name)
+
+	meshes = []
+	nfaces = 0
+	for name, farray in groups:
+		if name is None:
+			print('(W) Faces found before any material, using the default material')
+		else:
+			print('Creating new mesh {}, faces {}-{}, with material: {}'.format(len(meshes) + 1, nfaces, nfaces + farray.shape[0], name))
+		nfaces += farray.shape[0]
+
+		try:
+			meshes.append(create_mesh_data(varray, tarray, narray, farray, name, recompute_normals))
+		except Exception as e:
+			print('(W) could not load mesh!')
+			print(e)
+			raise
+
+	print('File read. Found {} vertices and {} faces.'.format(varray.shape[0], nfaces))
+
+	if use_cache:
+		save_mesh_cache(file_name, mtl_files, meshes, recompute_normals)
+
+	return mtl_files, meshes
+
+
+def parse_obj_file(file_name):
+	'''
+	Parses a Blender3D object file: its lines are sorted by keyword in a single pass (see read_records()), and the
+	records of each keyword are parsed at once.
+	:param file_name: The path to the .obj file
+	:return: A tuple (material library files, vertices, texture coordinates, normals, groups), where groups lists
+	the faces of each material change in file order as pairs (material name, triangles), see parse_face_records().
+	The material name is None for the faces before any material.
+	'''
+	with open(file_name, 'rb') as objfile:
+		records = read_records(objfile.read(), ['v', 'vt', 'vn', 'f', 'usemtl', 'mtllib'])
+
+	# all vertices in one array
+	varray = parse_float_records(records['v'][0], len(records['v'][1]), 3)
+
+	# and all texture vectors
+	tarray = parse_float_records(records['vt'][0], len(records['vt'][1]), 2)
+
+	# and all normals
+	narray = parse_float_records(records['vn'][0], len(records['vn'][1]), 3)
+
+	mtl_files = [os.path.join(os.path.dirname(file_name), name) for name in read_names(records['mtllib'][0])]
+
+	# material indicate a new mesh in the file, so we split the faces on each material change: the group of a face
+	# is given by the number of usemtl lines before it, 0 for the faces before any material
+	materials = [None] + read_names(records['usemtl'][0])
+	triangles, faces = parse_face_records(records['f'][0], len(records['f'][1]))
+	groups = np.searchsorted(records['usemtl'][1], records['f'][1][faces])
+	bounds = np.searchsorted(groups, np.arange(len(materials) + 1))
+
+	groups = [(name, triangles[bounds[group]:bounds[group + 1]]) for group, name in enumerate(materials)]
+	return mtl_files, varray, tarray, narray, [(name, farray) for name, farray in groups if farray.shape[0] > 0]
+
+
+def create_meshes(mtl_files, meshes):
+	'''
+	Creates the Mesh objects from the data returned by load_obj_data().
+	:param mtl_files: The material library files used by the meshes
+	:param meshes: The list of mesh data
+	:return: A list of Mesh objects
+	'''
+	library = MaterialLibrary()
+	for mtl_file in mtl_files:
+		library = load_material_library(mtl_file)
 
-	lnlist = []
-	mesh_id = 0
 	mesh_list = []
+	for data in meshes:
+		if data['material'] is None:
+			material = Material()
+		else:
+			material = library.materials[library.names[data['material']]]
+
+		mesh_list.append(Mesh(
+			vertices=data.get('vertices'),
+			faces=data.get('faces'),
+			normals=data.get('normals'),
+			textureCoords=data.get('textureCoords'),
+			tangents=data.get('tangents'),
+			binormals=data.get('binormals'),
+			material=material
+		))
+
+	print('--- Created {} mesh(es) from Blender file.'.format(len(mesh_list)))
+	return mesh_list
 
-	# current material object
-	material = None
 
-	with open(file_name) as objfile:
-		line_nb = 0 # count line number for easier error locating
+'''
+Binary cache for the meshes loaded from Blender files.
+The cache is stored next to the .obj file (eg, models/scene5.obj.cache). It starts with a one line JSON header
+holding the hash of the .obj and .mtl files it was built from and, for each mesh, its material name and the
+offset, type and shape of its arrays. The arrays follow as raw data, so that they can be memory-mapped directly.
+'''
+
+# version of the cache format, increase it whenever the content of the cache changes
+CACHE_VERSION = 4
+
+# the mesh arrays stored in the cache
+CACHE_ARRAYS = ['vertices', 'faces', 'normals', 'textureCoords', 'tangents', 'binormals']
+
+# arrays are aligned in the cache file so that they can be mapped with any type
+CACHE_ALIGNMENT = 64
+
 
-		# loop over all lines in the file
-		for line in objfile:
-			# process the line
-			data = process_line(line)
+def file_hash(file_name):
+	with open(file_name, 'rb') as f:
+		return hashlib.sha1(f.read()).hexdigest()
 
-			line_nb += 1 # increment line
 
-			# skip empty lines
+def cache_align(n):
+	return (n + CACHE_ALIGNMENT - 1) // CACHE_ALIGNMENT * CACHE_ALIGNMENT
+
+
+def save_mesh_cache(file_name, mtl_files, meshes, recompute_normals=False):
+	'''
+	Saves the meshes loaded from a Blender file to its binary cache.
+	:param file_name: The path to the .obj file the meshes were loaded from
+	:param mtl_files: The material library files used by the .obj file
+	:param meshes: The list of mesh data, as returned by load_obj_data()
+	:param recompute_normals: Whether the normals of the meshes were calculated from the faces
+	'''
+	cache_name = file_name + '.cache'
+
+	header = {
+		'version': CACHE_VERSION,
+		'recompute_normals': recompute_normals,
+		'obj': file_hash(file_name),
+		'mtl': [[os.path.relpath(mtl_file, os.path.dirname(file_name)), file_hash(mtl_file)] for mtl_file in mtl_files],
+		'meshes': []
+	}
+
+	arrays = []
+	offset = 0
+	for mesh in meshes:
+		entry = {'material': mesh['material'], 'arrays': {}}
+		for name in CACHE_ARRAYS:
+			data = mesh.get(name)
 			if data is None:
 				continue
+			data = np.ascontiguousarray(data)
+			entry['arrays'][name] = {'dtype': data.dtype.str, 'shape': data.shape, 'offset': offset}
+			arrays.append((offset, data))
+			offset = cache_align(offset + data.nbytes)
+		header['meshes'].append(entry)
 
-			elif data[0] == 'vertex':
-				vlist.append(data[1])
-
-			elif data[0] == 'normal':
-				vlist.append(data[1])
-
-			elif data[0] == 'vertex texture':
-				tlist.append(data[1])
-
-			elif data[0] == 'face':
-				if len(data[1]) == 3:
-					flist.append(data[1])
-					mesh_list.append(mesh_id)
-					mlist.append(material)
-					lnlist.append(line_nb)
-				else:
-					# converts quads into pairs of  triangles
-					face1 = [data[1][0], data[1][1], data[1][2]]
-					flist.append(face1)
-					mesh_list.append(mesh_id)
-					mlist.append(material)
-					lnlist.append(line_nb)
-
-					face2 = [data[1][0], data[1][2], data[1][3]]
-					flist.append(face2)
-					mesh_list.append(mesh_id)
-					mlist.append(material)
-					lnlist.append(line_nb)
-
-			elif data[0] == 'material library':
-				library = load_material_library('models/{}'.format(data[1]))
-
-			# material indicate a new mesh in the file, so we store the previous one if not empty and start
-			# a new one.
-			elif data[0] == 'material':
-				material = library.names[data[1]]
-				mesh_id += 1
-				print('[l.{}] Loading mesh with material: {}'.format(line_nb, data[1]))
-
-	print('File read. Found {} vertices and {} faces.'.format(len(vlist), len(flist)))
-
-	return create_meshes_from_blender(vlist, flist, mlist, tlist, library, mesh_list, lnlist)
-
-
-def create_meshes_from_blender(vlist, flist, mlist, tlist, library, mesh_list, lnlist):
-	fstart = 0
-	mesh_id = 1
-	meshes = []
+	header = (json.dumps(header) + '\n').encode()
+	start = cache_align(len(header))
 
-	# we start by putting all vertices in one array
-	varray = np.array(vlist, dtype='f')
+	try:
+		# write to a temporary file first, so that an interrupted run never leaves a broken cache behind
+		with open(cache_name + '.tmp', 'wb') as f:
+			f.write(header)
+			for offset, data in arrays:
+				f.seek(start + offset)
+				f.write(data.tobytes())
+		os.replace(cache_name + '.tmp', cache_name)
+		print('Saved mesh cache {}'.format(cache_name))
+	except OSError as e:
+		print('(W) Warning, could not save mesh cache {}: {}'.format(cache_name, e))
+
+
+def load_mesh_cache(file_name, recompute_normals=False):
+	'''
+	Loads the meshes of a Blender file from its binary cache. The arrays are memory-mapped from the cache
+	file and passed to the meshes without any copy.
+	:param file_name: The path to the .obj file
+	:param recompute_normals: Whether the normals should be calculated from the faces rather than read from the file
+	:return: The same as load_obj_data(), or None if there is no cache, if the .obj or .mtl files changed since it
+	was built, or if it was built with a different recompute_normals setting.
+	'''
+	cache_name = file_name + '.cache'
+	if not os.path.exists(cache_name):
+		return None
 
-	# and all texture vectors
-	tarray = np.array(tlist, dtype='f')
+	try:
+		with open(cache_name, 'rb') as f:
+			line = f.readline()
+		header = json.loads(line)
+	except (OSError, ValueError) as e:
+		print('(W) Warning, could not read mesh cache {}: {}'.format(cache_name, e))
+		return None
 
-	material = mlist[fstart]
+	if header.get('version') != CACHE_VERSION or header.get('recompute_normals') != recompute_normals \
+			or header.get('obj') != file_hash(file_name):
+		print('Mesh cache {} is out of date, rebuilding it'.format(cache_name))
+		return None
 
-	for f in range(len(flist)):
-		if mesh_id != mesh_list[f]:  # new mesh is denoted by change in material
-			print('Creating new mesh %i, faces %i-%i, line %i, with material %i: %s' % (mesh_id, fstart, f, lnlist[fstart], mlist[fstart], library.materials[mlist[fstart]].name))
-			try:
-				mesh = create_mesh(varray, tarray, flist, fstart, f, library, material)
-				meshes.append(mesh)
-			except Exception as e:
-				print('(W) could not load mesh!')
-				print(e)
-				raise
+	# material libraries are stored relative to the .obj file
+	mtl_files = [os.path.join(os.path.dirname(file_name), name) for name, mtl_hash in header['mtl']]
+	for mtl_file, (name, mtl_hash) in zip(mtl_files, header['mtl']):
+		if not os.path.exists(mtl_file) or file_hash(mtl_file) != mtl_hash:
+			print('Material library {} changed, rebuilding mesh cache {}'.format(mtl_file, cache_name))
+			return None
 
-			mesh_id = mesh_list[f]
+	print('Loading mesh(es) from cache: {}'.format(cache_name))
 
-			# start the next mesh
-			fstart = f
-			material = mlist[fstart]
+	# map the whole file once, all arrays are views into it
+	data = np.memmap(cache_name, dtype=np.uint8, mode='r')
+	start = cache_align(len(line))
 
-	# add the last mesh
-	try:
-		meshes.append(create_mesh(varray, tarray, flist, fstart, len(flist), library, material))
-	except:
-		print('(W) could not load mesh!')
-		raise
+	meshes = []
+	for entry in header['meshes']:
+		mesh = {'material': entry['material']}
+		for name, array in entry['arrays'].items():
+			dtype = np.dtype(array['dtype'])
+			shape = tuple(array['shape'])
+			offset = start + array['offset']
+			mesh[name] = data[offset:offset + dtype.itemsize * int(np.prod(shape))].view(dtype).reshape(shape)
+		meshes.append(mesh)
+
+	return mtl_files, meshes
 
-	print('--- Created {} mesh(es) from Blender file.'.format(len(meshes)))
-	return meshes
 
 def load_vertices_from_obj(file_path):
     """
@@ -249,16 +428,10 @@ def load_vertices_from_obj(file_path):
     vertices = []
     
     try:
-        with open(file_path, 'r') as file:
-            for line in file:
-                # Remove leading/trailing whitespace and split by whitespace
-                parts = line.strip().split()
-                
-                # Check if the line is a vertex line
-                if parts and parts[0] == 'v':
-                    # Convert the vertex components to floats and add to vertices list
-                    vertex = [float(parts[1]), float(parts[2]), float(parts[3])]
-                    vertices.append(vertex)
+        with open(file_path, 'rb') as file:
+            # Convert all vertex lines at once
+            text, lines = read_records(file.read(), ['v'])['v']
+            vertices = parse_float_records(text, len(lines), 3, dtype=float).tolist()
                     
     except FileNotFoundError:
         print(f"Error: The file '{file_path}' was not found.")
@@ -269,46 +442,62 @@ def load_vertices_from_obj(file_path):
     return vertices
 
 
-def create_mesh(varray, tarray, flist, fstart, f, library, material):
-	# select faces for this mesh
-	farray = np.array(flist[fstart:f], dtype=np.uint32)
-
-	# and vertices
-	vmax = np.max(farray[:, :, 0].flatten())
-	vmin = np.min(farray[:, :, 0].flatten()) - 1
-
-	# fix blender texture intexing
-	textures = fix_blender_textures(tarray, farray, varray)
-	if textures is not None:
-		textures = textures[vmin:vmax, :]
-
-	return Mesh(
-			vertices=varray[vmin:vmax, :],
-			faces=farray[:, :, 0] - vmin - 1,
-			material=library.materials[material],
-			textureCoords=textures
-		)
-
-
-def fix_blender_textures(textures, faces, vertices):
+def create_mesh_data(varray, tarray, narray, farray, material, recompute_normals=False):
 	'''
-	Corrects the indexing of textures in Blender file for OpenGL.
-	Blender allows for multiple indexing of vertices and textures, which is not supported by OpenGL.
-	This function ensures that indexing is consistent.
-	:param textures: Original Blender texture UV values
-	:param faces: Blender faces multiple-index
-	:return: a new texture array indexed according to vertices.
+	Creates the data of a mesh from the faces of a Blender file.
+	Blender allows for multiple indexing of vertices, textures and normals, which is not supported by OpenGL:
+	each face corner has its own position, texture and normal indices. We create one OpenGL vertex for each
+	distinct (position, texture, normal) triple used by the faces, so that vertices on UV seams and hard edges are
+	duplicated, and only the vertices used by this mesh are kept.
+	:param varray: All the vertex positions of the file
+	:param tarray: All the texture coordinates of the file
+	:param narray: All the normals of the file
+	:param farray: The faces of this mesh, as an array of (position, texture, normal) indices for each corner
+	:param material: The name of the material of this mesh
+	:param recompute_normals: If True, normals are calculated from the faces rather than read from the file
+	:return: The mesh data, as a dictionary holding the material name and the mesh arrays
 	'''
-	# (OpenGL, unlike Blender, does not allow for multiple indexing!)
-
-	if faces.shape[2] == 1:
+	# select which indices make a vertex. Texture and normal indices are 0 if missing (eg, vi//ni)
+	fields = [('v', 0)]
+	if farray.shape[2] > 1 and tarray.shape[0] > 0 and np.all(farray[:, :, 1] > 0):
+		fields.append(('vt', 1))
+	else:
 		print('(W) No texture indices provided, setting texture coordinate array as None!')
-		return None
 
-	new_textures = np.zeros((vertices.shape[0], 2), dtype='f')
-
-	for f in range(faces.shape[0]):
-		for j in range(faces.shape[1]):
-			new_textures[faces[f, j, 0] - 1, :] = textures[faces[f, j, 1] - 1, :]
+	if farray.shape[2] > 2 and narray.shape[0] > 0 and np.all(farray[:, :, 2] > 0) and not recompute_normals:
+		fields.append(('vn', 2))
+	elif not recompute_normals:
+		print('(W) No normal indices provided, normals will be calculated from the faces')
+
+	# pack the indices of each face corner in a single integer, so that np.unique finds the distinct triples in one
+	# go (sorting integers is much faster than sorting records)
+	corners = farray[:, :, [column for name, column in fields]].reshape((-1, len(fields))).astype(np.int64)
+	sizes = [{'v': varray, 'vt': tarray, 'vn': narray}[name].shape[0] + 1 for name, column in fields]
+	packed = np.ravel_multi_index(tuple(corners.T), sizes)
+	keys, first, inverse = np.unique(packed, return_index=True, return_inverse=True)
+
+	# keep the vertices in the order the faces first use them, rather than sorted, for better locality
+	order = np.argsort(first)
+	rank = np.empty_like(order)
+	rank[order] = np.arange(order.shape[0])
+	keys = dict(zip([name for name, column in fields], np.unravel_index(keys[order], sizes)))
+
+	# use 16 bits indices when possible, to halve the size of the index buffer
+	index_type = np.uint16 if order.shape[0] <= 65536 else np.uint32
+	faces = rank[inverse.flatten()].reshape((-1, 3)).astype(index_type)
+
+	print('- {} face corners welded into {} vertices'.format(corners.shape[0], order.shape[0]))
+
+	mesh = {
+		'material': material,
+		'vertices': varray[keys['v'] - 1, :],
+		'faces': faces,
+		'textureCoords': tarray[keys['vt'] - 1, :] if 'vt' in keys else None
+	}
+
+	if 'vn' in keys:
+		mesh['normals'] = narray[keys['vn'] - 1, :]
+	else:
+		mesh['normals'], mesh['tangents'], mesh['binormals'] = calculate_normals(mesh['vertices'], faces, mesh['textureCoords'])
 
-	return new_textures
+	return mesh
@@ -0,0 +1,283 @@
+import numpy as np
+
+from culling import frustum_planes, intersects
+
+'''
+Bounding volume hierarchies over the bounds of the models (see culling.py), so that culling and ray queries do not
+test every model: whole subtrees outside a frustum, or missed by a ray, are skipped with a single test. The trees
+are traversed one level at a time, testing all the nodes of a level at once.
+'''
+
+# below this number of items, testing all the items at once is faster than traversing the tree
+linear_scan_size = 256
+
+
+class BVH:
+    '''
+    Binary tree of axis aligned boxes over a set of items, each one given by its bounds. The tree is stored as
+    arrays, each node covering a contiguous range of the items sorted in tree order.
+    '''
+    def __init__(self, bounds, leaf_size=4):
+        '''
+        Builds the tree, splitting the items at the median of the longest axis of their centers.
+        :param bounds: An (N, 10) array of bounds, see culling.py
+        :param leaf_size: The largest number of items in a leaf
+        '''
+        self.bounds = np.array(bounds, dtype='f').reshape(-1, 10)
+        count = self.bounds.shape[0]
+        centers = self.bounds[:, 4:7]
+
+        # the items in tree order, and for each node the range of items it covers, its children (-1 for leaves)
+        # and its parent
+        self.order = np.arange(count)
+        start, end, left, right, parent = [0], [count], [-1], [-1], [-1]
+        stack = [0] if count > 0 else []
+        while stack:
+            node = stack.pop()
+            if end[node] - start[node] <= leaf_size:
+                continue
+            items = self.order[start[node]:end[node]]
+            axis = np.argmax(np.ptp(centers[items], axis=0))
+            half = len(items) // 2
+            self.order[start[node]:end[node]] = items[np.argpartition(centers[items, axis], half)]
+            for first, last in ((start[node], start[node] + half), (start[node] + half, end[node])):
+                child = len(start)
+                start.append(first)
+                end.append(last)
+                left.append(-1)
+                right.append(-1)
+                parent.append(node)
+                stack.append(child)
+            left[node], right[node] = len(start) - 2, len(start) - 1
+
+        self.start = np.array(start)
+        self.end = np.array(end)
+        self.left = np.array(left)
+        self.right = np.array(right)
+        self.parent = np.array(parent)
+
+        # the leaf holding each item
+        self.leaf = np.zeros(count, dtype=int)
+        for node in np.nonzero(self.left < 0)[0]:
+            self.leaf[self.order[self.start[node]:self.end[node]]] = node
+
+        # the nodes by depth, for refitting all of them from the leaves up
+        depth = np.zeros(len(start), dtype=int)
+        for node in range(1, len(start)):
+            depth[node] = depth[parent[node]] + 1
+        self.levels = [np.nonzero(depth == level)[0] for level in range(depth.max() + 1)] if count > 0 else []
+
+        self.low = np.zeros((len(start), 3), dtype='f')
+        self.high = np.zeros((len(start), 3), dtype='f')
+        self.refit()
+
+    def __len__(self):
+        return self.bounds.shape[0]
+
+    def refit(self, items=None, bounds=None):
+        '''
+        Updates the boxes of the nodes after items moved, without changing the structure of the tree.
+        :param items: The indices of the items that moved, or None to refit the whole tree
+        :param bounds: The new bounds of these items
+        '''
+        if items is not None:
+            self.bounds[items] = bounds
+        if len(self) == 0:
+            return
+
+        item_low = self.bounds[:, 4:7] - self.bounds[:, 7:10]
+        item_high = self.bounds[:, 4:7] + self.bounds[:, 7:10]
+
+        if items is None:
+            # the leaves cover consecutive ranges of the items, so their boxes are reduced over the ranges at once
+            leaves = np.nonzero(self.left < 0)[0]
+            leaves = leaves[np.argsort(self.start[leaves])]
+            starts = self.start[leaves]
+            self.low[leaves] = np.minimum.reduceat(item_low[self.order], starts)
+            self.high[leaves] = np.maximum.reduceat(item_high[self.order], starts)
+            for level in reversed(self.levels):
+                nodes = level[self.left[level] >= 0]
+                self.low[nodes] = np.minimum(self.low[self.left[nodes]], self.low[self.right[nodes]])
+                self.high[nodes] = np.maximum(self.high[self.left[nodes]], self.high[self.right[nodes]])
+            return
+
+        # only the leaves of the items which moved and their ancestors are updated, from the deepest level up
+        leaves = np.unique(self.leaf[items])
+        covered = [self.order[first:last] for first, last in zip(self.start[leaves], self.end[leaves])]
+        starts = np.cumsum([0] + [len(range_items) for range_items in covered[:-1]])
+        covered = np.concatenate(covered)
+        self.low[leaves] = np.minimum.reduceat(item_low[covered], starts)
+        self.high[leaves] = np.maximum.reduceat(item_high[covered], starts)
+
+        ancestors = np.zeros(len(self.parent), dtype=bool)
+        nodes = leaves
+        while nodes.size > 0:
+            nodes = np.unique(self.parent[nodes])
+            nodes = nodes[nodes >= 0]
+            nodes = nodes[~ancestors[nodes]]
+            ancestors[nodes] = True
+        for level in reversed(self.levels):
+            nodes = level[ancestors[level]]
+            self.low[nodes] = np.minimum(self.low[self.left[nodes]], self.low[self.right[nodes]])
+            self.high[nodes] = np.maximum(self.high[self.left[nodes]], self.high[self.right[nodes]])
+
+    def traverse(self, classify, test_items):
+        '''
+        Traverses the tree one level at a time.
+        :param classify: A function returning, for an array of nodes, two boolean arrays telling which nodes are
+        entirely missed, and which are entirely accepted (all their items are then accepted without testing them)
+        :param test_items: A function returning, for an array of items, a boolean array of the items accepted
+        :return: The array of accepted items
+        '''
+        if len(self) <= linear_scan_size:
+            items = self.order
+            return items[test_items(items)]
+
+        accepted = []
+        nodes = np.zeros(1 if len(self) > 0 else 0, dtype=int)
+        while nodes.size > 0:
+            missed, inside = classify(nodes)
+            accepted += [self.order[first:last] for first, last in zip(self.start[nodes[inside]], self.end[nodes[inside]])]
+
+            nodes = nodes[~missed & ~inside]
+            leaves = nodes[self.left[nodes] < 0]
+            if leaves.size > 0:
+                items = np.concatenate([self.order[first:last] for first, last in zip(self.start[leaves], self.end[leaves])])
+                accepted.append(items[test_items(items)])
+
+            nodes = nodes[self.left[nodes] >= 0]
+            nodes = np.concatenate([self.left[nodes], self.right[nodes]])
+
+        return np.concatenate(accepted) if accepted else np.zeros(0, dtype=int)
+
+    def frustum(self, planes):
+        '''
+        Returns the items whose bounds intersect a frustum, the same items as culling.intersects() over all items.
+        :param planes: The planes of one frustum (6, 4), or of several frustums (F, 6, 4) to keep the items in any of
+        them, see culling.frustum_planes()
+        :return: The array of items
+        '''
+        planes = planes.reshape(-1, 6, 4)
+        normals, offsets = planes[:, :, :3], planes[:, :, 3]
+
+        def classify(nodes):
+            center = (self.low[nodes] + self.high[nodes]) / 2
+            extent = (self.high[nodes] - self.low[nodes]) / 2
+            distance = np.einsum('nk,fpk->nfp', center, normals) + offsets
+            radius = np.einsum('nk,fpk->nfp', extent, np.abs(normals))
+            missed = np.all(np.any(distance < -radius, axis=2), axis=1)
+            inside = np.any(np.all(distance >= radius, axis=2), axis=1)
+            return missed, inside
+
+        return self.traverse(classify, lambda items: intersects(self.bounds[items], planes))
+
+    def ray(self, origin, direction, far=np.inf):
+        '''
+        Returns the items whose bounding box is hit by a ray, sorted by the distance where the ray enters the box.
+        :param origin: The origin of the ray
+        :param direction: The direction of the ray, the distances are in multiples of its length
+        :param far: The largest distance along the ray
+        :return: A tuple (array of items, array of distances)
+        '''
+        origin = np.asarray(origin, dtype='f')
+        with np.errstate(divide='ignore'):
+            inverse = 1. / np.asarray(direction, dtype='f')
+
+        def slabs(low, high):
+            with np.errstate(invalid='ignore'):
+                t0 = (low - origin) * inverse
+                t1 = (high - origin) * inverse
+            # an axis parallel to the ray gives NaN if the origin is on a face of the box, the axis is then ignored
+            enter = np.nanmax(np.minimum(t0, t1), axis=1, initial=-np.inf)
+            leave = np.nanmin(np.maximum(t0, t1), axis=1, initial=np.inf)
+            return enter, (enter <= leave) & (leave >= 0) & (enter <= far)
+
+        def classify(nodes):
+            enter, hit = slabs(self.low[nodes], self.high[nodes])
+            return ~hit, np.zeros(nodes.size, dtype=bool)
+
+        def box(items):
+            center, extent = self.bounds[items, 4:7], self.bounds[items, 7:10]
+            return slabs(center - extent, center + extent)
+
+        items = self.traverse(classify, lambda items: box(items)[1])
+        distances = np.maximum(box(items)[0], 0)
+        order = np.argsort(distances, kind='stable')
+        return items[order], distances[order]
+
+    def point(self, point):
+        '''
+        Returns the items whose bounding box contains a point.
+        '''
+        point = np.asarray(point, dtype='f')
+
+        def classify(nodes):
+            return np.any((point < self.low[nodes]) | (point > self.high[nodes]), axis=1), np.zeros(nodes.size, dtype=bool)
+
+        def contains(items):
+            return np.all(np.abs(point - self.bounds[items, 4:7]) <= self.bounds[items, 7:10], axis=1)
+
+        return self.traverse(classify, contains)
+
+
+class ModelTree:
+    '''
+    The models of a scene in two trees: one for the static models, built once, and one for the models that may move
+    (eg, the balloon), refitted when one of them moved. The bounds of the models are those of BaseModel.world_bounds(),
+    so models should be moved by assigning a new model matrix.
+    '''
+    def __init__(self, static=(), dynamic=()):
+        '''
+        :param static: The list of models that never move
+        :param dynamic: The list of models that may move
+        '''
+        self.static_models = list(static)
+        self.dynamic_models = list(dynamic)
+        self.static = BVH([model.world_bounds() for model in self.static_models])
+
+        # the bounds of the dynamic models when the tree was last refitted, compared by identity
+        self.dynamic_bounds = [model.world_bounds() for model in self.dynamic_models]
+        self.dynamic = BVH(self.dynamic_bounds)
+
+    def __len__(self):
+        return len(self.static_models) + len(self.dynamic_models)
+
+    def update(self):
+        '''
+        Refits the tree of dynamic models to the models which moved.
+        '''
+        bounds = [model.world_bounds() for model in self.dynamic_models]
+        moved = [index for index, (new, old) in enumerate(zip(bounds, self.dynamic_bounds)) if new is not old]
+        if moved:
+            self.dynamic.refit(moved, np.array([bounds[index] for index in moved]))
+            self.dynamic_bounds = bounds
+
+    def models(self, static_items, dynamic_items):
+        return [self.static_models[item] for item in np.sort(static_items)] + \
+               [self.dynamic_models[item] for item in np.sort(dynamic_items)]
+
+    def frustum(self, PV):
+        '''
+        Returns the models intersecting the frustum of a projection-view matrix, or of any of an array of them.
+        '''
+        self.update()
+        planes = frustum_planes(PV)
+        return self.models(self.static.frustum(planes), self.dynamic.frustum(planes))
+
+    def ray(self, origin, direction, far=np.inf):
+        '''
+        Returns the models whose bounding box is hit by a ray, and the distances where the ray enters them, sorted by
+        distance.
+        :return: A list of (distance, model) pairs
+        '''
+        self.update()
+        hits = [(distance, self.static_models[item]) for item, distance in zip(*self.static.ray(origin, direction, far))]
+        hits += [(distance, self.dynamic_models[item]) for item, distance in zip(*self.dynamic.ray(origin, direction, far))]
+        return sorted(hits, key=lambda hit: hit[0])
+
+    def point(self, point):
+        '''
+        Returns the models whose bounding box contains a point.
+        '''
+        self.update()
+        return self.models(self.static.point(point), self.dynamic.point(point))
@@ -0,0 +1,129 @@
+import numpy as np
+
+'''
+View frustum culling: the models whose bounding volumes are outside the frustum of a pass (the camera, a face of the
+environment map, or the light) are not drawn in that pass. The bounds of all the models are tested at once against
+the planes of the frustum.
+The bounds of a model are stored in a single array of 10 values: the center and radius of the bounding sphere, then
+the center and half extents of the axis aligned bounding box.
+'''
+
+# the number of models tested and culled in each pass since the last call to reset_cull_stats()
+cull_stats = {}
+
+
+def local_bounds(vertices):
+    '''
+    Computes the bounds of a mesh, in the coordinates of the model.
+    :param vertices: The (N, 3) array of vertex positions
+    :return: An array of 10 values, see above
+    '''
+    low = vertices.min(axis=0)
+    high = vertices.max(axis=0)
+    center = (low + high) / 2
+    radius = np.sqrt(np.max(np.sum((vertices - center) ** 2, axis=1)))
+    return np.hstack([center, radius, center, (high - low) / 2]).astype('f')
+
+
+# the bounds of models without vertices, which are never culled
+unbounded = np.array([0, 0, 0, np.inf, 0, 0, 0, np.inf, np.inf, np.inf], dtype='f')
+
+
+def transform_bounds(bounds, M):
+    '''
+    Transforms bounds by a model matrix: the sphere is scaled by the largest scale of the matrix, and the box is the
+    box containing the transformed box.
+    :param bounds: An array of 10 values, see above
+    :param M: The 4x4 model matrix
+    :return: The transformed bounds
+    '''
+    M3 = M[:3, :3]
+    scale = np.sqrt(np.max(np.sum(M3 ** 2, axis=0)))
+    return np.hstack([np.matmul(M3, bounds[0:3]) + M[:3, 3], bounds[3] * scale,
+                      np.matmul(M3, bounds[4:7]) + M[:3, 3], np.matmul(np.abs(M3), bounds[7:10])]).astype('f')
+
+
+def instance_bounds(bounds, matrices):
+    '''
+    Returns the bounds containing copies of bounds transformed by several matrices, eg the instances of an
+    InstancedModel, in the coordinates of the model.
+    :param bounds: An array of 10 values, see above
+    :param matrices: An (N, 4, 4) array of matrices
+    :return: The bounds of all copies, a point at the origin if there is no copy
+    '''
+    if len(matrices) == 0:
+        return np.zeros(10, dtype='f')
+    M3, translations = matrices[:, :3, :3], matrices[:, :3, 3]
+    spheres = np.matmul(M3, bounds[0:3]) + translations
+    radii = bounds[3] * np.sqrt(np.max(np.sum(M3 ** 2, axis=1), axis=1))
+    low = np.min(np.matmul(M3, bounds[4:7]) + translations - np.matmul(np.abs(M3), bounds[7:10]), axis=0)
+    high = np.max(np.matmul(M3, bounds[4:7]) + translations + np.matmul(np.abs(M3), bounds[7:10]), axis=0)
+    center = (low + high) / 2
+    radius = np.max(np.linalg.norm(spheres - center, axis=1) + radii)
+    return np.hstack([center, radius, center, (high - low) / 2]).astype('f')
+
+
+def frustum_planes(PV):
+    '''
+    Extracts the planes of the frustum of a projection-view matrix, with the normals pointing inside.
+    :param PV: A 4x4 matrix, or an array of matrices
+    :return: An array (..., 6, 4) holding the normal and offset of the left, right, bottom, top, near and far planes
+    '''
+    PV = np.asarray(PV)
+    rows = PV[..., :3, :]
+    w = PV[..., 3:, :]
+    planes = np.concatenate([w + rows, w - rows], axis=-2)[..., [0, 3, 1, 4, 2, 5], :]
+    return planes / np.linalg.norm(planes[..., :3], axis=-1, keepdims=True)
+
+
+def intersects(bounds, planes):
+    '''
+    Tests bounds against frustums, the spheres first and then the boxes.
+    :param bounds: An (N, 10) array of bounds
+    :param planes: The planes of one frustum (6, 4), or of several frustums (F, 6, 4)
+    :return: A boolean array, True for the bounds intersecting the frustum (any of them for several frustums)
+    '''
+    planes = planes.reshape(-1, 6, 4)
+    normals, offsets = planes[:, :, :3], planes[:, :, 3]
+
+    # the signed distances (N, F, 6) of the centers to the planes
+    sphere = np.einsum('nk,fpk->nfp', bounds[:, 0:3], normals) + offsets
+    box = np.einsum('nk,fpk->nfp', bounds[:, 4:7], normals) + offsets
+    box_radius = np.einsum('nk,fpk->nfp', bounds[:, 7:10], np.abs(normals))
+
+    inside = np.all(sphere >= -bounds[:, None, None, 3], axis=2)
+    inside &= np.all(box >= -box_radius, axis=2) | np.isinf(bounds[:, None, 3])
+    return np.any(inside, axis=1)
+
+
+def cull(models, PV, name):
+    '''
+    Returns the models intersecting the frustum of a pass.
+    :param models: A list of models, with a world_bounds() method (see BaseModel), or a bvh.ModelTree
+    :param PV: The projection-view matrix of the pass, or an array of them to keep the models in any of the frustums
+    :param name: The name of the pass, for the statistics
+    :return: The list of models to draw
+    '''
+    if len(models) == 0:
+        return []
+
+    if hasattr(models, 'frustum'):
+        visible = models.frustum(PV)
+    else:
+        bounds = np.array([model.world_bounds() for model in models])
+        visible = [model for model, keep in zip(models, intersects(bounds, frustum_planes(PV))) if keep]
+
+    stats = cull_stats.setdefault(name, [0, 0])
+    stats[0] += len(models)
+    stats[1] += len(models) - len(visible)
+    return visible
+
+
+def reset_cull_stats():
+    '''
+    Returns the number of models tested and culled in each pass, and resets them.
+    :return: A dictionary giving (tested, culled) for each pass
+    '''
+    stats = dict(cull_stats)
+    cull_stats.clear()
+    return stats
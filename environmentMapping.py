@@ -7,7 +7,9 @@ from cubeMap import CubeMap
 
 from shaders import *
 
-from framebuffer import Framebuffer
+from framebuffer import Framebuffer, Renderbuffer
+
+from renderQueue import gl_state
 
 
 class EnvironmentShader(BaseShaderProgram):
@@ -16,40 +18,59 @@ class EnvironmentShader(BaseShaderProgram):
         self.add_uniform('sampler_cube')
         self.add_uniform('VM')
         self.add_uniform('VMiT')
-        self.add_uniform('VT')
 
         self.map = map
 
     def bind(self, model, M):
-        glUseProgram(self.program)
+        gl_state.use_program(self.program)
         if self.map is not None:
             #self.map.update(model.scene)
             unit = len(model.mesh.textures)
-            glActiveTexture(GL_TEXTURE0)
-            self.map.bind()
+            self.map.bind(0)
             self.uniforms['sampler_cube'].bind(0)
 
-        P = model.scene.P  # get projection matrix from the scene
-        V = model.scene.camera.V  # get view matrix from the camera
+        context = model.scene.frame_context()
+        PVM, VM, VMiT = model.view_transforms(context, M)
 
         # set the PVM matrix uniform
-        self.uniforms['PVM'].bind(np.matmul(P, np.matmul(V, M)))
+        self.uniforms['PVM'].bind(PVM)
 
         # set the PVM matrix uniform
-        self.uniforms['VM'].bind(np.matmul(V, M))
+        self.uniforms['VM'].bind(VM)
 
         # set the PVM matrix uniform
-        self.uniforms['VMiT'].bind(np.linalg.inv(np.matmul(V, M))[:3, :3].transpose())
+        self.uniforms['VMiT'].bind(VMiT)
 
-        self.uniforms['VT'].bind(V.transpose()[:3, :3])
+        # the view matrix is read from the Frame block, bound by the context
 
 
 class EnvironmentMappingTexture(CubeMap):
-    def __init__(self, width=200, height=200):
+    '''
+    Cube map rendered from the scene, used for reflections. Rendering the six faces means drawing the whole scene
+    six times, so the update policy selects when the faces are rendered:
+    - 'always': all faces, every frame
+    - 'static': all faces, on the first frame only (reflections will not show moving objects)
+    - 'dirty': all faces, when a model moved or the light changed since the faces were last rendered
+    - 'round_robin': one face per frame, so that each face is updated every six frames
+    When all faces are rendered and the driver supports it, they are rendered in a single pass over the models using
+    layered rendering, rather than once per face.
+    '''
+    def __init__(self, width=200, height=200, policy='always', layered=True):
         CubeMap.__init__(self)
 
+        if policy not in ['always', 'static', 'dirty', 'round_robin']:
+            raise ValueError('Unknown environment map update policy: {}'.format(policy))
+        self.policy = policy
+
+        # True when the faces are up to date, for the static and dirty policies
         self.done = False
 
+        # the model matrices and light position when the faces were rendered, for the dirty policy
+        self.state = None
+
+        # the next face to render, for the round robin policy
+        self.next_face = 0
+
         self.width = width
         self.height = height
 
@@ -72,14 +93,69 @@ class EnvironmentMappingTexture(CubeMap):
             GL_TEXTURE_CUBE_MAP_POSITIVE_Z: translationMatrix([0, 0, t]),
         }
 
+        # the faces are rendered one after the other, so they can share a single depth buffer
+        self.depth_buffer = Renderbuffer(width, height)
+
         self.bind()
         for (face, fbo) in self.fbos.items():
             glTexImage2D(face, 0, self.format, width, height, 0, self.format, self.type, None)
             fbo.prepare(self, face)
+            fbo.attach_renderbuffer(self.depth_buffer)
         self.unbind()
 
-    def update(self, scene):
+        # a single framebuffer with all the faces as layers, for rendering them in one pass (see draw_layers()).
+        # As all its outputs must be layered, its depth buffer is a cube map too.
+        self.layered_fbo = None
+        self.depth_map = None
+        if layered and layered_rendering_supported():
+            self.depth_map = CubeMap(sample=GL_NEAREST, format=GL_DEPTH_COMPONENT, type=GL_FLOAT)
+            self.depth_map.bind()
+            for face in self.fbos:
+                glTexImage2D(face, 0, GL_DEPTH_COMPONENT24, width, height, 0, GL_DEPTH_COMPONENT, GL_FLOAT, None)
+            self.depth_map.unbind()
+
+            self.layered_fbo = Framebuffer()
+            if not (self.layered_fbo.prepare_layers(self) and self.layered_fbo.prepare_layers(self.depth_map, attachment=GL_DEPTH_ATTACHMENT)):
+                print('(W) Layered framebuffer not supported, rendering the environment map one face at a time')
+                self.layered_fbo = None
+
+    def invalidate(self):
+        '''
+        Forces the faces to be rendered again on the next update, eg when the scene changed in a way that the dirty
+        policy cannot detect (for the static policy too).
+        '''
+        self.done = False
+        self.state = None
+
+    def faces_to_update(self, scene):
+        '''
+        Returns the faces that should be rendered during this frame, according to the update policy.
+        '''
+        faces = list(self.fbos.keys())
+
+        if self.policy == 'dirty':
+            state = np.concatenate([model.M.flatten() for model in scene.models] + [np.array(scene.light.position, 'f')])
+            if self.state is None or not np.array_equal(state, self.state):
+                self.state = state
+                self.done = False
+
+        elif self.policy == 'round_robin' and self.done:
+            # all faces are rendered on the first frame, then one at a time
+            face = faces[self.next_face]
+            self.next_face = (self.next_face + 1) % len(faces)
+            return [face]
+
         if self.done:
+            return []
+
+        if self.policy != 'always':
+            self.done = True
+
+        return faces
+
+    def update(self, scene):
+        faces = self.faces_to_update(scene)
+        if len(faces) == 0:
             return
 
         self.bind()
@@ -90,8 +166,13 @@ class EnvironmentMappingTexture(CubeMap):
 
         glViewport(0, 0, self.width, self.height)
 
-        for (face, fbo) in self.fbos.items():
+        if len(faces) == len(self.fbos) and self.layered_fbo is not None:
+            faces = self.draw_layers(scene)
+
+        for face in faces:
+            fbo = self.fbos[face]
             fbo.bind()
+            glClear(GL_DEPTH_BUFFER_BIT)
             #scene.camera.V = np.identity(4)
             scene.camera.V = self.views[face]
 
@@ -105,4 +186,34 @@ class EnvironmentMappingTexture(CubeMap):
 
         scene.P = Pscene
 
-        self.unbind()
\ No newline at end of file
+        self.unbind()
+
+    def draw_layers(self, scene):
+        '''
+        Renders all faces in a single pass over the models: each model is drawn once with six instances, one per face.
+        The models are drawn with P and V set to the identity, so that their shaders calculate all view dependent
+        values in world coordinates, which are the same as the coordinates of each face up to a rotation.
+        :return: The faces that are left to render one at a time, all of them if layered rendering failed
+        '''
+        P = scene.P
+        scene.layer_PV = np.array([np.matmul(P, self.views[GL_TEXTURE_CUBE_MAP_POSITIVE_X + layer]) for layer in range(6)])
+        scene.P = np.identity(4)
+        scene.camera.V = np.identity(4)
+
+        fbo = self.layered_fbo
+        fbo.bind()
+
+        # clears the depth of all faces
+        glClear(GL_DEPTH_BUFFER_BIT)
+        try:
+            scene.draw_reflections()
+            return []
+        except RuntimeError as error:
+            print('(W) Layered rendering failed, rendering the environment map one face at a time: {}'.format(error))
+            self.layered_fbo = None
+            return list(self.fbos.keys())
+        finally:
+            fbo.unbind()
+            scene.layer_PV = None
+            scene.P = P
+            scene.camera.update()
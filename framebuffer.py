@@ -1,6 +1,26 @@
 from OpenGL.GL import *
 
 
+class Renderbuffer:
+    '''
+    Buffer that can be attached to framebuffers when its content does not need to be sampled as a texture, typically
+    for depth testing. A renderbuffer can be shared by several framebuffers that are not rendered at the same time,
+    eg the faces of a cube map.
+    '''
+
+    def __init__(self, width, height, format=GL_DEPTH_COMPONENT24):
+        '''
+        Initialise the renderbuffer
+        :param width: The width of the buffer, which should match the other attachments of the framebuffer
+        :param height: The height of the buffer
+        :param format: The internal format of the buffer, by default a 24 bits depth buffer
+        '''
+        self.rbo = glGenRenderbuffers(1)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.rbo)
+        glRenderbufferStorage(GL_RENDERBUFFER, format, width, height)
+        glBindRenderbuffer(GL_RENDERBUFFER, 0)
+
+
 class Framebuffer:
     '''
     Basic class to handle rendering to texture using a framebuffer object.
@@ -24,21 +44,57 @@ class Framebuffer:
     def unbind(self):
         glBindFramebuffer(GL_FRAMEBUFFER, 0)
 
-    def prepare(self, texture, target=None, level=0):
+    def prepare(self, texture, target=None, level=0, layer=None):
         '''
         Prepare the Framebuffer by linking its output to a texture
         :param texture: The texture object to render to
         :param target: The target of the rendering, if not the default for the texture (use for cube maps)
         :param level: The mipmap level (ignore)
+        :param layer: For texture arrays, the layer to render to
         :return:
         '''
         if target is None:
             target = texture.target
 
         self.bind()
-        glFramebufferTexture2D(GL_FRAMEBUFFER, self.attachment, target, texture.textureid, level)
+        if layer is not None:
+            glFramebufferTextureLayer(GL_FRAMEBUFFER, self.attachment, texture.textureid, level, layer)
+        else:
+            glFramebufferTexture2D(GL_FRAMEBUFFER, self.attachment, target, texture.textureid, level)
         if self.attachment == GL_DEPTH_ATTACHMENT:
             glDrawBuffer(GL_NONE)
             glReadBuffer(GL_NONE)
 
-        self.unbind()
\ No newline at end of file
+        self.unbind()
+
+    def attach_renderbuffer(self, renderbuffer, attachment=GL_DEPTH_ATTACHMENT):
+        '''
+        Adds a renderbuffer to the outputs of the framebuffer, eg a depth buffer for a colour framebuffer
+        :param renderbuffer: The Renderbuffer object
+        :param attachment: Which output of the rendering process to store in the renderbuffer
+        '''
+        self.bind()
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, attachment, GL_RENDERBUFFER, renderbuffer.rbo)
+        if self.attachment == GL_DEPTH_ATTACHMENT:
+            glDrawBuffer(GL_NONE)
+            glReadBuffer(GL_NONE)
+        self.unbind()
+
+    def prepare_layers(self, texture, level=0, attachment=None):
+        '''
+        Prepare the Framebuffer for layered rendering, by linking its output to all the layers of a texture (eg, the
+        six faces of a cube map). All outputs of a layered framebuffer must be layered, so this can also be used to
+        add a depth texture with the same layers.
+        :param texture: The texture object to render to
+        :param level: The mipmap level (ignore)
+        :param attachment: The output linked to the texture, if not the main attachment of the framebuffer
+        :return: True if the framebuffer can be used
+        '''
+        if attachment is None:
+            attachment = self.attachment
+
+        self.bind()
+        glFramebufferTexture(GL_FRAMEBUFFER, attachment, texture.textureid, level)
+        complete = glCheckFramebufferStatus(GL_FRAMEBUFFER) == GL_FRAMEBUFFER_COMPLETE
+        self.unbind()
+        return complete
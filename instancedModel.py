@@ -0,0 +1,163 @@
+import ctypes
+
+# imports all openGL functions
+from OpenGL.GL import *
+
+import numpy as np
+
+from BaseModel import BaseModel, no_parent
+from renderQueue import gl_state
+from shaders import instance_attributes
+from culling import instance_bounds
+from picking import triangle_cache
+
+
+class InstancedModel(BaseModel):
+    '''
+    Draws many copies of the same mesh (eg, spectators, lanterns or flags) with a single instanced draw call. The
+    model matrix and colour of each instance are stored in an instance buffer, whose attributes advance once per
+    instance (see glVertexAttribDivisor). The shader must read them, see shaders.InstancedPhongShader and
+    ShadowMapping.InstancedShadowMappingShader.
+    '''
+
+    def __init__(self, scene, M, mesh, transforms, colors=None, name=None, shader=None, visible=True, layout=None):
+        '''
+        :param M: The model matrix of the whole model, applied after the matrix of each instance
+        :param transforms: The model matrix of each instance, as an (N, 4, 4) array
+        :param colors: The colour of each instance, as an (N, 3) or (N, 4) array of values in [0, 1], multiplying the
+        texture or material colour. White if not given.
+        '''
+        BaseModel.__init__(self, scene=scene, M=M, mesh=mesh, visible=visible, layout=layout)
+
+        if name is not None:
+            self.name = name
+
+        if self.mesh.faces is not None and self.mesh.faces.shape[1] == 4:
+            self.primitive = GL_QUADS
+
+        self.bind()
+
+        # the instance buffer, and the number of instances it holds
+        self.instance_buffer = glGenBuffers(1)
+        self.count = 0
+        self.transforms = np.zeros((0, 4, 4), 'f')
+        self.colors = np.zeros((0, 4), 'f')
+
+        # the number of instances drawn for each instance of the buffer, set as the divisor of the instance
+        # attributes: more than one when rendering to several layers at once (see shaders.layered_vertex_shader())
+        self.divisor = 1
+
+        # the instance attributes are at fixed locations, after the vertex attributes
+        gl_state.bind_vertex_array(self.vao)
+        glBindBuffer(GL_ARRAY_BUFFER, self.instance_buffer)
+        stride = 16 * 4 + 4
+        for column in range(4):
+            location = instance_attributes['instance_M'] + column
+            glEnableVertexAttribArray(location)
+            glVertexAttribPointer(location, 4, GL_FLOAT, False, stride, ctypes.c_void_p(16 * column))
+            glVertexAttribDivisor(location, self.divisor)
+        location = instance_attributes['instance_color']
+        glEnableVertexAttribArray(location)
+        glVertexAttribPointer(location, 4, GL_UNSIGNED_BYTE, True, stride, ctypes.c_void_p(16 * 4))
+        glVertexAttribDivisor(location, self.divisor)
+        gl_state.bind_vertex_array(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        self.attributes.update(instance_attributes)
+
+        self.set_instances(transforms, colors)
+
+        if shader is not None:
+            self.bind_shader(shader)
+
+    def set_instances(self, transforms, colors=None):
+        '''
+        Replaces the instances, eg to move some of them. The bounds of the model are updated to contain all of them.
+        :param transforms: The model matrix of each instance, as an (N, 4, 4) array
+        :param colors: The colour of each instance, as an (N, 3) or (N, 4) array, or None for white
+        '''
+        transforms = np.asarray(transforms, dtype='f').reshape(-1, 4, 4)
+        if colors is None:
+            colors = np.ones((transforms.shape[0], 4), 'f')
+        colors = np.asarray(colors, dtype='f')
+        if colors.shape[1] == 3:
+            colors = np.hstack([colors, np.ones((colors.shape[0], 1), 'f')])
+        if colors.shape[0] != transforms.shape[0]:
+            raise ValueError('Expected {} instance colors, found {}'.format(transforms.shape[0], colors.shape[0]))
+
+        # each row holds the matrix by column, as read by OpenGL, then the colour on 8 bits per component
+        instances = np.zeros((transforms.shape[0], 16 * 4 + 4), dtype=np.uint8)
+        instances[:, :64] = np.ascontiguousarray(transforms.transpose(0, 2, 1)).view(np.uint8).reshape(-1, 64)
+        instances[:, 64:] = np.round(np.clip(colors, 0., 1.) * 255).astype(np.uint8)
+
+        glBindBuffer(GL_ARRAY_BUFFER, self.instance_buffer)
+        if transforms.shape[0] == self.count:
+            glBufferSubData(GL_ARRAY_BUFFER, 0, instances.nbytes, instances)
+        else:
+            glBufferData(GL_ARRAY_BUFFER, instances, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        self.transforms = transforms
+        self.colors = colors
+        self.count = transforms.shape[0]
+
+        # the bounds are computed again by world_bounds(), and the triangles by picking
+        if self.mesh.vertices is not None:
+            self.bounds = instance_bounds(self.mesh_bounds, transforms)
+        self.world_bounds_cache = (None, None)
+        triangle_cache.pop(self, None)
+
+    def bind(self):
+        '''
+        Stores the vertex data as BaseModel.bind(), keeping the bounds of the mesh for computing the bounds of the
+        instances.
+        '''
+        BaseModel.bind(self)
+        self.mesh_bounds = self.bounds
+
+    def draw_depth(self, shader, Mp=no_parent):
+        '''
+        Draws the instances using the instanced variant of the depth shader, see ShadowMapping.DepthShader.
+        '''
+        if self.visible:
+            gl_state.bind_vertex_array(self.vao)
+            shader.bind(model=self, M=self.world_matrix(Mp), instanced=True)
+            self.draw_primitives()
+
+    def draw_primitives(self, instances=1):
+        '''
+        Draws all the instances with a single draw call.
+        :param instances: The number of times to draw each instance, eg once per layer for layered rendering
+        '''
+        if self.count == 0:
+            return
+
+        # each instance of the buffer is drawn for the given number of consecutive instances
+        if self.divisor != instances:
+            for location in range(instance_attributes['instance_M'], instance_attributes['instance_color'] + 1):
+                glVertexAttribDivisor(location, instances)
+            self.divisor = instances
+
+        if self.mesh.faces is not None:
+            glDrawElementsInstanced(self.primitive, self.mesh.faces.size, self.index_type(), None,
+                                    self.count * instances)
+        else:
+            glDrawArraysInstanced(self.primitive, 0, self.mesh.vertices.shape[0], self.count * instances)
+
+    def triangle_vertices(self):
+        '''
+        Returns the triangles of all the instances, for picking.
+        '''
+        vertices = BaseModel.triangle_vertices(self)
+        positions = np.matmul(vertices.reshape(-1, 3), self.transforms[:, :3, :3].transpose(0, 2, 1))
+        positions += self.transforms[:, None, :3, 3]
+        return positions.reshape(-1, 3, 3)
+
+    def part_name(self, triangle):
+        '''
+        Returns the index of the instance holding a triangle.
+        '''
+        return 'instance {}'.format(triangle // self.triangles().shape[0])
+
+    def vbo__del__(self):
+        glDeleteBuffers(1, [self.instance_buffer])
+        BaseModel.vbo__del__(self)
@@ -6,10 +6,20 @@ from scene import Scene
 
 from lightSource import LightSource
 
-from blender import load_obj_file, load_vertices_from_obj
+from blender import load_vertices_from_obj
+
+from assetLoader import AssetLoader
+
+from texture import texture_manager
+
+from vertexLayout import VertexLayout, default_layout, vertex_memory
 
 from BaseModel import DrawModelFromMesh
 
+from staticBatch import StaticBatch
+
+from bvh import ModelTree
+
 from shaders import *
 
 from ShadowMapping import *
@@ -22,9 +32,15 @@ from environmentMapping import *
 
 class ExeterScene(Scene):
     def __init__(self):
+        # start loading the models and their textures in worker processes, while the window is created. The water
+        # was exported flat shaded, so its normals are calculated from the faces to keep it smooth.
+        loader = AssetLoader()
+        loader.load_obj_files(['models/scene5.obj', 'models/lightvertices.obj', ('models/water.obj', {'recompute_normals': True}), 'models/balloon.obj'])
+
         Scene.__init__(self)
 
-        self.environment = EnvironmentMappingTexture(width=400, height=400)
+        # the reflections in the water only need updating when the balloon or the light moves
+        self.environment = EnvironmentMappingTexture(width=400, height=400, policy='dirty')
 
         self.light = LightSource(self, position=[0., 7.1, 0.])
         self.shaders = 'phong'
@@ -39,30 +55,41 @@ class ExeterScene(Scene):
         self.show_shadow_map = ShowTexture(self, self.shadows)
 
         # Load the static scene
-        meshes = load_obj_file('models/scene5.obj')
-        self.add_models_list(
-            [DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([0,-1,0]),scaleMatrix([0.5,0.5,0.5])), mesh=mesh, shader=ShadowMappingShader(shadow_map=self.shadows), name='scene') for mesh in meshes]
-        )
+        # the static meshes of each shader are merged in a single batch, drawn with a few calls
+        meshes = loader.meshes('models/scene5.obj')
+        scene_batch = StaticBatch(scene=self, M=np.matmul(translationMatrix([0,-1,0]),scaleMatrix([0.5,0.5,0.5])), meshes=meshes, shader=ShadowMappingShader(shadow_map=self.shadows), name='scene')
+        self.add_model(scene_batch)
+        self.shadows.add_casters([scene_batch])
 
         # Load fake light sources to give different shader
-        meshes = load_obj_file('models/lightvertices.obj')
-        self.add_models_list(
-            [DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([0,-1,0]),scaleMatrix([0.5,0.5,0.5])), mesh=mesh, shader=MaxBrightnessShader(), name='scene') for mesh in meshes]
+        meshes = loader.meshes('models/lightvertices.obj')
+        self.add_model(
+            StaticBatch(scene=self, M=np.matmul(translationMatrix([0,-1,0]),scaleMatrix([0.5,0.5,0.5])), meshes=meshes, shader=MaxBrightnessShader(), name='scene')
         )
 
-        # Load water independently to give environment shaders
-        meshes = load_obj_file('models/water.obj')
+        # Load water independently to give environment shaders. The reflections at grazing angles magnify the errors
+        # of the normals, which are stored on 16 bits rather than 10.
+        meshes = loader.meshes('models/water.obj')
+        water_layout = VertexLayout(formats=dict(default_layout.formats, normal='snorm16'), tolerances=default_layout.tolerances)
         self.add_models_list(
-            [DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([0,-1,0]),scaleMatrix([0.5,0.5,0.5])), mesh=mesh, shader=EnvironmentShader(map=self.environment), name='scene') for mesh in meshes]
+            [DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([0,-1,0]),scaleMatrix([0.5,0.5,0.5])), mesh=mesh, shader=EnvironmentShader(map=self.environment), name='scene', layout=water_layout) for mesh in meshes]
         )
         
         # Load all meshes of the balloon and add each part separately
-        balloon_meshes = load_obj_file('models/balloon.obj')
+        balloon_meshes = loader.meshes('models/balloon.obj')
         self.balloon_parts = []
         for i, mesh in enumerate(balloon_meshes):
             balloon_part = DrawModelFromMesh(scene=self, M=np.matmul(translationMatrix([0, -1, 0]), scaleMatrix([0.5, 0.5, 0.5])), mesh=mesh, shader=ShadowMappingShader(shadow_map=self.shadows), name=f'balloon')
             self.balloon_parts.append(balloon_part)
             self.add_model(balloon_part)
+        self.shadows.add_casters(self.balloon_parts, dynamic=True)
+
+        # the models in bounding volume hierarchies for culling, only the balloon moves
+        self.model_tree = ModelTree(static=[model for model in self.models if model not in self.balloon_parts], dynamic=self.balloon_parts)
+
+        loader.close()
+        texture_manager.report()
+        vertex_memory.report()
 
         # Draw skybox
         self.skybox = SkyBox(scene=self)
@@ -101,13 +128,12 @@ class ExeterScene(Scene):
             else:
                 self.move_balloon_down()
 
-    def draw_shadow_map(self):
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-
     def draw_reflections(self):
-        self.skybox.draw()
-        for model in self.models:
-            model.draw()
+        self.render_queue.add_models(self.visible_models(self.model_tree, 'environment'))
+
+        # the skybox is in a later pass, so that the depth test discards its fragments hidden by the models
+        self.render_queue.add(self.skybox)
+        self.render_queue.flush()
 
     def draw(self, framebuffer=False):
         '''
@@ -127,8 +153,8 @@ class ExeterScene(Scene):
             self.environment.update(self)
             self.show_shadow_map.draw()
 
-        for model in self.models:
-            model.draw()
+        self.render_queue.add_models(self.visible_models(self.model_tree, 'camera'))
+        self.render_queue.flush()
 
         if not framebuffer:
             pygame.display.flip()
@@ -144,6 +170,10 @@ class ExeterScene(Scene):
         if event.key == pygame.K_s:
             self.animationRunning = True
 
+        # toggles the report of the frame times, state changes and culling
+        if event.key == pygame.K_d:
+            self.debug = not self.debug
+
 
 if __name__ == '__main__':
     # initialises the scene object
@@ -1,7 +1,14 @@
 from material import Material
 import numpy as np
 
-from texture import Texture
+from OpenGL.GL import GL_LINEAR
+
+from texture import texture_manager
+
+# parameters of the textures of the materials (see Texture). They are mipmapped with trilinear filtering, as they
+# are mostly seen from a distance or at grazing angles (eg, the ground). Anisotropic filtering (eg, 'anisotropy': 8.0)
+# further sharpens the ground, but it is very slow on software renderers such as Mesa's llvmpipe.
+material_texture_parameters = {'sample': GL_LINEAR, 'mipmap': 'cpu', 'anisotropy': 1.0}
 
 
 class Mesh:
@@ -9,13 +16,15 @@ class Mesh:
     Simple class to hold a mesh data. For now we will only focus on vertices, faces (indices of vertices for each face)
     and normals.
     '''
-    def __init__(self, vertices=None, faces=None, normals=None, textureCoords=None, material=Material()):
+    def __init__(self, vertices=None, faces=None, normals=None, textureCoords=None, material=Material(), tangents=None, binormals=None):
         '''
         Initialises a mesh object.
         :param vertices: A numpy array containing all vertices
         :param faces: [optional] An int array containing the vertex indices for all faces.
         :param normals: [optional] An array of normal vectors, calculated from the faces if not provided.
         :param material: [optional] An object containing the material information for this object
+        :param tangents: [optional] An array of tangent vectors, only used if normals are provided
+        :param binormals: [optional] An array of binormal vectors, only used if normals are provided
         '''
         self.name = 'Unknown'
         self.vertices = vertices
@@ -24,8 +33,8 @@ class Mesh:
         self.colors = None
         self.textureCoords = textureCoords
         self.textures = []
-        self.tangents = None
-        self.binormals = None
+        self.tangents = tangents
+        self.binormals = binormals
 
         if vertices is not None:
             print('Creating mesh')
@@ -46,50 +55,71 @@ class Mesh:
             self.normals = normals
 
         if material.texture is not None:
-            self.textures.append(Texture(material.texture))
+            self.textures.append(texture_manager.get(material.texture, **material_texture_parameters))
             #self.textures.append(Texture('lena.bmp'))
 
 
     def calculate_normals(self):
         '''
-        method to calculate normals from the mesh faces.
-        TODO WS3: Fix this code to calculate the correct normals
-        Use the approach discussed in class:
-        1. calculate normal for each face using cross product
-        2. set each vertex normal as the average of the normals over all faces it belongs to.
+        method to calculate normals from the mesh faces, see calculate_normals() below.
         '''
-
-        self.normals = np.zeros((self.vertices.shape[0], 3), dtype='f')
+        self.normals, tangents, binormals = calculate_normals(self.vertices, self.faces, self.textureCoords)
         if self.textureCoords is not None:
-            self.tangents = np.zeros((self.vertices.shape[0], 3), dtype='f')
-            self.binormals = np.zeros((self.vertices.shape[0], 3), dtype='f')
-
-        #TODO WS3
-        for f in range(self.faces.shape[0]):
-            # first calculate the face normal using the cross product of the triangle's sides
-            a = self.vertices[self.faces[f, 1]] - self.vertices[self.faces[f, 0]]
-            b = self.vertices[self.faces[f, 2]] - self.vertices[self.faces[f, 0]]
-            face_normal = np.cross(a, b)
-
-            # tangent
-            if self.textureCoords is not None:
-                txa = self.textureCoords[self.faces[f, 1], :] - self.textureCoords[self.faces[f, 0], :]
-                txb = self.textureCoords[self.faces[f, 2], :] - self.textureCoords[self.faces[f, 2], :]
-                face_tangent = txb[0]*a - txa[0]*b
-                face_binormal = -txb[1]*a + txa[1]*b
-
-            # blend normal on all 3 vertices
-            for j in range(3):
-                self.normals[self.faces[f, j], :] += face_normal
-                if self.textureCoords is not None:
-                    self.tangents[self.faces[f, j], :] += face_tangent
-                    self.binormals[self.faces[f, j], :] += face_binormal
-
-        # finally we need to normalize the vectors
-        self.normals /= np.linalg.norm(self.normals, axis=1, keepdims=True)
-        if self.textureCoords is not None:
-            self.tangents /= np.linalg.norm(self.tangents, axis=1, keepdims=True)
-            self.binormals /= np.linalg.norm(self.binormals, axis=1, keepdims=True)
+            self.tangents = tangents
+            self.binormals = binormals
+
+
+def calculate_normals(vertices, faces, textureCoords=None):
+    '''
+    Calculates the normals of a mesh from its faces (and the tangents and binormals if texture coordinates are given).
+    Use the approach discussed in class:
+    1. calculate normal for each face using cross product
+    2. set each vertex normal as the average of the normals over all faces it belongs to.
+    All faces are processed at once: the face normals (and tangents) are calculated as arrays, then
+    accumulated on the vertices using np.add.at, which correctly handles vertices shared by several faces.
+    This function does not use OpenGL, so it can run in a worker process (see assetLoader.py).
+    :param vertices: The vertex positions
+    :param faces: The vertex indices of each face
+    :param textureCoords: [optional] The texture coordinates of each vertex
+    :return: a tuple of arrays (normals, tangents, binormals), tangents and binormals are None without textureCoords
+    '''
+
+    # the three vertex indices of each face
+    f0 = faces[:, 0]
+    f1 = faces[:, 1]
+    f2 = faces[:, 2]
+
+    # first calculate the face normals using the cross product of the triangle's sides
+    a = vertices[f1] - vertices[f0]
+    b = vertices[f2] - vertices[f0]
+    face_normals = np.cross(a, b)
+
+    # blend normals on all 3 vertices of each face
+    normals = np.zeros((vertices.shape[0], 3), dtype='f')
+    np.add.at(normals, faces[:, :3], face_normals[:, np.newaxis, :])
+
+    # finally we need to normalize the vectors
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+
+    if textureCoords is None:
+        return normals, None, None
+
+    # tangent
+    txa = textureCoords[f1, :] - textureCoords[f0, :]
+    txb = textureCoords[f2, :] - textureCoords[f0, :]
+    face_tangents = txb[:, 0:1]*a - txa[:, 0:1]*b
+    face_binormals = -txb[:, 1:2]*a + txa[:, 1:2]*b
+
+    tangents = np.zeros((vertices.shape[0], 3), dtype='f')
+    binormals = np.zeros((vertices.shape[0], 3), dtype='f')
+    np.add.at(tangents, faces[:, :3], face_tangents[:, np.newaxis, :])
+    np.add.at(binormals, faces[:, :3], face_binormals[:, np.newaxis, :])
+
+    # the tangents of vertices whose faces all have degenerate texture coordinates (eg, water.obj) are left null
+    tangents /= np.maximum(np.linalg.norm(tangents, axis=1, keepdims=True), np.finfo('f').tiny)
+    binormals /= np.maximum(np.linalg.norm(binormals, axis=1, keepdims=True), np.finfo('f').tiny)
+
+    return normals, tangents, binormals
 
 
 class CubeMesh(Mesh):
@@ -0,0 +1,113 @@
+import weakref
+
+import numpy as np
+
+from BaseModel import no_parent
+
+'''
+Picking the model under the mouse by casting a ray from the camera: the ray is tested against the bounds of the models
+first (see bvh.py), then against the triangles of the models whose bounds it hits, nearest first.
+'''
+
+# the first vertex and the two edges of each triangle of the models already picked, in model coordinates
+triangle_cache = weakref.WeakKeyDictionary()
+
+
+class Pick:
+    '''
+    The result of picking: the model hit, and where.
+    '''
+    def __init__(self, model, point, distance, part=None):
+        '''
+        :param model: The model hit
+        :param point: The point hit, in world coordinates
+        :param distance: The distance along the ray, in multiples of the length of its direction
+        :param part: For models drawing several meshes, the name of the part hit (see BaseModel.part_name())
+        '''
+        self.model = model
+        self.name = model.name
+        self.point = point
+        self.distance = distance
+        self.part = part
+
+    def __repr__(self):
+        part = ' ({})'.format(self.part) if self.part is not None else ''
+        return '{}{} at [{:.3f}, {:.3f}, {:.3f}]'.format(self.name, part, *self.point)
+
+
+def mouse_ray(P, V, x, y, window_size):
+    '''
+    Returns the ray going through a pixel of the window, from the near to the far plane of the projection.
+    :param P: The projection matrix
+    :param V: The view matrix
+    :param x, y: The position of the pixel, from the top left corner of the window as given by PyGame
+    :param window_size: The size of the window
+    :return: A tuple (origin, direction) in world coordinates, the direction going from the near to the far plane
+    '''
+    ndc_x = 2. * (x + 0.5) / window_size[0] - 1.
+    ndc_y = 1. - 2. * (y + 0.5) / window_size[1]
+    points = np.matmul(np.array([[ndc_x, ndc_y, -1., 1.], [ndc_x, ndc_y, 1., 1.]]), np.linalg.inv(np.matmul(P, V)).T)
+    points = points[:, :3] / points[:, 3:]
+    return points[0], points[1] - points[0]
+
+
+def ray_triangles(origin, direction, v0, e1, e2):
+    '''
+    Intersects a ray with triangles using the Moller-Trumbore algorithm, all triangles at once. Triangles are hit from
+    both sides.
+    :param origin: The origin of the ray
+    :param direction: The direction of the ray
+    :param v0: The first vertex of each triangle (T, 3)
+    :param e1, e2: The edges from the first vertex to the two others (T, 3)
+    :return: The distance of each triangle along the ray, in multiples of the length of the direction, inf if missed
+    '''
+    p = np.cross(direction, e2)
+    det = np.einsum('ij,ij->i', e1, p)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inverse = 1. / det
+        s = origin - v0
+        u = np.einsum('ij,ij->i', s, p) * inverse
+        q = np.cross(s, e1)
+        v = np.matmul(q, direction) * inverse
+        t = np.einsum('ij,ij->i', e2, q) * inverse
+        hit = (det != 0) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t >= 0)
+    return np.where(hit, t, np.inf)
+
+
+def model_triangles(model):
+    '''
+    Returns the first vertex and the edges of the triangles of a model, computed on the first call.
+    '''
+    triangles = triangle_cache.get(model)
+    if triangles is None:
+        vertices = model.triangle_vertices().astype(np.float64)
+        triangles = triangle_cache[model] = (vertices[:, 0], vertices[:, 1] - vertices[:, 0], vertices[:, 2] - vertices[:, 0])
+    return triangles
+
+
+def pick(models, origin, direction):
+    '''
+    Returns the nearest model hit by a ray.
+    :param models: A bvh.ModelTree holding the models that can be picked
+    :param origin: The origin of the ray, in world coordinates
+    :param direction: The direction of the ray (see mouse_ray())
+    :return: A Pick object, or None if no model is hit
+    '''
+    best = None
+    for distance, model in models.ray(origin, direction):
+        # the models are sorted by the distance where the ray enters their bounds, so the models whose bounds
+        # are further than the nearest triangle hit cannot be nearer
+        if best is not None and distance > best.distance:
+            break
+        if not model.visible or model.mesh.vertices is None:
+            continue
+
+        # the ray is intersected with the triangles in model coordinates, the distances along the ray are the same
+        iM = np.linalg.inv(model.world_matrix(no_parent))
+        t = ray_triangles(np.matmul(iM[:3, :3], origin) + iM[:3, 3], np.matmul(iM[:3, :3], direction), *model_triangles(model))
+        if t.size == 0:
+            continue
+        triangle = np.argmin(t)
+        if np.isfinite(t[triangle]) and (best is None or t[triangle] < best.distance):
+            best = Pick(model, origin + t[triangle] * direction, t[triangle], model.part_name(triangle))
+    return best
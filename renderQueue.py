@@ -0,0 +1,145 @@
+from OpenGL.GL import *
+
+
+class GLState:
+    '''
+    Keeps track of the OpenGL objects bound through it: the program, the vertex array, the active texture unit and
+    the texture bound to each unit and target. Binding an object which is already bound is skipped, so callers do not
+    need to know what was drawn before them. For the tracked state to stay right, all these bindings must go through
+    the shared gl_state object rather than calling OpenGL directly.
+    '''
+    def __init__(self):
+        # None means unknown, eg before the first binding
+        self.program = None
+        self.vertex_array = None
+        self.active_unit = None
+
+        # the texture bound to each (unit, target)
+        self.textures = {}
+
+        # the number of bindings made and skipped since the last call to reset_counters()
+        self.changes = {'program': 0, 'vertex array': 0, 'texture unit': 0, 'texture': 0}
+        self.skipped = 0
+
+    def use_program(self, program):
+        if program == self.program:
+            self.skipped += 1
+            return
+        glUseProgram(program)
+        self.program = program
+        self.changes['program'] += 1
+
+    def bind_vertex_array(self, vertex_array):
+        vertex_array = int(vertex_array)
+        if vertex_array == self.vertex_array:
+            self.skipped += 1
+            return
+        glBindVertexArray(vertex_array)
+        self.vertex_array = vertex_array
+        self.changes['vertex array'] += 1
+
+    def active_texture(self, unit):
+        '''
+        :param unit: The index of the texture unit, from 0
+        '''
+        if unit == self.active_unit:
+            self.skipped += 1
+            return
+        glActiveTexture(GL_TEXTURE0 + unit)
+        self.active_unit = unit
+        self.changes['texture unit'] += 1
+
+    def bind_texture(self, target, texture, unit=None):
+        '''
+        Binds a texture to a unit, the active unit is only changed if the texture is not bound to it yet.
+        :param target: The texture target, eg GL_TEXTURE_2D
+        :param texture: The OpenGL texture id, 0 to unbind
+        :param unit: The index of the texture unit, by default the active unit
+        '''
+        if unit is None:
+            unit = self.active_unit
+        key = (unit, target)
+        if self.textures.get(key) == texture:
+            self.skipped += 1
+            return
+        if unit is not None:
+            self.active_texture(unit)
+        glBindTexture(target, texture)
+        self.textures[key] = texture
+        self.changes['texture'] += 1
+
+    def delete_texture(self, texture):
+        '''
+        Deletes a texture: OpenGL unbinds it from all units, and its id may be reused by a new texture.
+        '''
+        glDeleteTextures(1, [texture])
+        for key, bound in self.textures.items():
+            if bound == texture:
+                self.textures[key] = 0
+
+    def delete_vertex_array(self, vertex_array):
+        glDeleteVertexArrays(1, [vertex_array])
+        if int(vertex_array) == self.vertex_array:
+            self.vertex_array = 0
+
+    def invalidate(self):
+        '''
+        Forgets the tracked state, so that the next bindings are made. This should be called after code binding
+        objects directly with OpenGL.
+        '''
+        self.program = None
+        self.vertex_array = None
+        self.active_unit = None
+        self.textures = {}
+
+    def reset_counters(self):
+        '''
+        Returns the bindings made and skipped since the last call, and resets the counters.
+        :return: A tuple (dictionary of the bindings made for each kind of object, number of bindings skipped)
+        '''
+        changes, skipped = self.changes, self.skipped
+        self.changes = dict.fromkeys(changes, 0)
+        self.skipped = 0
+        return changes, skipped
+
+
+# the OpenGL state of the process, shared by all models, shaders and textures
+gl_state = GLState()
+
+
+class RenderQueue:
+    '''
+    Collects the models to draw, and draws them sorted by a (pass, program, texture set, vertex array) key: the models
+    sharing a program and textures are drawn one after the other, so that the state only changes between groups, and
+    gl_state skips the bindings that did not change. Passes are drawn in increasing order (see BaseModel.render_pass),
+    and the models with the same key are drawn in the order they were added.
+    '''
+    def __init__(self):
+        self.items = []
+
+    def add(self, model, *args):
+        '''
+        Adds a model to draw on the next flush().
+        :param model: The model, drawn with model.draw(*args)
+        '''
+        if model.visible:
+            self.items.append((self.key(model), len(self.items), model, args))
+
+    def add_models(self, models):
+        for model in models:
+            self.add(model)
+
+    @staticmethod
+    def key(model):
+        textures = tuple(texture.textureid for texture in model.mesh.textures)
+        program = model.shader.program if model.shader is not None else 0
+        return model.render_pass, program, textures, int(model.vao)
+
+    def flush(self):
+        '''
+        Draws the models added since the last flush, and empties the queue.
+        '''
+        items, self.items = self.items, []
+        items.sort(key=lambda item: item[:2])
+        for key, index, model, args in items:
+            model.draw(*args)
@@ -1,3 +1,5 @@
+import time
+
 # pygame is just used to create a window with the operating system on which to draw.
 import pygame
 
@@ -15,6 +17,40 @@ from matutils import *
 
 from lightSource import LightSource
 
+from renderQueue import RenderQueue, gl_state
+
+from culling import cull, reset_cull_stats
+
+from bvh import ModelTree
+
+from picking import mouse_ray, pick
+
+
+class FrameContext:
+    '''
+    Values shared by all the models drawn with the same projection, view and light, computed once instead of for each
+    model. See Scene.frame_context().
+    '''
+    def __init__(self, P, V, light, block):
+        '''
+        :param block: The Frame uniform block, updated with the values of the context
+        '''
+        self.P = P
+        self.V = V
+        self.PV = np.matmul(P, V)
+
+        # the inverse of the view matrix, to go from view to world coordinates
+        self.iV = np.linalg.inv(V)
+
+        # the light position, in world and view coordinates
+        self.light = tuple(light.position)
+        self.light_position = unhomog(np.dot(V, homog(light.position))).astype('f')
+
+        block.set(V=V, light=self.light_position, Ia=light.Ia, Id=light.Id, Is=light.Is)
+        block.upload()
+        block.bind()
+
+
 class Scene:
     '''
     This is the main class for adrawing an OpenGL scene using the PyGame library
@@ -70,6 +106,10 @@ class Scene:
         # to start with, we use an orthographic projection; change this.
         self.P = frustumMatrix(left, right, top, bottom, near, far)
 
+        # when rendering to all the layers of a framebuffer at once, the projection-view matrix of each layer
+        # (see EnvironmentMappingTexture), in which case P and V are the identity
+        self.layer_PV = None
+
         # initialises the camera object
         self.camera = Camera()
 
@@ -82,6 +122,93 @@ class Scene:
         # This class will maintain a list of models to draw in the scene,
         self.models = []
 
+        # the models in bounding volume hierarchies (see bvh.ModelTree), if the scene builds them, used for culling
+        # and picking
+        self.model_tree = None
+
+        # the position of the mouse when the left button was pressed, or None once it moved: releasing the button
+        # without moving the mouse picks the model under it, while moving it in between orbits the camera
+        self.pick_position = None
+
+        # the values shared by the models drawn with the current projection, view and light, and the uniform block
+        # holding them for the shaders
+        self.context = None
+        self.frame_block = None
+
+        # the models are drawn through a queue sorting them by state, to limit the state changes
+        self.render_queue = RenderQueue()
+
+        # the duration of the last frames, reported every report_interval frames in debug mode (see report_frames())
+        self.frame_times = []
+        self.report_interval = 100
+        self.debug = False
+
+    def frame_context(self):
+        '''
+        Returns the values shared by all the models drawn with the current projection, view and light. A new context
+        is only created when one of them changed, so that the models can keep the values derived from the context
+        (see BaseModel.view_transforms()).
+        :return: A FrameContext object
+        '''
+        context = self.context
+        if context is not None and context.light == tuple(self.light.position):
+            # the camera creates a new view matrix when updated, which is usually the same as the previous one
+            if context.P is not self.P and np.array_equal(context.P, self.P):
+                context.P = self.P
+            if context.V is not self.camera.V and np.array_equal(context.V, self.camera.V):
+                context.V = self.camera.V
+            if context.P is self.P and context.V is self.camera.V:
+                return context
+
+        if self.frame_block is None:
+            self.frame_block = UniformBlock('Frame')
+        self.context = FrameContext(self.P, self.camera.V, self.light, self.frame_block)
+        return self.context
+
+    def report_frames(self):
+        '''
+        Prints, in debug mode only, the average frame time, number of uniform calls (glUniform and uniform block
+        bindings), state changes and culled models over the last frames. The counters are reset in any case.
+        '''
+        frames = len(self.frame_times)
+        frame_times = self.frame_times
+        self.frame_times = []
+        made, skipped_uniforms = uniform_calls['made'], uniform_calls['skipped']
+        uniform_calls['made'] = uniform_calls['skipped'] = 0
+
+        changes, skipped = gl_state.reset_counters()
+        culled = reset_cull_stats()
+        if self.debug:
+            print('Frame time {:.1f}ms on average over {} frames ({:.1f}ms at worst), {:.0f} uniform calls per frame and '
+                  '{:.0f} skipped as the value was already set'.format(
+                      1000 * sum(frame_times) / frames, frames, 1000 * max(frame_times),
+                      made / frames, skipped_uniforms / frames))
+            print('State changes per frame: {:.0f} ({}), {:.0f} skipped as the object was already bound'.format(
+                sum(changes.values()) / frames, ', '.join('{} {:.0f}'.format(kind, count / frames) for kind, count in changes.items()),
+                skipped / frames))
+            print('Models culled per frame: {}'.format(', '.join('{} {:.1f} of {:.1f}'.format(
+                name, count / frames, tested / frames) for name, (tested, count) in culled.items())))
+
+    def visible_models(self, models, name):
+        '''
+        Returns the models in the view of the current projection and camera, or of any layer when rendering all
+        the layers of a framebuffer at once.
+        :param models: A list of models, or a bvh.ModelTree
+        :param name: The name of the pass, for the culling statistics
+        '''
+        PV = self.layer_PV if self.layer_PV is not None else np.matmul(self.P, self.camera.V)
+        return cull(models, PV, name)
+
+    def pick(self, x, y):
+        '''
+        Returns the model under a pixel of the window, see picking.pick().
+        :param x, y: The position of the pixel, eg of the mouse
+        :return: A picking.Pick object giving the model and the point hit, or None
+        '''
+        models = self.model_tree if self.model_tree is not None else ModelTree(dynamic=self.models)
+        origin, direction = mouse_ray(self.P, self.camera.V, x, y, self.window_size)
+        return pick(models, origin, direction)
+
     def add_model(self, model):
         '''
         This method just adds a model to the scene.
@@ -117,9 +244,9 @@ class Scene:
             # ensure that the camera view matrix is up to date
             self.camera.update()
 
-        # then we loop over all models in the list and draw them
-        for model in self.models:
-            model.draw()
+        # then we draw all models in the view, sorted by state
+        self.render_queue.add_models(self.visible_models(self.models, 'camera'))
+        self.render_queue.flush()
 
         # once we are done drawing, we display the scene
         # Note that here we use double buffering to avoid artefacts:
@@ -143,7 +270,10 @@ class Scene:
 
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 mods = pygame.key.get_mods()
-                if event.button == 4:
+                if event.button == 1:
+                    self.pick_position = event.pos
+
+                elif event.button == 4:
                     #pass
                     #TODO: WS2
                     if mods & pygame.KMOD_CTRL:
@@ -161,7 +291,20 @@ class Scene:
                     else:
                         self.camera.distance += 1
 
+            elif event.type == pygame.MOUSEBUTTONUP:
+                if event.button == 1 and self.pick_position is not None:
+                    start = time.perf_counter()
+                    picked = self.pick(*self.pick_position)
+                    print('Picked {}'.format(picked if picked is not None else 'nothing'))
+                    if self.debug:
+                        print('- picking took {:.2f}ms'.format(1000 * (time.perf_counter() - start)))
+                    self.pick_position = None
+
             elif event.type == pygame.MOUSEMOTION:
+                # the mouse moved while pressed: this is a drag, not a click
+                if event.buttons[0]:
+                    self.pick_position = None
+
                 if pygame.mouse.get_pressed()[0]:
                     if self.mouse_mvt is not None:
                         self.mouse_mvt = pygame.mouse.get_rel()
@@ -193,7 +336,12 @@ class Scene:
 
             self.pygameEvents()
 
+            start = time.perf_counter()
             self.update()
 
             # otherwise, continue drawing
-            self.draw()
\ No newline at end of file
+            self.draw()
+
+            self.frame_times.append(time.perf_counter() - start)
+            if len(self.frame_times) == self.report_interval:
+                self.report_frames()
\ No newline at end of file
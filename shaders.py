@@ -1,11 +1,39 @@
+import ctypes
+import hashlib
+import os
+import re
+
 # imports all openGL functions
 from OpenGL.GL import *
 from OpenGL.GL import shaders
+from OpenGL.error import GLError
 from matutils import *
+from renderQueue import gl_state
 # we will use numpy to store data in arrays
 import numpy as np
 
 
+# the value last set for each uniform location of each program, as uniforms keep their value until set again: setting
+# the same value again is skipped. Counts the glUniform calls made and skipped, see Scene.report_frames().
+uniform_values = {}
+uniform_calls = {'made': 0, 'skipped': 0}
+
+# the uniform blocks shared by all programs declaring them, with their binding point and their fields in the order
+# of the GLSL declaration: the Frame block is set once per frame context (see Scene.frame_context()) and each
+# material has its own Material block (see material_block())
+uniform_blocks = {
+    'Frame': (0, [('V', 'mat4'), ('light', 'vec3'), ('Ia', 'vec3'), ('Id', 'vec3'), ('Is', 'vec3')]),
+    'Material': (1, [('Ka', 'vec3'), ('Kd', 'vec3'), ('Ks', 'vec3'), ('Ns', 'float'), ('alpha', 'float')]),
+}
+
+# the names of the uniform blocks declared by each program, and the buffer bound to each binding point
+program_blocks = {}
+bound_blocks = {}
+
+# the Material block of each material
+material_blocks = {}
+
+
 class Uniform:
     '''
     We create a simple class to handle uniforms, this is not necessary,
@@ -19,6 +47,10 @@ class Uniform:
         self.name = name
         self.value = value
         self.location = -1
+        self.program = None
+
+        # the location of the uniform in each program it was linked to
+        self.locations = {}
 
     def link(self, program):
         '''
@@ -26,23 +58,48 @@ class Uniform:
         in the program from its name
         :param program: the GLSL program where the uniform is used
         '''
-        self.location = glGetUniformLocation(program=program, name=self.name)
-        if self.location == -1:
-            print('(E) Warning, no uniform {}'.format(self.name))
+        if program not in self.locations:
+            self.locations[program] = glGetUniformLocation(program=program, name=self.name)
+            if self.locations[program] == -1:
+                print('(E) Warning, no uniform {}'.format(self.name))
+        self.location = self.locations[program]
+        self.program = program
+
+    def changed(self, value):
+        '''
+        Checks whether a value differs from the one last set for the uniform in its program, and records it if so.
+        :param value: The value to set, a number, a list or a numpy array
+        :return: True if the value needs setting with glUniform
+        '''
+        if isinstance(value, np.ndarray):
+            value = (value.shape, value.dtype.char, value.tobytes())
+        elif isinstance(value, list):
+            value = tuple(value)
+
+        key = (self.program, self.location)
+        if key in uniform_values and uniform_values[key] == value:
+            uniform_calls['skipped'] += 1
+            return False
+
+        uniform_values[key] = value
+        uniform_calls['made'] += 1
+        return True
 
     def bind_matrix(self, M=None, number=1, transpose=True):
         '''
         Call this before rendering to bind the Python matrix to the GLSL uniform mat4.
         You will need different methods for different types of uniform, but for now this will
         do for the PVM matrix
-        :param number: the number of matrices sent, leave that to 1 for now
+        :param number: the number of matrices sent, for arrays of matrices
         :param transpose: Whether the matrix should be transposed
         '''
         if M is not None:
             self.value = M
-        if self.value.shape[0] == 4 and self.value.shape[1] == 4:
+        if not self.changed(self.value):
+            return
+        if self.value.shape[-2] == 4 and self.value.shape[-1] == 4:
             glUniformMatrix4fv(self.location, number, transpose, self.value)
-        elif self.value.shape[0] == 3 and self.value.shape[1] == 3:
+        elif self.value.shape[-2] == 3 and self.value.shape[-1] == 3:
             glUniformMatrix3fv(self.location, number, transpose, self.value)
         else:
             print('(E) Error: Trying to bind as uniform a matrix of shape {}'.format(self.value.shape))
@@ -66,16 +123,24 @@ class Uniform:
     def bind_int(self, value=None):
         if value is not None:
             self.value = value
-        glUniform1i(self.location, self.value)
+        if self.changed(self.value):
+            glUniform1i(self.location, self.value)
 
     def bind_float(self, value=None):
         if value is not None:
             self.value = value
-        glUniform1f(self.location, self.value)
+        if self.changed(self.value):
+            glUniform1f(self.location, self.value)
 
     def bind_vector(self, value=None):
+        '''
+        Binds a vector, given as a numpy array or a list
+        '''
         if value is not None:
             self.value = value
+        if not self.changed(self.value):
+            return
+        value = np.asarray(self.value, 'f')
         if value.shape[0] == 2:
             glUniform2fv(self.location, 1, value)
         elif value.shape[0] == 3:
@@ -92,6 +157,234 @@ class Uniform:
         self.value = value
 
 
+class UniformBlock:
+    '''
+    A uniform block in the std140 layout, stored in a uniform buffer object. All programs declaring a block of the same
+    name read it from the same binding point, so its values are uploaded once and then shared by all draws, rather
+    than set as uniforms of each program. See uniform_blocks for the blocks and their fields.
+    '''
+
+    # the std140 base alignment and size of each type of field, in bytes
+    layouts = {'int': (4, 4), 'float': (4, 4), 'vec2': (8, 8), 'vec3': (16, 12), 'vec4': (16, 16), 'mat4': (16, 64)}
+
+    def __init__(self, name):
+        '''
+        :param name: The name of the block in the GLSL code, in uniform_blocks
+        '''
+        self.name = name
+        self.binding, fields = uniform_blocks[name]
+
+        # the offset of each field in the block
+        self.fields = {}
+        offset = 0
+        for field, type in fields:
+            alignment, size = self.layouts[type]
+            offset = (offset + alignment - 1) // alignment * alignment
+            self.fields[field] = (offset, type)
+            offset += size
+
+        # the size of a block is rounded up to a multiple of a vec4
+        self.data = np.zeros((offset + 15) // 16 * 16, dtype=np.uint8)
+
+        self.ubo = glGenBuffers(1)
+        glBindBuffer(GL_UNIFORM_BUFFER, self.ubo)
+        glBufferData(GL_UNIFORM_BUFFER, self.data.nbytes, None, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+
+    def set(self, **values):
+        '''
+        Sets fields of the block, which are sent to OpenGL by upload()
+        :param values: The value of each field, matrices as numpy arrays
+        '''
+        for field, value in values.items():
+            offset, type = self.fields[field]
+            value = np.asarray(value, dtype=np.int32 if type == 'int' else np.float32)
+            if type == 'mat4':
+                # OpenGL matrices are stored by column
+                value = value.transpose()
+            value = np.ascontiguousarray(value).view(np.uint8).ravel()
+            self.data[offset:offset + value.size] = value
+
+    def upload(self):
+        glBindBuffer(GL_UNIFORM_BUFFER, self.ubo)
+        glBufferSubData(GL_UNIFORM_BUFFER, 0, self.data.nbytes, self.data)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+
+    def bind(self):
+        '''
+        Binds the block to its binding point, for all programs declaring it. Skipped if it is already bound.
+        '''
+        if bound_blocks.get(self.binding) == self.ubo:
+            uniform_calls['skipped'] += 1
+            return
+        glBindBufferBase(GL_UNIFORM_BUFFER, self.binding, self.ubo)
+        bound_blocks[self.binding] = self.ubo
+        uniform_calls['made'] += 1
+
+
+def material_block(material, update=False):
+    '''
+    Returns the Material uniform block of a material, which is uploaded when first requested.
+    :param material: The Material object
+    :param update: Whether to upload the block again, if the properties of the material changed
+    '''
+    block = material_blocks.get(material)
+    if block is None or update:
+        if block is None:
+            block = material_blocks[material] = UniformBlock('Material')
+        block.set(Ka=material.Ka, Kd=material.Kd, Ks=material.Ks, Ns=material.Ns, alpha=material.alpha)
+        block.upload()
+    return block
+
+
+def link_uniform_blocks(program):
+    '''
+    Connects the uniform blocks declared by a program to their binding points.
+    :return: The names of the blocks declared by the program
+    '''
+    blocks = set()
+    for name, (binding, fields) in uniform_blocks.items():
+        index = glGetUniformBlockIndex(program, name)
+        if index != GL_INVALID_INDEX:
+            glUniformBlockBinding(program, index, binding)
+            blocks.add(name)
+    return blocks
+
+
+# GLSL programs already compiled and linked, indexed by their source code and attribute locations. Shader objects
+# with the same sources share a single OpenGL program, while each one keeps its own uniform values, which are all
+# set again when the shader is bound for a model.
+programs = {}
+
+# folder where the linked programs are saved using glGetProgramBinary(), so that later runs can load them instead of
+# compiling the GLSL code again. Set to None to disable this cache.
+program_binary_cache = 'shaders/cache'
+
+# whether the driver can save and load program binaries, checked once by program_binary_supported()
+program_binary_support = None
+
+
+def program_binary_supported():
+    '''
+    Checks whether the OpenGL driver provides the program binary functions (ARB_get_program_binary). Without them
+    (eg, some offscreen contexts), the program binary cache is skipped and programs are always compiled.
+    '''
+    global program_binary_support
+    if program_binary_support is None:
+        program_binary_support = bool(glProgramParameteri) and bool(glGetProgramBinary) and bool(glProgramBinary)
+        if not program_binary_support:
+            print('(W) Warning, program binaries not supported by the driver, the program binary cache is disabled')
+    return program_binary_support
+
+
+def program_binary_file(key):
+    '''
+    Returns the file of the program binary cache for a program. Binaries can only be loaded by the driver that
+    created them, so the file name is a hash of the sources and attributes of the program, and of the OpenGL driver.
+    '''
+    driver = [glGetString(GL_VENDOR), glGetString(GL_RENDERER), glGetString(GL_VERSION)]
+    digest = hashlib.sha1(repr((key, driver)).encode()).hexdigest()
+    return os.path.join(program_binary_cache, '{}.bin'.format(digest))
+
+
+def load_program_binary(key):
+    '''
+    Loads a linked program from the program binary cache.
+    :return: The program, or None if it is not in the cache or if the driver rejected the binary.
+    '''
+    if program_binary_cache is None or not program_binary_supported() or not os.path.exists(program_binary_file(key)):
+        return None
+
+    # the file starts with the binary format (a GLenum), followed by the binary itself
+    data = np.fromfile(program_binary_file(key), dtype=np.uint8)
+    program = glCreateProgram()
+    try:
+        glProgramBinary(program, int(data[:4].view(np.uint32)[0]), data[4:], data.shape[0] - 4)
+        if glGetProgramiv(program, GL_LINK_STATUS) == GL_TRUE:
+            return program
+    except GLError as error:
+        print('(W) Warning, could not load program binary: {}'.format(error))
+
+    # the binary is outdated (eg, the driver was updated), we need to compile the program
+    glDeleteProgram(program)
+    return None
+
+
+def save_program_binary(key, program):
+    '''
+    Saves a linked program in the program binary cache.
+    '''
+    if program_binary_cache is None or not program_binary_supported():
+        return
+
+    length = glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH)
+    if length == 0:
+        return
+
+    data = np.empty(length + 4, dtype=np.uint8)
+    written = GLsizei()
+    format = GLenum()
+    glGetProgramBinary(program, length, ctypes.byref(written), ctypes.byref(format), data[4:])
+    data[:4] = np.frombuffer(np.uint32(format.value).tobytes(), dtype=np.uint8)
+
+    try:
+        os.makedirs(program_binary_cache, exist_ok=True)
+        data[:written.value + 4].tofile(program_binary_file(key))
+    except OSError as error:
+        print('(W) Warning, could not save program binary: {}'.format(error))
+
+
+# the locations of the per-instance attributes of instanced models (see InstancedModel). They are fixed, after the
+# vertex attributes, so that a shader shared by all models (eg, ShadowMapping.DepthShader) links them for all of
+# them. The model matrix is a mat4, which takes four locations.
+instance_attributes = {'instance_M': 8, 'instance_color': 12}
+
+
+def layered_rendering_supported():
+    '''
+    Checks whether the OpenGL driver can render to several layers of a framebuffer at once from the vertex shader,
+    using instancing (see layered_vertex_shader()).
+    '''
+    extensions = [glGetStringi(GL_EXTENSIONS, i).decode() for i in range(glGetIntegerv(GL_NUM_EXTENSIONS))]
+    return 'GL_ARB_draw_instanced' in extensions and 'GL_ARB_shader_viewport_layer_array' in extensions
+
+
+def layered_vertex_shader(source, layers):
+    '''
+    Creates the layered variant of a vertex shader, which renders each instance of a drawing to a different layer of
+    the framebuffer (eg, the faces of a cube map): instance i is written to layer l = i % layers, using layer_PV[l]*PVM
+    as the PVM matrix, so that instanced models can draw each of their instances once per layer. The PVM uniform
+    should then only hold the model matrix, so that all other view dependent values are calculated in world
+    coordinates.
+    :param source: The GLSL code of the vertex shader
+    :param layers: The number of layers
+    :return: The GLSL code of the layered vertex shader, or None if the shader does not use a PVM uniform
+    '''
+    version = re.search(r'#\s*version[^\n]*\n', source)
+    declaration = re.search(r'uniform\s+mat4\s+PVM\s*;[^\n]*\n', source)
+    if version is None or declaration is None or re.search(r'\bvoid\s+main\s*\(', source) is None:
+        return None
+
+    # the extensions must come first, and the layer matrices are declared along with PVM
+    header = source[:version.end()] + \
+        '#extension GL_ARB_draw_instanced : require\n' + \
+        '#extension GL_ARB_shader_viewport_layer_array : require\n' + \
+        source[version.end():declaration.end()] + \
+        'uniform mat4 layer_PV[{}];\n'.format(layers)
+
+    # project with the matrix of the layer, and call the original main() from the new one that selects the layer
+    layer = '(gl_InstanceIDARB % {})'.format(layers)
+    body = re.sub(r'\bPVM\b', '(layer_PV[{}] * PVM)'.format(layer), source[declaration.end():])
+    body = re.sub(r'\bvoid\s+main\s*\(', 'void layer_main(', body)
+
+    return header + body + '''
+void main() {
+    layer_main();
+    gl_Layer = %s;
+}
+''' % layer
+
+
 class BaseShaderProgram:
     '''
     This is the base class for loading and compiling the GLSL shaders.
@@ -149,20 +442,54 @@ class BaseShaderProgram:
             'PVM': Uniform('PVM'),  # project view model matrix
         }
 
+        # the variant of the program for layered rendering (see select_layers()), compiled when first needed
+        self.layered_program = None
+        self.layer_uniform = Uniform('layer_PV')
+        self.layers = 1
+
+        # the uniform blocks declared by the program (see uniform_blocks)
+        self.blocks = set()
 
     def add_uniform(self, name):
         self.uniforms[name] = Uniform(name)
 
     def compile(self, attributes):
         '''
-        Call this function to compile the GLSL codes for both shaders.
+        Call this function to compile the GLSL codes for both shaders. If a program with the same sources and
+        attributes was already compiled, it is reused rather than compiled again, and programs compiled in previous
+        runs are loaded from the program binary cache.
         :return:
         '''
+        self.attributes = attributes
+        self.default_program = self.link_program(self.vertex_shader_source, attributes)
+        self.layered_program = None
+        self.layers = 1
+
+        # tell OpenGL to use this shader program for rendering, and link all uniforms
+        self.use_program(self.default_program)
+
+    def link_program(self, vertex_shader_source, attributes):
+        '''
+        Returns the program for a vertex shader and the fragment shader of this object, compiling it only if it is
+        not in the registry of programs or in the program binary cache.
+        '''
+        key = (vertex_shader_source, self.fragment_shader_source, tuple(sorted(attributes.items())))
+        if key not in programs:
+            programs[key] = load_program_binary(key)
+            if programs[key] is not None:
+                print('Loaded GLSL program binary [{}]'.format(self.name))
+
+        if programs[key] is not None:
+            print('Using compiled GLSL program [{}]'.format(self.name))
+            if programs[key] not in program_blocks:
+                program_blocks[programs[key]] = link_uniform_blocks(programs[key])
+            return programs[key]
+
         print('Compiling GLSL shaders [{}]...'.format(self.name))
         try:
-            self.program = glCreateProgram()
-            glAttachShader(self.program, shaders.compileShader(self.vertex_shader_source, shaders.GL_VERTEX_SHADER))
-            glAttachShader(self.program, shaders.compileShader(self.fragment_shader_source, shaders.GL_FRAGMENT_SHADER))
+            program = glCreateProgram()
+            glAttachShader(program, shaders.compileShader(vertex_shader_source, shaders.GL_VERTEX_SHADER))
+            glAttachShader(program, shaders.compileShader(self.fragment_shader_source, shaders.GL_FRAGMENT_SHADER))
 
             #self.program = shaders.compileProgram(
             #    shaders.compileShader(self.vertex_shader_source, shaders.GL_VERTEX_SHADER),
@@ -172,16 +499,60 @@ class BaseShaderProgram:
             print('(E) An error occured while compiling {} shader:\n {}\n... forwarding exception...'.format(self.name, error)),
             raise error
 
+        self.program = program
         self.bindAttributes(attributes)
 
-        glLinkProgram(self.program)
+        # allow the linked program to be saved in the program binary cache
+        if program_binary_cache is not None and program_binary_supported():
+            glProgramParameteri(program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
 
-        # tell OpenGL to use this shader program for rendering
-        glUseProgram(self.program)
+        glLinkProgram(program)
+        program_blocks[program] = link_uniform_blocks(program)
+
+        programs[key] = program
+        save_program_binary(key, program)
+        return program
+
+    def use_program(self, program):
+        '''
+        Sets the program used by this shader, and links all uniforms to it.
+        '''
+        self.program = program
+        gl_state.use_program(self.program)
+
+        # the fields of the uniform blocks are not set as uniforms
+        self.blocks = program_blocks.get(program, set())
+        block_fields = [field for block in self.blocks for field, type in uniform_blocks[block][1]]
 
-        # link all uniforms
         for uniform in self.uniforms:
-            self.uniforms[uniform].link(self.program)
+            if uniform not in block_fields:
+                self.uniforms[uniform].link(self.program)
+
+    def select_layers(self, layer_PV=None):
+        '''
+        Selects the program used for rendering. If layer_PV is given, the layered variant of the program is used, to
+        render the model to all the layers of the framebuffer at once using instancing (see layered_vertex_shader()).
+        Otherwise, the normal program is used.
+        :param layer_PV: None, or an array holding the projection-view matrix of each layer
+        :return: The number of instances to draw
+        '''
+        if layer_PV is None:
+            if self.layers > 1:
+                self.use_program(self.default_program)
+                self.layers = 1
+            return 1
+
+        if self.layered_program is None:
+            source = layered_vertex_shader(self.vertex_shader_source, len(layer_PV))
+            if source is None:
+                raise RuntimeError('Shader {} does not support layered rendering'.format(self.name))
+            self.layered_program = self.link_program(source, self.attributes)
+
+        self.use_program(self.layered_program)
+        self.layer_uniform.link(self.program)
+        self.layer_uniform.bind_matrix(layer_PV, number=len(layer_PV))
+        self.layers = len(layer_PV)
+        return self.layers
 
     def bindAttributes(self, attributes):
         # bind all shader attributes to the correct locations in the VAO
@@ -195,13 +566,18 @@ class BaseShaderProgram:
         '''
 
         # tell OpenGL to use this shader program for rendering
-        glUseProgram(self.program)
-
-        P = model.scene.P
-        V = model.scene.camera.V
+        gl_state.use_program(self.program)
 
         # set the PVM matrix uniform
-        self.uniforms['PVM'].bind(np.matmul(P, np.matmul(V, M)))
+        PVM, VM, VMiT = model.view_transforms(model.scene.frame_context(), M, normals=False)
+        self.uniforms['PVM'].bind(PVM)
+
+    def bind_material(self, material, textures):
+        '''
+        Binds the properties of a material, for models drawing parts with different materials after bind() (see
+        staticBatch.py). This program does not use materials.
+        '''
+        pass
 
 
 class PhongShader(BaseShaderProgram):
@@ -244,49 +620,61 @@ class PhongShader(BaseShaderProgram):
         Call this function to enable this GLSL Program (you can have multiple GLSL programs used during rendering!)
         '''
 
-        P = model.scene.P
-        V = model.scene.camera.V
+        # the values shared by all models drawn with the same projection, view and light
+        context = model.scene.frame_context()
 
         # tell OpenGL to use this shader program for rendering
-        glUseProgram(self.program)
+        gl_state.use_program(self.program)
+
+        PVM, VM, VMiT = model.view_transforms(context, M)
 
         # set the PVM matrix uniform
-        self.uniforms['PVM'].bind(np.matmul(P, np.matmul(V, M)))
+        self.uniforms['PVM'].bind(PVM)
 
         # set the PVM matrix uniform
-        self.uniforms['VM'].bind(np.matmul(V, M))
+        self.uniforms['VM'].bind(VM)
 
         # set the PVM matrix uniform
-        self.uniforms['VMiT'].bind(np.linalg.inv(np.matmul(V, M))[:3, :3].transpose())
+        self.uniforms['VMiT'].bind(VMiT)
 
         # bind the mode to the program
         self.uniforms['mode'].bind(model.scene.mode)
 
-        self.uniforms['alpha'].bind(model.mesh.material.alpha)
+        self.bind_material(model.mesh.material, model.mesh.textures)
+
+        # bind the light properties, the Frame block is bound by the context
+        if 'Frame' not in self.blocks:
+            self.bind_light_uniforms(model.scene.light, context)
 
-        if len(model.mesh.textures) > 0:
+    def bind_material(self, material, textures):
+        '''
+        Binds the material properties, and tells the program whether the material has a texture (the textures
+        themselves are bound by the model).
+        '''
+        if len(textures) > 0:
             # bind the texture(s)
             self.uniforms['textureObject'].bind(0)
             self.uniforms['has_texture'].bind(1)
         else:
             self.uniforms['has_texture'].bind(0)
 
-        # bind material properties
-        self.bind_material_uniforms(model.mesh.material)
-
-        # bind the light properties
-        self.bind_light_uniforms(model.scene.light, V)
+        # bind material properties, from the block of the material if the program declares it
+        if 'Material' in self.blocks:
+            material_block(material).bind()
+        else:
+            self.uniforms['alpha'].bind(material.alpha)
+            self.bind_material_uniforms(material)
 
-    def bind_light_uniforms(self, light, V):
-        self.uniforms['light'].bind_vector(unhomog(np.dot(V, homog(light.position))))
-        self.uniforms['Ia'].bind_vector(np.array(light.Ia, 'f'))
-        self.uniforms['Id'].bind_vector(np.array(light.Id, 'f'))
-        self.uniforms['Is'].bind_vector(np.array(light.Is, 'f'))
+    def bind_light_uniforms(self, light, context):
+        self.uniforms['light'].bind_vector(context.light_position)
+        self.uniforms['Ia'].bind_vector(light.Ia)
+        self.uniforms['Id'].bind_vector(light.Id)
+        self.uniforms['Is'].bind_vector(light.Is)
 
     def bind_material_uniforms(self, material):
-        self.uniforms['Ka'].bind_vector(np.array(material.Ka, 'f'))
-        self.uniforms['Kd'].bind_vector(np.array(material.Kd, 'f'))
-        self.uniforms['Ks'].bind_vector(np.array(material.Ks, 'f'))
+        self.uniforms['Ka'].bind_vector(material.Ka)
+        self.uniforms['Kd'].bind_vector(material.Kd)
+        self.uniforms['Ks'].bind_vector(material.Ks)
         self.uniforms['Ns'].bind_float(material.Ns)
 
     def add_uniform(self, name):
@@ -295,7 +683,16 @@ class PhongShader(BaseShaderProgram):
         self.uniforms[name] = Uniform(name)
 
     def unbind(self):
-        glUseProgram(0)
+        gl_state.use_program(0)
+
+
+class InstancedPhongShader(PhongShader):
+    '''
+    Variant of the Phong shader for instanced models (see InstancedModel), which reads the model matrix and the
+    colour of each instance from the instance attributes.
+    '''
+    def __init__(self, name='phong_instanced'):
+        PhongShader.__init__(self, name=name)
 
 
 class FlatShader(PhongShader):
@@ -346,10 +743,8 @@ class MaxBrightnessShader(BaseShaderProgram):
 
     def bind(self, model, M):
         # tell OpenGL to use this shader program for rendering
-        glUseProgram(self.program)
-
-        P = model.scene.P
-        V = model.scene.camera.V
+        gl_state.use_program(self.program)
 
         # set the PVM matrix uniform
-        self.uniforms['PVM'].bind(np.matmul(P, np.matmul(V, M)))
\ No newline at end of file
+        PVM, VM, VMiT = model.view_transforms(model.scene.frame_context(), M, normals=False)
+        self.uniforms['PVM'].bind(PVM)
\ No newline at end of file
@@ -0,0 +1,5 @@
+#version 130
+
+// nothing to do here: the depth of each fragment is written to the depth buffer by OpenGL
+void main() {
+}
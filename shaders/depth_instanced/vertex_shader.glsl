@@ -0,0 +1,14 @@
+#version 130
+
+//=== in attributes are read from the vertex array, one row per instance of the shader
+in vec3 position;	// the position attribute contains the vertex position
+
+//=== instance attributes are read from the instance array, one row per instance of the model (see InstancedModel)
+in mat4 instance_M;     // the model matrix of the instance, applied before the model matrix of the model
+
+uniform mat4 PVM; 	// the Perspective-View-Model matrix of the light
+
+void main() {
+    // only the depth is rendered, so we just need to transform the position
+    gl_Position = PVM * instance_M * vec4(position, 1.0f);
+}
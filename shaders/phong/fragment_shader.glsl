@@ -1,4 +1,5 @@
 # version 130 // required to use OpenGL core standard
+#extension GL_ARB_uniform_buffer_object : require
 
 //=== 'in' attributes are passed on from the vertex shader's 'out' attributes, and interpolated for each fragment
 in vec3 fragment_color;        // the fragment colour
@@ -14,19 +15,23 @@ uniform int mode;	// the rendering mode (better to code different shaders!)
 uniform int has_texture;
 uniform sampler2D textureObject; // texture object
 
-// material uniforms
-uniform vec3 Ka;    // ambient reflection properties of the material
-uniform vec3 Kd;    // diffuse reflection propoerties of the material
-uniform vec3 Ks;    // specular properties of the material
-uniform float Ns;   // specular exponent
+// material properties, from the uniform block of the material (see shaders.uniform_blocks)
+layout(std140) uniform Material {
+    vec3 Ka;        // ambient reflection properties of the material
+    vec3 Kd;        // diffuse reflection propoerties of the material
+    vec3 Ks;        // specular properties of the material
+    float Ns;       // specular exponent
+    float alpha;
+};
 
-// light source
-uniform vec3 light; // light position in view space
-uniform vec3 Ia;    // ambient light properties
-uniform vec3 Id;    // diffuse properties of the light source
-uniform vec3 Is;    // specular properties of the light source
-
-uniform float alpha = 1.0f;
+// view and light source, from the uniform block of the frame
+layout(std140) uniform Frame {
+    mat4 V;         // the view matrix
+    vec3 light;     // light position in view space
+    vec3 Ia;        // ambient light properties
+    vec3 Id;        // diffuse properties of the light source
+    vec3 Is;        // specular properties of the light source
+};
 
 ///=== main shader code
 void main() {
@@ -1,4 +1,5 @@
 # version 130 // required to use OpenGL core standard
+#extension GL_ARB_uniform_buffer_object : require
 
 //=== 'in' attributes are passed on from the vertex shader's 'out' attributes, and interpolated for each fragment
 in vec3 fragment_color;        // the fragment colour
@@ -14,25 +15,36 @@ uniform int mode;	// the rendering mode (better to code different shaders!)
 uniform int has_texture;
 uniform sampler2D textureObject; // texture object
 uniform sampler2DShadow shadow_map;
+
+// cascaded shadow maps: the number of cascades (0 when using the single shadow map), the texture array holding one
+// cascade per layer, and for each cascade its shadow map matrix and the distance to the camera where it ends
+uniform int cascades = 0;
+uniform sampler2DArrayShadow shadow_cascades;
+uniform mat4 cascade_matrices[4];
+uniform vec4 cascade_ends;
 //uniform sampler2D old_map;
 
 // shadow map matrix
 // this shadow map matrix times the fragment shader position allows looking up the depth in the shadow map texture
 uniform mat4 shadow_map_matrix;
 
-// material uniforms
-uniform vec3 Ka;    // ambient reflection properties of the material
-uniform vec3 Kd;    // diffuse reflection propoerties of the material
-uniform vec3 Ks;    // specular properties of the material
-uniform float Ns;   // specular exponent
-
-// light source
-uniform vec3 light; // light position in view space
-uniform vec3 Ia;    // ambient light properties
-uniform vec3 Id;    // diffuse properties of the light source
-uniform vec3 Is;    // specular properties of the light source
-
-uniform float alpha = 1.0f;
+// material properties, from the uniform block of the material (see shaders.uniform_blocks)
+layout(std140) uniform Material {
+    vec3 Ka;        // ambient reflection properties of the material
+    vec3 Kd;        // diffuse reflection propoerties of the material
+    vec3 Ks;        // specular properties of the material
+    float Ns;       // specular exponent
+    float alpha;
+};
+
+// view and light source, from the uniform block of the frame
+layout(std140) uniform Frame {
+    mat4 V;         // the view matrix
+    vec3 light;     // light position in view space
+    vec3 Ia;        // ambient light properties
+    vec3 Id;        // diffuse properties of the light source
+    vec3 Is;        // specular properties of the light source
+};
 
 
 vec4 phong(vec4 texval);
@@ -74,6 +86,22 @@ void main() {
 
     final_color = phong(texval);
 
+    if (cascades > 0)
+    {
+        // the fragment uses the first cascade ending after it, and is not shadowed past the last one
+        int cascade = int(dot(step(cascade_ends, vec4(-position_view_space.z)), vec4(1.0f)));
+        if (cascade < cascades)
+        {
+            vec4 p = cascade_matrices[cascade]*vec4(position_view_space, 1);
+            p.xyz /= p.w;
+            p.z *= 0.999;
+
+            float val = texture(shadow_cascades, vec4(p.xy, cascade, p.z));
+            final_color.xyz = (1.0-val)*Ka*Ia*texval.xyz + val*final_color.xyz;
+        }
+        return;
+    }
+
     vec4 p = shadow_map_matrix*vec4(position_view_space, 1);
 
     //float zlight = texture(old_map, p.xy/p.w).r;
@@ -0,0 +1,165 @@
+# version 130 // required to use OpenGL core standard
+#extension GL_ARB_uniform_buffer_object : require
+
+//=== 'in' attributes are passed on from the vertex shader's 'out' attributes, and interpolated for each fragment
+in vec3 fragment_color;        // the fragment colour
+in vec3 position_view_space;   // the position in view coordinates of this fragment
+in vec3 normal_view_space;     // the normal in view coordinates to this fragment
+in vec2 fragment_texCoord;
+in vec4 fragment_instance_color; // the colour of the instance (see InstancedModel)
+
+//=== 'out' attributes are the output image, usually only one for the colour of each pixel
+out vec4 final_color;
+
+//=== uniforms
+uniform int mode;	// the rendering mode (better to code different shaders!)
+uniform int has_texture;
+uniform sampler2D textureObject; // texture object
+uniform sampler2DShadow shadow_map;
+
+// cascaded shadow maps: the number of cascades (0 when using the single shadow map), the texture array holding one
+// cascade per layer, and for each cascade its shadow map matrix and the distance to the camera where it ends
+uniform int cascades = 0;
+uniform sampler2DArrayShadow shadow_cascades;
+uniform mat4 cascade_matrices[4];
+uniform vec4 cascade_ends;
+//uniform sampler2D old_map;
+
+// shadow map matrix
+// this shadow map matrix times the fragment shader position allows looking up the depth in the shadow map texture
+uniform mat4 shadow_map_matrix;
+
+// material properties, from the uniform block of the material (see shaders.uniform_blocks)
+layout(std140) uniform Material {
+    vec3 Ka;        // ambient reflection properties of the material
+    vec3 Kd;        // diffuse reflection propoerties of the material
+    vec3 Ks;        // specular properties of the material
+    float Ns;       // specular exponent
+    float alpha;
+};
+
+// view and light source, from the uniform block of the frame
+layout(std140) uniform Frame {
+    mat4 V;         // the view matrix
+    vec3 light;     // light position in view space
+    vec3 Ia;        // ambient light properties
+    vec3 Id;        // diffuse properties of the light source
+    vec3 Is;        // specular properties of the light source
+};
+
+
+vec4 phong(vec4 texval);
+
+vec4 phong(vec4 texval) {
+        // 1. calculate vectors used for shading calculations
+    // TODO WS4
+    vec3 camera_direction = -normalize(position_view_space);
+    vec3 light_direction = normalize(light-position_view_space);
+
+    // 2. now we calculate light components
+    // TODO WS4
+    vec4 ambient = vec4(Ia*Ka,alpha);
+    vec4 diffuse = vec4(Id*Kd*max(0.0f,dot(light_direction, normal_view_space)), alpha);
+    vec4 specular = vec4(Is*Ks*pow(max(0.0f, dot(reflect(light_direction, normal_view_space), -camera_direction)), Ns), alpha);
+
+    // 3. we calculate the attenuation function
+    // in this formula, dist should be the distance between the surface and the light
+    float dist = length(light - position_view_space);
+    float attenuation =  min(1.0/(dist*dist*0.005) + 1.0/(dist*0.05), 1.0);
+
+    // 5. Finally, we combine the shading components
+    return texval*ambient + attenuation*(texval*diffuse + specular);
+}
+
+///=== main shader code
+void main() {
+
+    // 4. we sample from the texture map
+    // the texture2D function just samples from the texture object at coordinates set by fragment_texCoord
+    // using interpolation/extrapolation as set in the OpenGL program
+    vec4 texval = vec4(1.0f);
+    if(has_texture == 1)
+        texval = texture2D(textureObject, fragment_texCoord);
+
+    // the colour of the instance tints the texture, or the material if there is no texture
+    texval *= fragment_instance_color;
+
+    final_color = vec4(0.0f);
+
+    // 5. Finally, we combine the shading components
+
+    final_color = phong(texval);
+
+    if (cascades > 0)
+    {
+        // the fragment uses the first cascade ending after it, and is not shadowed past the last one
+        int cascade = int(dot(step(cascade_ends, vec4(-position_view_space.z)), vec4(1.0f)));
+        if (cascade < cascades)
+        {
+            vec4 p = cascade_matrices[cascade]*vec4(position_view_space, 1);
+            p.xyz /= p.w;
+            p.z *= 0.999;
+
+            float val = texture(shadow_cascades, vec4(p.xy, cascade, p.z));
+            final_color.xyz = (1.0-val)*Ka*Ia*texval.xyz + val*final_color.xyz;
+        }
+        return;
+    }
+
+    vec4 p = shadow_map_matrix*vec4(position_view_space, 1);
+
+    //float zlight = texture(old_map, p.xy/p.w).r;
+
+    //if( zlight > -p.z/p.w )
+     //  final_color=vec4(0,0,0,0);
+
+    //final_color = vec4( 0, p.z/p.w/10, 0, 1.0f );
+
+    /*
+    if(p.z/p.w < 0)
+        final_color.x = 1.0;
+    else
+        if(p.z/p.w > 1)
+            final_color.z = 1.0;
+        else
+            final_color.y = p.z/p.w;
+
+    if(zlight < 1.01*p.z/p.w)
+        final_color = vec4(0);
+*/
+
+	if (p.w > 0)
+	{
+		p.xyz /= p.w;
+
+		//p.xyz = -p.xyz*0.5 + 0.5;
+
+		p.z *= 0.999;
+
+		// this is another alternative that also works:
+		//p.z -= 0.01;
+
+		float val = texture(shadow_map, p.xyz);
+        //if (val < 0.5f)
+		//	final_color.xyz = Ka*Ia*texval.xyz; //
+        final_color.xyz = (1.0-val)*Ka*Ia*texval.xyz + val*final_color.xyz;
+
+        //if (p.z > 0.9)
+         //   final_color.xyz = Ka*Ia*texval.xyz;
+
+        //final_color = vec4(p.z, 0.0f, 0.0f, 1.0f);
+        //final_color = vec4(texture(old_map, p.xy).r, 0.0f, 0.0f, 1.0f);
+        //final_color = vec4(-p.z, 0.0f, 0.0f, 1.0f);
+	}
+    //*/
+
+    //final_color.xyz = Ka*Ia*texval.xyz; //
+    //final_color = p;
+
+    //final_color = vec4( p.w/100, 0, 0, 1.0f );
+    //final_color = vec4( 0, texture(shadow_map,p.xyz), 0, 1.0f );
+    //final_color = vec4( 0, length(p)/100, 0, 1.0f );
+
+}
+
+
@@ -0,0 +1,39 @@
+#version 130		// required to use OpenGL core standard
+
+//=== in attributes are read from the vertex array, one row per instance of the shader
+in vec3 position;	// the position attribute contains the vertex position
+in vec3 normal;		// store the vertex normal
+in vec2 texCoord;
+
+//=== instance attributes are read from the instance array, one row per instance of the model (see InstancedModel)
+in mat4 instance_M;     // the model matrix of the instance, applied before the model matrix of the model
+in vec4 instance_color; // the colour of the instance, multiplying the texture
+
+//=== out attributes are interpolated on the face, and passed on to the fragment shader
+out vec3 position_view_space;   // the position of the vertex in view coordinates
+out vec3 normal_view_space;     // the normal of the vertex in view coordinates
+out vec2 fragment_texCoord;
+out vec4 fragment_instance_color;
+
+//=== uniforms
+uniform mat4 PVM; 	// the Perspective-View-Model matrix is received as a Uniform
+uniform mat4 VM; 	// the View-Model matrix is received as a Uniform
+uniform mat3 VMiT;  // The inverse-transpose of the view model matrix, used for normals
+uniform int mode;	// the rendering mode (better to code different shaders!)
+
+
+void main() {
+    // 1. first, we transform the position using PVM matrix and the matrix of the instance.
+    gl_Position = PVM * instance_M * vec4(position, 1.0f);
+
+    // 2. calculate vectors used for shading calculations. The normals are transformed by the cofactor matrix of
+    // the instance, which is its inverse-transpose times its determinant, as they are normalized anyway.
+    mat3 m = mat3(instance_M);
+    mat3 cofactor = mat3(cross(m[1], m[2]), cross(m[2], m[0]), cross(m[0], m[1]));
+    position_view_space = vec3(VM*instance_M*vec4(position,1.0f));
+    normal_view_space = normalize(VMiT*(sign(dot(m[0], cofactor[0]))*cofactor*normal));
+
+    // 3. forward the texture coordinates and the colour of the instance.
+    fragment_texCoord = texCoord;
+    fragment_instance_color = instance_color;
+}
@@ -3,8 +3,7 @@
 //=== in attributes are read from the vertex array, one row per instance of the shader
 in vec3 position;	// the position attribute contains the vertex position
 in vec3 normal;		// store the vertex normal
-in vec3 tangent;
-in vec3 binormal;
+in vec4 tangent;	// the tangent, with the sign of the binormal in w: binormal = tangent.w * cross(normal, tangent.xyz)
 in vec3 color; 		// store the vertex colour
 in vec2 texCoord;
 
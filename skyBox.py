@@ -11,17 +11,6 @@ class SkyBoxShader(BaseShaderProgram):
         BaseShaderProgram.__init__(self, name=name)
         self.add_uniform('sampler_cube')
 
-    def bind(self, model, M):
-        BaseShaderProgram.bind(self, model, M)
-        P = model.scene.P  # get projection matrix from the scene
-        V = model.scene.camera.V  # get view matrix from the camera
-        Vr = np.identity(4)
-        Vr[:3, :3] = V[:3, :3]
-
-        self.uniforms['PVM'].bind(np.matmul(P, np.matmul(V, M)))
-        #self.uniforms['PVM'].bind(np.matmul(V, M))
-
-
 
 class SkyBox(DrawModelFromMesh):
     def __init__(self, scene):
@@ -29,6 +18,9 @@ class SkyBox(DrawModelFromMesh):
                                    mesh=CubeMesh(texture=CubeMap(name='skybox/ame_ash'), inside=True),
                                    shader=SkyBoxShader(), name='skybox')
 
+        # drawn after the other models when in the same render queue (see ExeterScene.draw_reflections())
+        self.render_pass = 1
+
     def draw(self):
         glDepthMask(GL_FALSE)
         DrawModelFromMesh.draw(self)
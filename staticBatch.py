@@ -0,0 +1,168 @@
+import ctypes
+
+# imports all openGL functions
+from OpenGL.GL import *
+
+import numpy as np
+
+from BaseModel import BaseModel, no_parent
+from mesh import Mesh
+from renderQueue import gl_state
+from texture import texture_manager
+
+
+class StaticBatch(BaseModel):
+    '''
+    Merges meshes drawn with the same shader and model matrix (eg, the static parts of a scene) into a single model,
+    with one vertex and index buffer. The meshes keep their own indices, offset by a base vertex when drawing, and the
+    meshes with the same material and textures are drawn together with one multi-draw call.
+    '''
+
+    # the vertex attributes of the meshes, as named in Mesh, and their number of components
+    attributes_size = {'normals': 3, 'colors': 3, 'textureCoords': 2, 'tangents': 3, 'binormals': 3}
+
+    def __init__(self, scene, M, meshes, shader, name=None, visible=True, layout=None):
+        '''
+        :param meshes: The list of meshes to merge, all made of triangles
+        :param shader: The shader of all the meshes. Its bind_material() method is called before drawing each group
+        of meshes with a different material.
+        '''
+        BaseModel.__init__(self, scene=scene, M=M, mesh=merge_meshes(meshes), visible=visible, layout=layout)
+
+        if name is not None:
+            self.name = name
+
+        # the range of each mesh in the buffers: number of indices, offset in the index buffer in bytes and base vertex
+        index_size = self.mesh.faces.itemsize
+        counts = np.array([mesh.faces.size for mesh in meshes], dtype=np.int32)
+        offsets = np.cumsum([0] + [count * index_size for count in counts[:-1]]).astype(np.uintp)
+        base_vertices = np.cumsum([0] + [mesh.vertices.shape[0] for mesh in meshes[:-1]]).astype(np.int32)
+        self.ranges = (counts, offsets, base_vertices)
+
+        # the name of the material of each mesh, to tell which part of the batch was picked (see part_name())
+        self.part_names = [mesh.material.name for mesh in meshes]
+
+        # the meshes with identical materials and textures are drawn together, the list holds the material, textures
+        # and ranges of each group
+        groups = {}
+        for index, mesh in enumerate(meshes):
+            material = mesh.material
+            key = (tuple(material.Ka), tuple(material.Kd), tuple(material.Ks), material.Ns, material.alpha,
+                   tuple(texture.textureid for texture in mesh.textures))
+            groups.setdefault(key, (mesh, []))[1].append(index)
+        self.groups = [(mesh.material, mesh.textures, tuple(array[indices] for array in self.ranges))
+                       for mesh, indices in groups.values()]
+
+        # the merged mesh uses the material of the first group, for the shaders binding the material of the mesh
+        self.mesh.material, self.mesh.textures = self.groups[0][0], self.groups[0][1]
+
+        # the batch takes over the textures of the meshes, with a single reference to each texture (see
+        # TextureManager), released by vbo__del__(): the references of the meshes sharing a texture are released
+        self.textures = []
+        for mesh in meshes:
+            for texture in mesh.textures:
+                if any(texture is other for other in self.textures):
+                    texture_manager.release(texture)
+                else:
+                    self.textures.append(texture)
+
+        print('Batched {} meshes with {} vertices in {} draw groups'.format(
+            len(meshes), self.mesh.vertices.shape[0], len(self.groups)))
+
+        self.bind()
+        self.bind_shader(shader)
+
+    def draw(self, Mp=no_parent):
+        '''
+        Draws all the meshes of the batch, with one draw call per group of meshes sharing a material.
+        :param Mp: The model matrix of the parent object, for composite objects.
+        '''
+        if self.visible:
+            gl_state.bind_vertex_array(self.vao)
+
+            # use the layered variant of the shader when rendering to all layers of a framebuffer at once
+            instances = self.shader.select_layers(self.scene.layer_PV)
+
+            self.shader.bind(model=self, M=self.world_matrix(Mp))
+            for material, textures, ranges in self.groups:
+                self.shader.bind_material(material, textures)
+                for unit, tex in enumerate(textures):
+                    tex.bind(unit)
+                self.draw_ranges(ranges, instances)
+
+    def draw_primitives(self, instances=1):
+        '''
+        Draws all the meshes at once, eg for rendering their depth.
+        '''
+        self.draw_ranges(self.ranges, instances)
+
+    def triangles(self):
+        '''
+        Returns the triangles of the meshes, with the indices offset by the base vertex of their mesh.
+        '''
+        counts, offsets, base_vertices = self.ranges
+        return self.mesh.faces.astype(np.int64) + np.repeat(base_vertices, counts // 3)[:, None]
+
+    def part_name(self, triangle):
+        '''
+        Returns the name of the material of the mesh holding a triangle, as the meshes are not named.
+        '''
+        counts = self.ranges[0]
+        return self.part_names[np.searchsorted(np.cumsum(counts // 3), triangle, side='right')]
+
+    def vbo__del__(self):
+        '''
+        Releases the buffers, and the textures of all the groups rather than only those of the merged mesh.
+        '''
+        self.mesh.textures = self.textures
+        BaseModel.vbo__del__(self)
+
+    def draw_ranges(self, ranges, instances=1):
+        '''
+        Issues the draw calls for ranges of the buffers, once the VAO and shader are bound.
+        :param ranges: A tuple of arrays (number of indices, offset in the index buffer, base vertex)
+        :param instances: The number of instances to draw, eg for layered rendering
+        '''
+        counts, offsets, base_vertices = ranges
+        if instances > 1:
+            # there is no instanced multi-draw call, the ranges are drawn one by one
+            for count, offset, base_vertex in zip(counts, offsets, base_vertices):
+                glDrawElementsInstancedBaseVertex(self.primitive, int(count), self.index_type(),
+                                                  ctypes.c_void_p(int(offset)), instances, int(base_vertex))
+        else:
+            glMultiDrawElementsBaseVertex(self.primitive, counts, self.index_type(), offsets, len(counts), base_vertices)
+
+
+def merge_meshes(meshes):
+    '''
+    Concatenates the vertex attributes and indices of meshes, without offsetting the indices (see StaticBatch).
+    Attributes missing in some of the meshes are set to 0 for these meshes.
+    :param meshes: A list of Mesh objects, all made of triangles
+    :return: A Mesh object
+    '''
+    if len(meshes) == 0:
+        raise ValueError('No mesh to merge')
+    if any(mesh.faces is None or mesh.faces.shape[1] != 3 for mesh in meshes):
+        raise ValueError('Only meshes made of indexed triangles can be merged')
+
+    # the indices are kept on 16 bits if possible
+    index_type = np.uint16 if all(mesh.faces.dtype == np.uint16 for mesh in meshes) else np.uint32
+
+    # the normals are merged below with the other attributes, they cannot be calculated from the merged faces
+    merged = Mesh(vertices=np.concatenate([mesh.vertices for mesh in meshes]).astype('f'),
+                  faces=np.concatenate([mesh.faces for mesh in meshes]).astype(index_type),
+                  normals=np.zeros((0, 3), 'f'))
+
+    for name, size in StaticBatch.attributes_size.items():
+        arrays = [getattr(mesh, name) for mesh in meshes]
+        if all(array is None for array in arrays):
+            setattr(merged, name, None)
+            continue
+        if any(array is None for array in arrays):
+            print('(W) Warning in merge_meshes(): some meshes have no {}, set to 0'.format(name))
+        setattr(merged, name, np.concatenate([
+            array if array is not None else np.zeros((mesh.vertices.shape[0], size), 'f')
+            for mesh, array in zip(meshes, arrays)]).astype('f'))
+
+    merged.name = meshes[0].name
+    return merged
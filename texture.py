@@ -2,38 +2,153 @@ import pygame
 from OpenGL.GL import *
 import numpy as np
 
+from renderQueue import gl_state
+
+
+def decode_image(name):
+    '''
+    Decodes an image from the textures folder to a numpy array of RGBA pixels, with the rows in OpenGL order
+    (bottom to top). This function does not use OpenGL, so it can run in a worker process (see assetLoader.py).
+    :param name: The name of the image file, relative to the textures folder
+    :return: A (height, width, 4) array of bytes
+    '''
+    img = pygame.image.load('./textures/{}'.format(name))
+    pixels = np.frombuffer(pygame.image.tostring(img, "RGBA", 1), dtype=np.uint8)
+    return pixels.reshape((img.get_height(), img.get_width(), 4))
+
+
+def mip_chain(pixels):
+    '''
+    Builds the mipmap chain of an image on the CPU, using a box filter: each level averages blocks of 2x2 pixels of
+    the previous one, until the image is a single pixel. This function does not use OpenGL, so it can run in a
+    worker process (see assetLoader.py).
+    :param pixels: A (height, width, channels) array of bytes
+    :return: The list of levels, starting with the image itself
+    '''
+    levels = [pixels]
+    while levels[-1].shape[0] > 1 or levels[-1].shape[1] > 1:
+        level = levels[-1].astype(np.float32)
+
+        # OpenGL rounds odd sizes down, so the last row or column of odd sized levels is dropped
+        height = level.shape[0] // 2 * 2
+        width = level.shape[1] // 2 * 2
+        if height > 0:
+            level = 0.5 * (level[0:height:2] + level[1:height:2])
+        if width > 0:
+            level = 0.5 * (level[:, 0:width:2] + level[:, 1:width:2])
+
+        levels.append((level + 0.5).astype(np.uint8))
+
+    return levels
+
+
+# whether the driver supports anisotropic filtering, checked once by anisotropic_filtering_supported()
+anisotropic_filtering_support = None
+
+
+def anisotropic_filtering_supported():
+    '''
+    Checks whether the OpenGL driver supports anisotropic filtering, which is core since OpenGL 4.6 and an extension
+    (EXT or ARB_texture_filter_anisotropic) before. Without it, textures are created without anisotropic filtering.
+    '''
+    global anisotropic_filtering_support
+    if anisotropic_filtering_support is None:
+        version = (glGetIntegerv(GL_MAJOR_VERSION), glGetIntegerv(GL_MINOR_VERSION))
+        extensions = [glGetStringi(GL_EXTENSIONS, i).decode() for i in range(glGetIntegerv(GL_NUM_EXTENSIONS))]
+        anisotropic_filtering_support = version >= (4, 6) or 'GL_EXT_texture_filter_anisotropic' in extensions \
+            or 'GL_ARB_texture_filter_anisotropic' in extensions
+        if not anisotropic_filtering_support:
+            print('(W) Warning, anisotropic filtering not supported by the driver, textures are not filtered anisotropically')
+    return anisotropic_filtering_support
+
 
 class ImageWrapper:
-    def __init__(self, name):
+    # images that were already decoded by name, eg by the asset loader. Each entry is the list of mipmap levels of the
+    # image, starting with the full image (see mip_chain()), or only the full image if the levels were not computed.
+    decoded = {}
+
+    def __init__(self, name, levels=None):
+        '''
+        :param name: The name of the image file, relative to the textures folder
+        :param levels: The mipmap levels of the image if they were already computed, see mip_chain()
+        '''
+        if levels is None:
+            levels = ImageWrapper.decoded.get(name)
+        if levels is not None:
+            self.img = None
+            self.levels = levels
+            self.pixels = self.levels[0]
+            return
+
         # load the image from file using pyGame - any other image reading function could be used here.
         print('Loading image: texture/{}'.format(name))
         self.img = pygame.image.load('./textures/{}'.format(name))
+        self.pixels = None
+        self.levels = None
 
     def width(self):
+        if self.pixels is not None:
+            return self.pixels.shape[1]
         return self.img.get_width()
 
     def height(self):
+        if self.pixels is not None:
+            return self.pixels.shape[0]
         return self.img.get_height()
 
     def data(self, format=GL_RGB):
+        if self.pixels is not None:
+            if format == GL_RGBA:
+                return self.pixels
+            elif format == GL_RGB:
+                return np.ascontiguousarray(self.pixels[:, :, :3])
+
         # convert the python image object to a plain byte array for passsing to OpenGL
         if format == GL_RGBA:
             return pygame.image.tostring(self.img, "RGBA", 1)
         elif format == GL_RGB:
             return pygame.image.tostring(self.img, "RGB", 1)
 
+    def mipmaps(self, format=GL_RGB):
+        '''
+        Returns the mipmap levels of the image, computing them if they were not decoded with the image.
+        '''
+        if self.levels is None or len(self.levels) == 1:
+            if self.pixels is None:
+                self.pixels = np.frombuffer(pygame.image.tostring(self.img, "RGBA", 1), dtype=np.uint8).reshape((self.height(), self.width(), 4))
+            self.levels = mip_chain(self.pixels)
+
+        if format == GL_RGB:
+            return [np.ascontiguousarray(level[:, :, :3]) for level in self.levels]
+        return self.levels
+
 
 class Texture:
     '''
     Class to handle texture loading.
     '''
-    def __init__(self, name, img=None, wrap=GL_REPEAT, sample=GL_NEAREST, format=GL_RGBA, type=GL_UNSIGNED_BYTE, target=GL_TEXTURE_2D):
+    # defaults for the subclasses that do not call Texture.__init__()
+    mipmap = None
+    anisotropy = 1.0
+
+    def __init__(self, name, img=None, wrap=GL_REPEAT, sample=GL_NEAREST, format=GL_RGBA, type=GL_UNSIGNED_BYTE, target=GL_TEXTURE_2D, mipmap=None, anisotropy=1.0, levels=None):
+        '''
+        :param mipmap: How to create the mipmaps of the texture: None for no mipmaps, 'cpu' to compute them with a box
+        filter on the CPU (see mip_chain()), or 'gpu' to let OpenGL compute them with glGenerateMipmap().
+        With mipmaps, sampling uses trilinear filtering if sample is GL_LINEAR.
+        :param anisotropy: The maximum anisotropy for anisotropic filtering, 1 to disable it. It is ignored if the driver
+        does not support anisotropic filtering.
+        :param levels: The mipmap levels of the image if they were already computed (see TextureManager), so that they
+        are not computed again.
+        '''
         self.name = name
         self.format = format
         self.type = type
         self.wrap = wrap
         self.sample = sample
         self.target = target
+        self.mipmap = mipmap
+        self.anisotropy = anisotropy
 
         self.textureid = glGenTextures(1)
 
@@ -42,14 +157,28 @@ class Texture:
         self.bind()
 
         if img is None:
-            img = ImageWrapper(name)
+            img = ImageWrapper(name, levels)
+
+            # the rows of the images are tightly packed, while OpenGL expects them to start on 4 bytes boundaries
+            # by default, which is not the case for GL_RGB levels whose width is not a multiple of 4
+            alignment = glGetIntegerv(GL_UNPACK_ALIGNMENT)
+            glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
 
             # load the texture in the buffer
-            glTexImage2D(self.target, 0, format, img.width(), img.height(), 0, format, type, img.data(format))
+            if mipmap == 'cpu':
+                for level, data in enumerate(img.mipmaps(format)):
+                    glTexImage2D(self.target, level, format, data.shape[1], data.shape[0], 0, format, type, data)
+            else:
+                glTexImage2D(self.target, 0, format, img.width(), img.height(), 0, format, type, img.data(format))
+            glPixelStorei(GL_UNPACK_ALIGNMENT, alignment)
+            generate_mipmap = mipmap == 'gpu'
         else:
-            # if a data array is provided use this
+            # if a data array is provided use this, its mipmaps are always generated by OpenGL
             glTexImage2D(self.target, 0, format, img.shape[0], img.shape[1], 0, format, type, img)
+            generate_mipmap = mipmap is not None
 
+        if generate_mipmap:
+            glGenerateMipmap(self.target)
 
         # set what happens for texture coordinates outside [0,1]
         glTexParameteri(self.target, GL_TEXTURE_WRAP_S, wrap)
@@ -57,10 +186,23 @@ class Texture:
 
         # set how sampling from the texture is done.
         glTexParameteri(self.target, GL_TEXTURE_MAG_FILTER, sample)
-        glTexParameteri(self.target, GL_TEXTURE_MIN_FILTER, sample)
+        glTexParameteri(self.target, GL_TEXTURE_MIN_FILTER, self.min_filter())
+
+        if anisotropy > 1.0 and anisotropic_filtering_supported():
+            glTexParameterf(self.target, GL_TEXTURE_MAX_ANISOTROPY, min(anisotropy, glGetFloatv(GL_MAX_TEXTURE_MAX_ANISOTROPY)))
 
         self.unbind()
 
+    def min_filter(self):
+        '''
+        Returns the minification filter of the texture, which also selects how mipmap levels are sampled.
+        '''
+        if self.mipmap is None:
+            return self.sample
+        elif self.sample == GL_LINEAR:
+            return GL_LINEAR_MIPMAP_LINEAR
+        return GL_NEAREST_MIPMAP_NEAREST
+
     def set_shadow_comparison(self):
         self.set_parameter(GL_TEXTURE_COMPARE_MODE, GL_COMPARE_REF_TO_TEXTURE)
 
@@ -80,7 +222,7 @@ class Texture:
         self.sample = sample
         self.bind()
         glTexParameteri(self.target, GL_TEXTURE_MAG_FILTER, sample)
-        glTexParameteri(self.target, GL_TEXTURE_MIN_FILTER, sample)
+        glTexParameteri(self.target, GL_TEXTURE_MIN_FILTER, self.min_filter())
         self.unbind()
 
     def set_data_from_image(self, data, width=None, height=None):
@@ -93,10 +235,74 @@ class Texture:
         # load the texture in the buffer
         glTexImage2D(self.target, 0, self.format, width, height, 0, self.format, self.type, data)
 
+        if self.mipmap is not None:
+            glGenerateMipmap(self.target)
+
         self.unbind()
 
-    def bind(self):
-        glBindTexture(self.target, self.textureid)
+    def bind(self, unit=None):
+        '''
+        Binds the texture to a texture unit, by default the active one.
+        '''
+        gl_state.bind_texture(self.target, self.textureid, unit)
 
     def unbind(self):
-        glBindTexture(self.target, 0)
+        gl_state.bind_texture(self.target, 0)
+
+
+class TextureManager:
+    '''
+    Process-wide cache of the textures loaded from image files, so that all meshes using the same image with the
+    same parameters share one decoded image and one OpenGL texture. Textures are reference counted, and deleted
+    when the last mesh using them releases them. Shared textures should not be modified (eg, using
+    set_sampling_parameter()), use different parameters in get() instead.
+    '''
+    def __init__(self):
+        # the cached textures and their reference count, by image name and texture parameters
+        self.textures = {}
+        # the mipmap levels of the images of the cached textures computed on the CPU, by image name. They are kept as
+        # long as a texture of the image is cached, so that textures of the same image with other parameters do not
+        # compute them again (the images decoded by the asset loader are freed when it is closed).
+        self.levels = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, wrap=GL_REPEAT, sample=GL_NEAREST, format=GL_RGBA, type=GL_UNSIGNED_BYTE, target=GL_TEXTURE_2D, mipmap=None, anisotropy=1.0):
+        '''
+        Returns the texture for an image, loading it only if it is not in the cache yet.
+        The parameters are the same as for Texture().
+        '''
+        key = (name, wrap, sample, format, type, target, mipmap, anisotropy)
+        if key in self.textures:
+            self.hits += 1
+            self.textures[key][1] += 1
+        else:
+            self.misses += 1
+            levels = None
+            if mipmap == 'cpu':
+                if name not in self.levels:
+                    self.levels[name] = ImageWrapper(name).mipmaps(GL_RGBA)
+                levels = self.levels[name]
+            self.textures[key] = [Texture(name, wrap=wrap, sample=sample, format=format, type=type, target=target, mipmap=mipmap, anisotropy=anisotropy, levels=levels), 1]
+        return self.textures[key][0]
+
+    def release(self, texture):
+        '''
+        Releases a texture returned by get(), the OpenGL texture is deleted when it is not used any more.
+        '''
+        for key, entry in self.textures.items():
+            if entry[0] is texture:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    gl_state.delete_texture(texture.textureid)
+                    del self.textures[key]
+                    if all(other[0] != texture.name for other in self.textures):
+                        self.levels.pop(texture.name, None)
+                return
+
+    def report(self):
+        print('Texture cache: {} textures, {} hits, {} misses'.format(len(self.textures), self.hits, self.misses))
+
+
+# the texture manager shared by all meshes
+texture_manager = TextureManager()
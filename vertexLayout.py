@@ -0,0 +1,170 @@
+from OpenGL.GL import *
+
+import numpy as np
+
+'''
+Layout of the vertex attributes in the vertex buffers. The attributes of a model are interleaved in a single buffer,
+each one stored in the format selected by the layout, eg the normals on 10 bits per component rather than as floats.
+'''
+
+
+def quantize_snorm(data, bits):
+    '''
+    Quantizes values in [-1, 1] to signed integers of the given number of bits, as read back by OpenGL for
+    normalized attributes (value = max(integer / (2^(bits-1) - 1), -1)).
+    '''
+    scale = 2 ** (bits - 1) - 1
+    return np.round(np.clip(data, -1., 1.) * scale).astype(np.int32)
+
+
+def pack_int_2_10_10_10_rev(data):
+    '''
+    Packs vectors of up to 4 components in [-1, 1] in 32 bits, for a GL_INT_2_10_10_10_REV attribute: 10 bits for each
+    of x, y and z and 2 bits for w, so that w can only be -1, 0 or 1.
+    '''
+    packed = np.zeros(data.shape[0], dtype=np.uint32)
+    for component in range(data.shape[1]):
+        bits = 10 if component < 3 else 2
+        packed |= (quantize_snorm(data[:, component], bits).astype(np.uint32) & (2 ** bits - 1)) << (10 * component)
+    return packed.reshape(-1, 1)
+
+
+def unpack_int_2_10_10_10_rev(packed, components):
+    data = np.zeros((packed.shape[0], components), dtype='f')
+    for component in range(components):
+        bits = 10 if component < 3 else 2
+        value = (packed[:, 0].astype(np.int64) >> (10 * component)) & (2 ** bits - 1)
+        value = np.where(value >= 2 ** (bits - 1), value - 2 ** bits, value)
+        data[:, component] = np.maximum(value / (2 ** (bits - 1) - 1), -1.)
+    return data
+
+
+# the vertex formats: the OpenGL type, whether the integers are normalized, the number of components given to OpenGL
+# (None for the number of components of the data), and the functions converting the data to and from the format
+vertex_formats = {
+    'float': (GL_FLOAT, False, None, lambda data: data.astype(np.float32), lambda stored, n: stored),
+    'half': (GL_HALF_FLOAT, False, None, lambda data: data.astype(np.float16), lambda stored, n: stored.astype('f')),
+    'unorm16': (GL_UNSIGNED_SHORT, True, None, lambda data: np.round(np.clip(data, 0., 1.) * 65535).astype(np.uint16),
+                lambda stored, n: stored / 65535.),
+    'snorm16': (GL_SHORT, True, None, lambda data: quantize_snorm(data, 16).astype(np.int16),
+                lambda stored, n: np.maximum(stored / 32767., -1.)),
+    'unorm8': (GL_UNSIGNED_BYTE, True, None, lambda data: np.round(np.clip(data, 0., 1.) * 255).astype(np.uint8),
+               lambda stored, n: stored / 255.),
+    'int_2_10_10_10_rev': (GL_INT_2_10_10_10_REV, True, 4, pack_int_2_10_10_10_rev, unpack_int_2_10_10_10_rev),
+}
+
+
+class VertexLayout:
+    '''
+    Selects the format of each vertex attribute in the interleaved vertex buffer of the models (see BaseModel.bind()).
+    Attributes with a format of None are not stored. If the binormals are not stored but the tangents are, the
+    tangents get a fourth component with the sign of the binormal, which shaders recover as
+    binormal = tangent.w * cross(normal, tangent.xyz).
+    '''
+    def __init__(self, formats, tolerances=None):
+        '''
+        :param formats: A dictionary giving the format of each attribute (see vertex_formats), attributes not listed
+        are stored as floats
+        :param tolerances: A dictionary giving the largest error allowed when converting an attribute to its format,
+        above which the attribute is stored as floats, eg for texture coordinates repeating the texture many times,
+        which are not precise enough as half floats
+        '''
+        for name, format in formats.items():
+            if format is not None and format not in vertex_formats:
+                raise ValueError('Unknown vertex format {} for attribute {}'.format(format, name))
+        self.formats = formats
+        self.tolerances = tolerances if tolerances is not None else {}
+
+    def pack(self, attributes):
+        '''
+        Converts the attributes to their format and interleaves them.
+        :param attributes: A list of (name, array) pairs, in the order of their locations. Arrays that are None are
+        skipped. The 'binormal' attribute may be dropped, see above.
+        :return: A tuple (array of bytes with one row per vertex, list of (name, size, type, normalized, offset))
+        '''
+        arrays = dict(attributes)
+        if self.formats.get('binormal', 'float') is None and arrays.get('tangent') is not None and arrays.get('binormal') is not None:
+            tangents, binormals = arrays['tangent'], arrays['binormal']
+            normals = arrays['normal'] if arrays.get('normal') is not None else np.cross(binormals, tangents)
+            sign = np.where(np.sum(np.cross(normals, tangents) * binormals, axis=1, keepdims=True) < 0, -1., 1.)
+            arrays['tangent'] = np.hstack([tangents, sign])
+
+        fields = []
+        offset = 0
+        for name, data in attributes:
+            data = arrays[name]
+            format = self.formats.get(name, 'float')
+            if data is None or format is None:
+                continue
+            stored = self.convert(name, data, format)
+            if stored is None:
+                format = 'float'
+                stored = vertex_formats[format][3](data)
+
+            type, normalized, size, encode, decode = vertex_formats[format]
+            stored = stored.reshape(stored.shape[0], -1)
+            fields.append((name, size or data.shape[1], type, normalized, offset, stored))
+
+            # each attribute is aligned on 4 bytes
+            offset += -(-stored[0].nbytes // 4) * 4
+
+        vertices = np.zeros((fields[0][5].shape[0], offset), dtype=np.uint8)
+        for name, size, type, normalized, start, stored in fields:
+            vertices[:, start:start + stored[0].nbytes] = np.ascontiguousarray(stored).view(np.uint8).reshape(stored.shape[0], -1)
+
+        return vertices, [field[:5] for field in fields]
+
+    def convert(self, name, data, format):
+        '''
+        Converts an attribute to a format, or returns None if the error is above the tolerance of the attribute.
+        '''
+        type, normalized, size, encode, decode = vertex_formats[format]
+        stored = encode(data)
+        if name in self.tolerances:
+            error = np.max(np.abs(decode(stored, data.shape[1]) - data), initial=0.)
+            if error > self.tolerances[name]:
+                print('Vertex attribute {} stored as floats, as the error in format {} is {:.5f}'.format(name, format, error))
+                return None
+        return stored
+
+
+# the default layout: positions as floats, directions on 10 bits per component and texture coordinates as half
+# floats, unless they repeat the texture too many times (the error should stay below half a texel for a 1024 pixels
+# texture)
+default_layout = VertexLayout(
+    formats={'position': 'float', 'normal': 'int_2_10_10_10_rev', 'color': 'unorm8', 'texCoord': 'half',
+             'tangent': 'int_2_10_10_10_rev', 'binormal': None},
+    tolerances={'texCoord': 1. / 2048})
+
+# all attributes stored as floats, eg for comparing the rendering with the default layout
+float_layout = VertexLayout(formats={})
+
+
+class VertexMemory:
+    '''
+    Counts the memory used by the vertex and index buffers of the models, and the memory the vertices would use with
+    all attributes stored as floats.
+    '''
+    def __init__(self):
+        self.vertices = 0
+        self.vertex_bytes = 0
+        self.float_bytes = 0
+        self.index_bytes = 0
+
+    def add(self, count, vertex_bytes, float_bytes, index_bytes):
+        self.vertices += count
+        self.vertex_bytes += vertex_bytes
+        self.float_bytes += float_bytes
+        self.index_bytes += index_bytes
+
+    def report(self):
+        if self.vertices == 0:
+            return
+        print('Vertex buffers: {} vertices, {:.1f} bytes per vertex ({:.1f} as floats), {:.2f}MB ({:.2f}MB as floats) '
+              'and {:.2f}MB of indices'.format(
+                  self.vertices, self.vertex_bytes / self.vertices, self.float_bytes / self.vertices,
+                  self.vertex_bytes / 2 ** 20, self.float_bytes / 2 ** 20, self.index_bytes / 2 ** 20))
+
+
+# the vertex memory of all models
+vertex_memory = VertexMemory()